@@ -0,0 +1,48 @@
+import argparse
+import time
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import DBSCAN
+from metabgc.src.metabgccluster import ClusterReads
+
+"""
+Benchmark of the sparse radius graph DBSCAN of metabgc cluster against the dense brute force
+DBSCAN on synthetic abundance matrices, where reads of a bin have noisy copies of a sparse
+sample profile. The dense run is skipped above --max_dense_reads.
+"""
+
+def synthetic_matrix(num_reads, num_samples, num_bins, density, seed):
+    rng = np.random.RandomState(seed)
+    bin_profiles = sparse.random(num_bins, num_samples, density=density, random_state=rng,
+                                 data_rvs=lambda n: rng.poisson(20, n) + 1).tocsr()
+    bins = rng.randint(0, num_bins, num_reads)
+    mat = bin_profiles[bins].multiply(rng.randint(1, 4, (num_reads, 1))).tocsr()
+    mat.data = mat.data + rng.poisson(0.5, mat.nnz)
+    return mat.astype(np.float64)
+
+def time_call(func):
+    t0 = time.time()
+    result = func()
+    return result, time.time() - t0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the sparse DBSCAN of metabgc cluster.")
+    parser.add_argument('--num_reads', type=int, nargs='+', default=[2000, 50000, 200000], help="Number of reads.")
+    parser.add_argument('--num_samples', type=int, default=2000, help="Number of samples.")
+    parser.add_argument('--num_bins', type=int, default=2000, help="Number of bins.")
+    parser.add_argument('--density', type=float, default=0.01, help="Fraction of the samples of a bin.")
+    parser.add_argument('--max_dist', type=float, default=0.1, help="DBSCAN eps.")
+    parser.add_argument('--max_dense_reads', type=int, default=5000, help="Largest matrix clustered densely.")
+    parser.add_argument('--seed', type=int, default=915, help="Random seed.")
+    args = parser.parse_args()
+
+    for num_reads in args.num_reads:
+        mat = synthetic_matrix(num_reads, args.num_samples, args.num_bins, args.density, args.seed)
+        print("== {0} reads x {1} samples, {2} non zero ==".format(num_reads, args.num_samples, mat.nnz))
+        sparse_labels, sparse_seconds = time_call(lambda: ClusterReads(mat, args.max_dist, 1))
+        print("sparse: {0:.2f}s, {1} bins".format(sparse_seconds, len(set(sparse_labels.tolist()))))
+        if num_reads <= args.max_dense_reads:
+            dense_labels, dense_seconds = time_call(lambda: DBSCAN(eps=args.max_dist, min_samples=1, metric="correlation",
+                                                                   algorithm="brute").fit_predict(mat.toarray()))
+            print("dense: {0:.2f}s, speedup {1:.1f}x, same labels: {2}".format(
+                dense_seconds, dense_seconds / sparse_seconds, dense_labels.tolist() == sparse_labels.tolist()))
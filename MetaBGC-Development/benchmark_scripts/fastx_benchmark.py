@@ -0,0 +1,59 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from Bio import SeqIO
+from metabgc.src.seqreader import ReadFastxBatches, FastxToFasta
+
+"""
+Benchmark of the buffer-level FASTA/FASTQ reader against Bio.SeqIO on synthetic FASTQ
+files, for parsing alone and for the FASTQ to FASTA conversion done in preprocessing.
+"""
+
+def write_fastq(fastq_file, num_reads, read_len, seed):
+    random.seed(seed)
+    pool = [''.join(random.choice('ACGT') for _ in range(read_len)) for _ in range(1000)]
+    qual = 'I' * read_len
+    with open(fastq_file, 'w') as outfile:
+        for i in range(num_reads):
+            outfile.write("@read" + str(i) + "/1\n" + pool[i % 1000] + "\n+\n" + qual + "\n")
+
+def time_call(func):
+    t0 = time.time()
+    result = func()
+    return result, time.time() - t0
+
+def report(name, num_reads, seconds):
+    print("{0}: {1} reads in {2:.2f}s, {3:.0f} reads/s".format(name, num_reads, seconds, num_reads / seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the buffer-level reader against Bio.SeqIO.")
+    parser.add_argument('--num_reads', type=int, nargs='+', default=[1000000, 10000000],
+                        help="Number of synthetic reads of each benchmark file.")
+    parser.add_argument('--read_len', type=int, default=150, help="Length of synthetic reads.")
+    parser.add_argument('--seed', type=int, default=915, help="Random seed.")
+    parser.add_argument('--skip_seqio', action='store_true', help="Only time the buffer-level reader.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="metabgc_fastx_")
+    try:
+        for num_reads in args.num_reads:
+            fastq_file = os.path.join(work_dir, "reads.fastq")
+            write_fastq(fastq_file, num_reads, args.read_len, args.seed)
+            print("== {0} reads ==".format(num_reads))
+
+            count, seconds = time_call(lambda: sum(len(h) for h, s in ReadFastxBatches(fastq_file, "fastq")))
+            report("buffer parse", count, seconds)
+            count, seconds = time_call(lambda: FastxToFasta(fastq_file, "fastq", os.path.join(work_dir, "buffer.fasta")))
+            report("buffer convert", count, seconds)
+            if not args.skip_seqio:
+                count, seconds = time_call(lambda: sum(1 for r in SeqIO.parse(fastq_file, "fastq")))
+                report("SeqIO parse", count, seconds)
+                count, seconds = time_call(lambda: SeqIO.convert(fastq_file, "fastq",
+                                                                 os.path.join(work_dir, "seqio.fasta"), "fasta"))
+                report("SeqIO convert", count, seconds)
+            os.remove(fastq_file)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,120 @@
+import argparse
+import os
+import pickle
+import random
+import shutil
+import tempfile
+import time
+from metabgc.src.kmerrecruit import RunPCKmerRecruit, CompareRecruitment, ReverseComplement, BuildKmerIndex, RecruitRead
+from metabgc.src.seqreader import ReadFastxBatches, RecordId
+from metabgc.src.blastrunlib import RunPCMakeDBandBlastN
+
+"""
+Accuracy and speed of the k-mer recruitment of quantify on synthetic samples. Reads are
+sampled from random identified reads with substitutions and random strands, mixed with
+unrelated reads. The recruitment is compared with the generated truth and, when blastn and
+makeblastdb are on the PATH, with the BLAST search of quantify. On one process, it is also
+timed against the unscreened recruitment, where the index is pickled for each sample task
+and every read goes through the Python k-mer lookups.
+"""
+
+QUANTIFY_BLAST_PARAMS = "-dust no -max_target_seqs 1000000 -perc_identity 95.0 -qcov_hsp_perc 50 -window_size 11 " \
+                        "-outfmt \"6 sseqid slen sstart send qseqid qlen qstart qend pident evalue\" "
+
+def random_seq(length):
+    return "".join(random.choice("ACGT") for i in range(length))
+
+def mutate(seq, rate):
+    return "".join(random.choice([b for b in "ACGT" if b != c]) if random.random() < rate else c for c in seq)
+
+def write_inputs(work_dir, num_reps, num_samples, reads_per_sample, read_len, seed):
+    random.seed(seed)
+    rep_list = [random_seq(read_len) for i in range(num_reps)]
+    rep_file = os.path.join(work_dir, "CombinedIDFASTASeqs_Drep.fasta")
+    with open(rep_file, 'w') as outfile:
+        for i, rep in enumerate(rep_list):
+            outfile.write(">id{0}\n{1}\n".format(i, rep))
+    read_dir = os.path.join(work_dir, "nucl_seq_dir")
+    os.makedirs(read_dir)
+    truth_dir = os.path.join(work_dir, "truth")
+    os.makedirs(truth_dir)
+    for s in range(num_samples):
+        sample = "S{0}".format(s)
+        with open(os.path.join(read_dir, sample + ".fasta"), 'w') as read_file, \
+                open(os.path.join(truth_dir, sample + ".txt"), 'w') as truth_file:
+            for r in range(reads_per_sample):
+                read_id = "{0}_r{1}".format(sample, r)
+                if random.random() < 0.1:
+                    rep_idx = random.randrange(num_reps)
+                    offset = random.randint(0, read_len // 3)
+                    rate = random.choice([0.0, 0.01, 0.02, 0.1])
+                    read = mutate(rep_list[rep_idx][offset:], rate) + random_seq(offset)
+                    if random.random() < 0.5:
+                        read = ReverseComplement(read.encode()).decode()
+                    if rate <= 0.02:
+                        truth_file.write("{0}\t{1}\t0\t0\tid{2}\n".format(read_id, read_len, rep_idx))
+                else:
+                    read = random_seq(read_len)
+                read_file.write(">{0}\n{1}\n".format(read_id, read))
+    return rep_file, read_dir, truth_dir
+
+def unscreened_recruit(read_dir, rep_file, out_dir):
+    index = BuildKmerIndex(rep_file)
+    for file in sorted(os.listdir(read_dir)):
+        # The copy of the index that each task received through the task queue
+        task_index = pickle.loads(pickle.dumps(index))
+        with open(os.path.join(out_dir, file.split(".")[0] + ".txt"), 'w') as outfile:
+            for headers, seqs in ReadFastxBatches(os.path.join(read_dir, file), "fasta"):
+                for header, seq in zip(headers, seqs):
+                    outfile.write("".join(RecruitRead(RecordId(header).decode(), seq.upper(), task_index)))
+
+def time_call(func):
+    t0 = time.time()
+    func()
+    return time.time() - t0
+
+def report(name, compare_dict):
+    print("{0}: recall {1:.4f}, precision {2:.4f} ({3} reference pairs, {4} recruited, {5} shared)".format(
+        name, compare_dict["recall"], compare_dict["precision"], compare_dict["reference"],
+        compare_dict["recruited"], compare_dict["shared"]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the k-mer recruitment of quantify against blastn.")
+    parser.add_argument('--num_reps', type=int, default=2000, help="Number of identified reads.")
+    parser.add_argument('--num_samples', type=int, default=4, help="Number of samples.")
+    parser.add_argument('--reads_per_sample', type=int, default=100000, help="Number of reads of each sample.")
+    parser.add_argument('--read_len', type=int, default=100, help="Read length.")
+    parser.add_argument('--cpu', type=int, default=4, help="Number of processes.")
+    parser.add_argument('--seed', type=int, default=915, help="Random seed.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="metabgc_recruit_")
+    try:
+        rep_file, read_dir, truth_dir = write_inputs(work_dir, args.num_reps, args.num_samples,
+                                                     args.reads_per_sample, args.read_len, args.seed)
+        kmer_dir = os.path.join(work_dir, "kmer")
+        os.makedirs(kmer_dir)
+        kmer_seconds = time_call(lambda: RunPCKmerRecruit(read_dir, rep_file, kmer_dir, args.cpu))
+        print("k-mer recruitment: {0:.2f}s".format(kmer_seconds))
+        report("k-mer vs truth", CompareRecruitment(truth_dir, kmer_dir))
+        serial_dir = os.path.join(work_dir, "kmer_serial")
+        os.makedirs(serial_dir)
+        serial_seconds = time_call(lambda: RunPCKmerRecruit(read_dir, rep_file, serial_dir, 1))
+        unscreened_dir = os.path.join(work_dir, "kmer_unscreened")
+        os.makedirs(unscreened_dir)
+        unscreened_seconds = time_call(lambda: unscreened_recruit(read_dir, rep_file, unscreened_dir))
+        print("one process: {0:.2f}s, unscreened with an index per task: {1:.2f}s, speedup {2:.1f}x".format(
+            serial_seconds, unscreened_seconds, unscreened_seconds / serial_seconds))
+        report("k-mer vs unscreened", CompareRecruitment(unscreened_dir, serial_dir))
+        if shutil.which("blastn") and shutil.which("makeblastdb"):
+            blast_dir = os.path.join(work_dir, "blastn")
+            os.makedirs(blast_dir)
+            blast_seconds = time_call(lambda: RunPCMakeDBandBlastN(read_dir, "", rep_file, "blastn",
+                                                                   QUANTIFY_BLAST_PARAMS, blast_dir, args.cpu + 1))
+            print("blastn: {0:.2f}s, speedup {1:.1f}x".format(blast_seconds, blast_seconds / kmer_seconds))
+            report("blastn vs truth", CompareRecruitment(truth_dir, blast_dir))
+            report("k-mer vs blastn", CompareRecruitment(blast_dir, kmer_dir))
+        else:
+            print("blastn or makeblastdb not found, skipping the BLAST comparison.")
+    finally:
+        shutil.rmtree(work_dir)
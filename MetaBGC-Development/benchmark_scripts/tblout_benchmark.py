@@ -0,0 +1,70 @@
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from Bio import SearchIO
+from metabgc.src.utils import parseHMMScores
+
+"""
+Benchmark of the line-oriented tblout parser against Bio.SearchIO on synthetic hmmsearch
+tblout files. The SearchIO side keeps the best score of each read, as parseHMMScores does.
+"""
+
+TBL_HEADER = ("# target name  accession  query name  accession  E-value  score  bias  E-value  score  bias  "
+              "exp reg clu  ov env dom rep inc description of target\n")
+
+def write_tblout(tbl_file, num_hits, seed):
+    random.seed(seed)
+    with open(tbl_file, 'w') as outfile:
+        outfile.write(TBL_HEADER)
+        for i in range(num_hits):
+            score = round(random.uniform(0.0, 200.0), 1)
+            outfile.write("read{0}_{1} - AbcK__30_10__30_60 - 1e-10 {2} 0.1 1e-10 {2} 0.1 1.0 1 0 0 1 1 1 1 -\n"
+                          .format(i, i % 6 + 1, score))
+
+def searchio_scores(tbl_file):
+    score_dict = {}
+    with open(tbl_file, 'r') as handle:
+        for record in SearchIO.parse(handle, "hmmer3-tab"):
+            for hit in record.hits:
+                if hit.bitscore > score_dict.get(hit.id, float('-inf')):
+                    score_dict[hit.id] = hit.bitscore
+    return score_dict
+
+def time_call(func):
+    t0 = time.time()
+    result = func()
+    return result, time.time() - t0
+
+def report(name, num_hits, seconds):
+    print("{0}: {1} hits in {2:.2f}s, {3:.0f} hits/s".format(name, num_hits, seconds, num_hits / seconds))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the native tblout parser against Bio.SearchIO.")
+    parser.add_argument('--num_hits', type=int, nargs='+', default=[1000000],
+                        help="Number of hit lines of each benchmark file.")
+    parser.add_argument('--seed', type=int, default=915, help="Random seed.")
+    parser.add_argument('--min_speedup', type=float, default=10.0,
+                        help="Fail if the native parser is not this many times faster.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="metabgc_tblout_")
+    try:
+        for num_hits in args.num_hits:
+            tbl_file = os.path.join(work_dir, "S1__30_60.tbl")
+            write_tblout(tbl_file, num_hits, args.seed)
+            print("== {0} hits ==".format(num_hits))
+
+            native_dict, native_seconds = time_call(lambda: parseHMMScores(tbl_file))
+            report("native parse", num_hits, native_seconds)
+            seqio_dict, seqio_seconds = time_call(lambda: searchio_scores(tbl_file))
+            report("SearchIO parse", num_hits, seqio_seconds)
+            assert native_dict == seqio_dict
+            speedup = seqio_seconds / native_seconds
+            print("speedup: {0:.1f}x".format(speedup))
+            assert speedup >= args.min_speedup, "native parser is less than {0}x faster".format(args.min_speedup)
+            os.remove(tbl_file)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,75 @@
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from metabgc.src.seqtranslate import TranslateFastaFile
+
+"""
+Benchmark of the built-in 6 frame translator against EMBOSS transeq on one core.
+A synthetic read FASTA is generated unless one is provided with --fasta.
+"""
+
+def write_reads(fasta_file, num_reads, read_len, seed):
+    random.seed(seed)
+    with open(fasta_file, 'w') as outfile:
+        for i in range(num_reads):
+            seq = ''.join(random.choice('ACGT') for _ in range(read_len))
+            outfile.write(">read" + str(i) + "/1\n" + seq + "\n")
+
+def read_fasta_dict(fasta_file):
+    seq_dict = {}
+    seq_id = None
+    with open(fasta_file) as infile:
+        for line in infile:
+            line = line.strip()
+            if line.startswith('>'):
+                seq_id = line[1:].split()[0]
+                seq_dict[seq_id] = []
+            elif seq_id is not None:
+                seq_dict[seq_id].append(line)
+    return {k: ''.join(v) for k, v in seq_dict.items()}
+
+def count_reads(fasta_file):
+    with open(fasta_file, 'rb') as infile:
+        return sum(1 for line in infile if line.startswith(b'>'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark built-in translation against EMBOSS transeq.")
+    parser.add_argument('--fasta', help="Read FASTA file. Synthetic reads are generated if not provided.")
+    parser.add_argument('--num_reads', type=int, default=1000000, help="Number of synthetic reads.")
+    parser.add_argument('--read_len', type=int, default=100, help="Length of synthetic reads.")
+    parser.add_argument('--seed', type=int, default=915, help="Random seed.")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="metabgc_translate_")
+    try:
+        fasta_file = args.fasta
+        if fasta_file is None:
+            fasta_file = os.path.join(work_dir, "reads.fasta")
+            write_reads(fasta_file, args.num_reads, args.read_len, args.seed)
+        num_reads = count_reads(fasta_file)
+
+        builtin_out = os.path.join(work_dir, "builtin.faa")
+        t0 = time.time()
+        TranslateFastaFile(fasta_file, builtin_out)
+        builtin_time = time.time() - t0
+        print("builtin: {0} reads in {1:.2f}s, {2:.0f} reads/s/core".format(num_reads, builtin_time, num_reads / builtin_time))
+
+        if shutil.which("transeq"):
+            transeq_out = os.path.join(work_dir, "transeq.faa")
+            t0 = time.time()
+            subprocess.call("transeq " + fasta_file + " " + transeq_out + " -frame=6 -table=11 -sformat pearson", shell=True)
+            transeq_time = time.time() - t0
+            print("transeq: {0} reads in {1:.2f}s, {2:.0f} reads/s/core".format(num_reads, transeq_time, num_reads / transeq_time))
+            print("speedup: {0:.1f}x".format(transeq_time / builtin_time))
+            builtin_dict = read_fasta_dict(builtin_out)
+            transeq_dict = read_fasta_dict(transeq_out)
+            mismatch = [k for k in transeq_dict if builtin_dict.get(k) != transeq_dict[k]]
+            print("records compared: {0}, mismatched: {1}".format(len(transeq_dict), len(mismatch)))
+        else:
+            print("transeq not found on PATH, skipping the comparison.")
+    finally:
+        shutil.rmtree(work_dir)
@@ -5,10 +5,16 @@ import os
 from metabgc.src.metabgcbuild import mbgcbuild
 from metabgc.src.metabgcidentify import mbgcidentify
 from metabgc.src.metabgcquantify import mbgcquantify
-from metabgc.src.metabgccluster import mbgccluster
+from metabgc.src.metabgccluster import mbgccluster, mbgcclusterupdate, mbgcclustersweep
 from metabgc.src.metabgcanalytics import mbgcanalytics
 from metabgc.src.metabgcsynthesize import mbgcsynthesize
 from metabgc.src.metabgcfindTP import mbgcfindtp
+from metabgc.src.resultcache import SetCacheDirectory, FileSignature, DirectorySignature
+from metabgc.src.blastdbregistry import SetBlastDBRegistry
+from metabgc.src.pipelinestate import RunStage
+from metabgc.src.executionbackend import SetExecutionBackend, RunWorker
+from metabgc.src.tableio import SetIntermediateFormat, ExportTSV
+from metabgc.src.hitstore import ReadHitTable
 
 __version__ = "2.0.0"
 
@@ -57,13 +63,21 @@ def cli():
 @click.option('--output_directory', required=True,
               type=click.Path(exists=True,dir_okay=True,writable=True),
               help="Directory to save results.")
+@click.option('--cache_directory', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Shared directory of cached HMMER and BLAST results, reused across output directories. Also read from METABGC_CACHE_DIR.")
+@click.option('--blast_db_registry', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Directory of the BLAST databases of the samples, keyed by sample content and reused across runs and protein families. Also read from METABGC_BLASTDB_DIR. Def.: blastdb in the cache directory, else ~/.cache/metabgc/blastdb.")
 @click.option('--cpu', required=False,
               type=click.INT,default=4,
               help="Number of threads. Def.: 4")
 def build(prot_alignment,prot_family_name,cohort_name,
           nucl_seq_directory,prot_seq_directory,seq_fmt,pair_fmt,r1_file_suffix,
           r2_file_suffix,tp_genes_nucl,blast_db_directory_map_file,blastn_search_directory,hmm_search_directory,f1_thresh,
-          output_directory,cpu):
+          output_directory,cache_directory,blast_db_registry,cpu):
+    SetCacheDirectory(cache_directory)
+    SetBlastDBRegistry(blast_db_registry)
     click.echo('Invoking MetaBGC Build...')
     t0 = time()
     logging.basicConfig(filename=os.path.join(output_directory, 'metabgc.log'), level=logging.INFO)
@@ -100,19 +114,51 @@ def build(prot_alignment,prot_family_name,cohort_name,
 @click.option('--hmm_search_directory', required=False,
               type=click.Path(exists=True,dir_okay=True,readable=True),
               help="Directory with HMM searches of the synthetic read files against all the spHMMs. Computed if not provided. To compute seperately, please see partial_scripts in development.")
+@click.option('--single_pass', is_flag=True, default=False,
+              help="Search each translated sample once against all the spHMMs combined into one hmmscan database.")
+@click.option('--stream_translation', is_flag=True, default=False,
+              help="Pipe the translated reads directly into the HMM search instead of writing prot_seq_dir. Implies --single_pass.")
+@click.option('--keep_prot_seq', is_flag=True, default=False,
+              help="With --stream_translation, also save the translated reads in prot_seq_dir.")
+@click.option('--prefilter', is_flag=True, default=False,
+              help="Only search the translated reads sharing a reduced alphabet k-mer with the spHMM seed alignments.")
+@click.option('--prefilter_report', is_flag=True, default=False,
+              help="With --prefilter, also search all the reads and report the recall of the prefilter.")
 @click.option('--output_directory', required=True,
               type=click.Path(exists=True,dir_okay=True,writable=True),
               help="Directory to save results.")
+@click.option('--intermediate_format', required=False,
+              type=click.Choice(['tsv', 'parquet'],case_sensitive=False),default='tsv',
+              help="Format of the intermediate hit and abundance tables. Parquet needs pyarrow. Def.: tsv")
+@click.option('--cache_directory', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Shared directory of cached HMMER and BLAST results, reused across output directories. Also read from METABGC_CACHE_DIR.")
+@click.option('--backend', required=False,
+              type=click.Choice(['local', 'queue', 'slurm'],case_sensitive=False),default='local',
+              help="Execution backend of the hmmsearch, blastn and makeblastdb tasks. queue and slurm run them on workers pulling from --queue_directory. Def.: local")
+@click.option('--queue_directory', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Work queue directory of the queue and slurm backends, on a filesystem shared with the workers.")
+@click.option('--local_workers', required=False,
+              type=click.INT,default=0,
+              help="With the queue backend, number of worker processes started on this node. Def.: 0, workers are started with metabgc worker.")
+@click.option('--slurm_options', required=False,
+              help="With the slurm backend, extra sbatch options of the worker job array, e.g. \"--partition=short --time=10:00:00\".")
 @click.option('--cpu', required=False,
               type=click.INT,default=4,
               help="Number of threads. Def.: 4")
 def identify(sphmm_directory,cohort_name,nucl_seq_directory,prot_seq_directory,
              seq_fmt,pair_fmt,r1_file_suffix,r2_file_suffix,
-             prot_family_name, hmm_search_directory, output_directory,cpu):
+             prot_family_name, hmm_search_directory, single_pass, stream_translation, keep_prot_seq, prefilter, prefilter_report,
+             output_directory,intermediate_format,cache_directory,backend,queue_directory,local_workers,slurm_options,cpu):
+    SetIntermediateFormat(intermediate_format)
+    SetCacheDirectory(cache_directory)
+    SetExecutionBackend(backend, queue_directory, local_workers, slurm_options)
     click.echo('Invoking MetaBGC Identify...')
     ident_reads_file = mbgcidentify(sphmm_directory, cohort_name, nucl_seq_directory,prot_seq_directory,
                  seq_fmt, pair_fmt, r1_file_suffix, r2_file_suffix,
-                 prot_family_name, hmm_search_directory, output_directory, cpu)
+                 prot_family_name, hmm_search_directory, output_directory, cpu, single_pass,
+                 stream_translation, keep_prot_seq, prefilter, prefilter_report)
     print('Identified reads: ' + ident_reads_file)
 
 @cli.command()
@@ -142,19 +188,48 @@ def identify(sphmm_directory,cohort_name,nucl_seq_directory,prot_seq_directory,
 @click.option('--blast_db_directory_map_file', required=False,
               type=click.Path(exists=True,dir_okay=False,readable=True),
               help="Path to 2 column comma seperated mapping file with (sample_name,blast_database_path). The BLAST databases are computed if not provided. To compute seperately, please see partial_scripts in development.")
+@click.option('--inverted_blast', is_flag=True, default=False,
+              help="Build one BLAST database of the identified reads and search the reads of each sample against it, instead of a database per sample.")
+@click.option('--recruit_method', required=False,
+              type=click.Choice(['blastn', 'kmer'],case_sensitive=False),default='blastn',
+              help="Method matching the sample reads to the identified reads: blastn, or an in-process k-mer index with ungapped extension. Def.: blastn")
 @click.option('--output_directory', required=True,
               type=click.Path(exists=True,dir_okay=True,writable=True),
               help="Directory to save results.")
+@click.option('--intermediate_format', required=False,
+              type=click.Choice(['tsv', 'parquet'],case_sensitive=False),default='tsv',
+              help="Format of the intermediate hit and abundance tables. Parquet needs pyarrow. Def.: tsv")
+@click.option('--cache_directory', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Shared directory of cached HMMER and BLAST results, reused across output directories. Also read from METABGC_CACHE_DIR.")
+@click.option('--blast_db_registry', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Directory of the BLAST databases of the samples, keyed by sample content and reused across runs and protein families. Also read from METABGC_BLASTDB_DIR. Def.: blastdb in the cache directory, else ~/.cache/metabgc/blastdb.")
+@click.option('--backend', required=False,
+              type=click.Choice(['local', 'queue', 'slurm'],case_sensitive=False),default='local',
+              help="Execution backend of the hmmsearch, blastn and makeblastdb tasks. queue and slurm run them on workers pulling from --queue_directory. Def.: local")
+@click.option('--queue_directory', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Work queue directory of the queue and slurm backends, on a filesystem shared with the workers.")
+@click.option('--local_workers', required=False,
+              type=click.INT,default=0,
+              help="With the queue backend, number of worker processes started on this node. Def.: 0, workers are started with metabgc worker.")
+@click.option('--slurm_options', required=False,
+              help="With the slurm backend, extra sbatch options of the worker job array, e.g. \"--partition=short --time=10:00:00\".")
 @click.option('--cpu', required=False,
               type=click.INT,default=4,
               help="Number of threads. Def.: 4")
 def quantify(identify_fasta,prot_family_name,cohort_name,nucl_seq_directory,
              seq_fmt,pair_fmt,r1_file_suffix,r2_file_suffix,blastn_search_directory,blast_db_directory_map_file,
-             output_directory,cpu):
+             inverted_blast,recruit_method,output_directory,intermediate_format,cache_directory,blast_db_registry,backend,queue_directory,local_workers,slurm_options,cpu):
+    SetIntermediateFormat(intermediate_format)
+    SetCacheDirectory(cache_directory)
+    SetBlastDBRegistry(blast_db_registry)
+    SetExecutionBackend(backend, queue_directory, local_workers, slurm_options)
     click.echo('Invoking MetaBGC Quantify...')
     abund_file, abund_wide_table = mbgcquantify(identify_fasta, prot_family_name, cohort_name, nucl_seq_directory,
              seq_fmt, pair_fmt, r1_file_suffix, r2_file_suffix,blast_db_directory_map_file,blastn_search_directory,
-             output_directory, cpu)
+             output_directory, cpu, inverted_blast, recruit_method)
     print('Reads abundance file: ' + abund_file)
 
 
@@ -172,9 +247,28 @@ def quantify(identify_fasta,prot_family_name,cohort_name,nucl_seq_directory,
 @click.option("--min_reads_bin", type=float, default=10,help="Minimum number of reads required in a bin to be considered in analytics output files.")
 @click.option("--min_abund_bin", type=float, default=10,help="Minimum total read abundance required in a bin to be considered in analytics output files.")
 @click.option("--cpu", type=int, default=1,help="Number of threads.")
-def cluster(table,table_wide,identify_fasta,max_dist,min_samples,min_reads_bin,min_abund_bin,cpu):
+@click.option("--update_model", default=None, type=click.Path(exists=True,file_okay=True,readable=True),
+              help="ClusterModel.json of a previous cluster run. The samples of --table are added to its bins, " \
+                   "re-clustering only the reads they affect, with the --max_dist and --min_samples of the model.")
+@click.option("--sweep", is_flag=True, default=False,
+              help="Compare the bins of a grid of --sweep_max_dist and --sweep_min_samples in ClusterSweep.tsv, " \
+                   "computing the read distances once, instead of writing the bins.")
+@click.option("--sweep_max_dist", default="0.05,0.1,0.2,0.3", help="Comma separated max_dist values of --sweep.")
+@click.option("--sweep_min_samples", default="1,2,3,5", help="Comma separated min_samples values of --sweep.")
+def cluster(table,table_wide,identify_fasta,max_dist,min_samples,min_reads_bin,min_abund_bin,cpu,update_model,
+            sweep,sweep_max_dist,sweep_min_samples):
     click.echo('Invoking MetaBGC Cluster...')
-    summary_file, cluster_file = mbgccluster(table,table_wide, identify_fasta, max_dist, min_samples,min_reads_bin, min_abund_bin, cpu)
+    if sweep:
+        sweep_file = mbgcclustersweep(table, table_wide, [float(d) for d in sweep_max_dist.split(",")],
+                                      [int(m) for m in sweep_min_samples.split(",")],
+                                      min_reads_bin, min_abund_bin, cpu)
+        click.echo('Cluster sweep file: ' + sweep_file)
+        return
+    if update_model:
+        summary_file, cluster_file = mbgcclusterupdate(update_model, table, table_wide, identify_fasta,
+                                                       min_reads_bin, min_abund_bin, cpu)
+    else:
+        summary_file, cluster_file = mbgccluster(table,table_wide, identify_fasta, max_dist, min_samples,min_reads_bin, min_abund_bin, cpu)
     click.echo('Cluster summary file: ' + summary_file)
     click.echo('Cluster detail file: ' + cluster_file)
 
@@ -215,29 +309,95 @@ def cluster(table,table_wide,identify_fasta,max_dist,min_samples,min_reads_bin,m
 @click.option('--blast_db_directory_map_file', required=False,
               type=click.Path(exists=True,dir_okay=False,readable=True),
               help="Path to 2 column comma seperated mapping file with (sample_name,blast_database_path). The BLAST databases are computed if not provided. To compute seperately, please see partial_scripts in development.")
+@click.option('--single_pass', is_flag=True, default=False,
+              help="Search each translated sample once against all the spHMMs combined into one hmmscan database.")
+@click.option('--stream_translation', is_flag=True, default=False,
+              help="Pipe the translated reads directly into the HMM search instead of writing prot_seq_dir. Implies --single_pass.")
+@click.option('--keep_prot_seq', is_flag=True, default=False,
+              help="With --stream_translation, also save the translated reads in prot_seq_dir.")
+@click.option('--prefilter', is_flag=True, default=False,
+              help="Only search the translated reads sharing a reduced alphabet k-mer with the spHMM seed alignments.")
+@click.option('--prefilter_report', is_flag=True, default=False,
+              help="With --prefilter, also search all the reads and report the recall of the prefilter.")
+@click.option('--inverted_blast', is_flag=True, default=False,
+              help="Build one BLAST database of the identified reads and search the reads of each sample against it, instead of a database per sample.")
+@click.option('--recruit_method', required=False,
+              type=click.Choice(['blastn', 'kmer'],case_sensitive=False),default='blastn',
+              help="Method matching the sample reads to the identified reads: blastn, or an in-process k-mer index with ungapped extension. Def.: blastn")
 @click.option('--output_directory', required=True,
               type=click.Path(exists=True,dir_okay=True,writable=True),
               help="Directory to save results.")
+@click.option('--intermediate_format', required=False,
+              type=click.Choice(['tsv', 'parquet'],case_sensitive=False),default='tsv',
+              help="Format of the intermediate hit and abundance tables. Parquet needs pyarrow. Def.: tsv")
+@click.option('--cache_directory', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Shared directory of cached HMMER and BLAST results, reused across output directories. Also read from METABGC_CACHE_DIR.")
+@click.option('--blast_db_registry', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Directory of the BLAST databases of the samples, keyed by sample content and reused across runs and protein families. Also read from METABGC_BLASTDB_DIR. Def.: blastdb in the cache directory, else ~/.cache/metabgc/blastdb.")
+@click.option('--backend', required=False,
+              type=click.Choice(['local', 'queue', 'slurm'],case_sensitive=False),default='local',
+              help="Execution backend of the hmmsearch, blastn and makeblastdb tasks. queue and slurm run them on workers pulling from --queue_directory. Def.: local")
+@click.option('--queue_directory', required=False,
+              type=click.Path(dir_okay=True,writable=True),
+              help="Work queue directory of the queue and slurm backends, on a filesystem shared with the workers.")
+@click.option('--local_workers', required=False,
+              type=click.INT,default=0,
+              help="With the queue backend, number of worker processes started on this node. Def.: 0, workers are started with metabgc worker.")
+@click.option('--slurm_options', required=False,
+              help="With the slurm backend, extra sbatch options of the worker job array, e.g. \"--partition=short --time=10:00:00\".")
 @click.option('--cpu', required=False,
               type=click.INT,default=4,
               help="Number of threads. Def.: 4")
 def search(sphmm_directory,prot_family_name,cohort_name,
             nucl_seq_directory,prot_seq_directory,seq_fmt,pair_fmt,
             r1_file_suffix,r2_file_suffix,max_dist,min_samples,min_reads_bin,min_abund_bin,
-            hmm_search_directory, blastn_search_directory, blast_db_directory_map_file, output_directory,cpu):
+            hmm_search_directory, blastn_search_directory, blast_db_directory_map_file, single_pass,
+            stream_translation, keep_prot_seq, prefilter, prefilter_report, inverted_blast, recruit_method, output_directory,intermediate_format,
+            cache_directory,blast_db_registry,backend,queue_directory,local_workers,slurm_options,cpu):
+    SetIntermediateFormat(intermediate_format)
+    SetCacheDirectory(cache_directory)
+    SetBlastDBRegistry(blast_db_registry)
+    SetExecutionBackend(backend, queue_directory, local_workers, slurm_options)
     logging.basicConfig(filename=os.path.join(output_directory,'metabgc.log'), level=logging.INFO)
     logging.info('Invoking MetaBGC search...')
     click.echo('Invoking MetaBGC search...')
     t0 = time()
-    ident_reads_file = mbgcidentify(sphmm_directory, cohort_name, nucl_seq_directory,prot_seq_directory,
-                                    seq_fmt, pair_fmt, r1_file_suffix, r2_file_suffix,
-                                    prot_family_name, hmm_search_directory, output_directory, cpu)
+    # Each stage is recorded in the run manifest; rerunning search in the same output
+    # directory resumes at the first stage that has not completed with the same inputs.
+    # The sample, spHMM and search files are keyed on their signatures, so samples that are
+    # added or replaced rerun the stages reading them.
+    identify_params = {"sphmm_directory": DirectorySignature(sphmm_directory), "cohort_name": cohort_name,
+                       "nucl_seq_directory": DirectorySignature(nucl_seq_directory),
+                       "prot_seq_directory": DirectorySignature(prot_seq_directory), "seq_fmt": seq_fmt,
+                       "pair_fmt": pair_fmt, "r1_file_suffix": r1_file_suffix, "r2_file_suffix": r2_file_suffix,
+                       "prot_family_name": prot_family_name, "hmm_search_directory": DirectorySignature(hmm_search_directory),
+                       "single_pass": single_pass, "stream_translation": stream_translation,
+                       "prefilter": prefilter, "intermediate_format": intermediate_format}
+    ident_reads_file = RunStage(output_directory, "identify", identify_params, ["ident_reads_file"],
+                                mbgcidentify, sphmm_directory, cohort_name, nucl_seq_directory, prot_seq_directory,
+                                seq_fmt, pair_fmt, r1_file_suffix, r2_file_suffix,
+                                prot_family_name, hmm_search_directory, output_directory, cpu, single_pass,
+                                stream_translation, keep_prot_seq, prefilter, prefilter_report)
 
-    abund_file, abund_wide_table = mbgcquantify(ident_reads_file, prot_family_name, cohort_name, nucl_seq_directory,
-             seq_fmt, pair_fmt, r1_file_suffix, r2_file_suffix,blast_db_directory_map_file,blastn_search_directory,
-             output_directory, cpu)
+    quantify_params = {"ident_reads_file": FileSignature(ident_reads_file), "nucl_seq_directory": DirectorySignature(nucl_seq_directory),
+                       "seq_fmt": seq_fmt, "pair_fmt": pair_fmt, "r1_file_suffix": r1_file_suffix,
+                       "r2_file_suffix": r2_file_suffix, "blast_db_directory_map_file": blast_db_directory_map_file,
+                       "blastn_search_directory": DirectorySignature(blastn_search_directory), "inverted_blast": inverted_blast,
+                       "recruit_method": recruit_method, "intermediate_format": intermediate_format}
+    abund_file, abund_wide_table = RunStage(output_directory, "quantify", quantify_params, ["abund_file", "abund_wide_table"],
+                                            mbgcquantify, ident_reads_file, prot_family_name, cohort_name, nucl_seq_directory,
+                                            seq_fmt, pair_fmt, r1_file_suffix, r2_file_suffix, blast_db_directory_map_file,
+                                            blastn_search_directory, output_directory, cpu, inverted_blast,
+                                            recruit_method)
 
-    summary_file, cluster_file = mbgccluster(abund_file,abund_wide_table, ident_reads_file, max_dist, min_samples,min_reads_bin, min_abund_bin, cpu)
+    cluster_params = {"abund_file": FileSignature(abund_file), "abund_wide_table": FileSignature(abund_wide_table),
+                      "ident_reads_file": FileSignature(ident_reads_file), "max_dist": max_dist,
+                      "min_samples": min_samples, "min_reads_bin": min_reads_bin, "min_abund_bin": min_abund_bin}
+    summary_file, cluster_file = RunStage(output_directory, "cluster", cluster_params, ["summary_file", "cluster_file"],
+                                          mbgccluster, abund_file, abund_wide_table, ident_reads_file, max_dist,
+                                          min_samples, min_reads_bin, min_abund_bin, cpu)
     click.echo('Cluster summary file: ' + summary_file)
     click.echo('Cluster detail file: ' + cluster_file)
     logging.info('Cluster summary file: ' + summary_file)
@@ -322,5 +482,35 @@ def synthesize(indir1, indir2, system, length, mflen, mflensd, num_reads,
 def findtp(aln_file, prot_seq_directory, output_directory, do_alignment):
     mbgcfindtp(aln_file, prot_seq_directory, output_directory, do_alignment)
 
+@cli.command()
+@click.option('--table', required=True,
+              type=click.Path(exists=True,dir_okay=True,readable=True),
+              help="Parquet table written with --intermediate_format parquet, or a CombinedHmmSearch hit store directory.")
+@click.option('--output_file', required=True,
+              type=click.Path(dir_okay=False,writable=True),
+              help="Path of the exported tab-delimited table.")
+@click.option('--no_header', is_flag=True, default=False,
+              help="Do not write the column names, as in the TSV hit tables.")
+def export_table(table, output_file, no_header):
+    if os.path.isdir(table):
+        ReadHitTable(table).to_csv(output_file, index=False, sep='\t', header=not no_header)
+    else:
+        ExportTSV(table, output_file, not no_header)
+    click.echo('Exported table: ' + output_file)
+
+@cli.command()
+@click.option('--queue_directory', required=True,
+              type=click.Path(exists=True,dir_okay=True,writable=True),
+              help="Work queue directory given to identify, quantify or search with the queue or slurm backend.")
+@click.option('--batch', required=False,
+              help="Only run the tasks of this batch of the queue. All the pending tasks are run if not provided.")
+def worker(queue_directory, batch):
+    logging.basicConfig(level=logging.INFO)
+    task_ctr = RunWorker(queue_directory, batch)
+    click.echo('Worker ran ' + str(task_ctr) + ' tasks.')
+
 def main():
     cli()
+
+if __name__ == '__main__':
+    main()
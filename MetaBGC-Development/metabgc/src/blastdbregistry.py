@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import fcntl
+import logging
+import os
+import shutil
+import socket
+import subprocess
+from metabgc.src.producer_consumer import Task, invoke_producer_consumer
+from metabgc.src.resultcache import CACHE_DIR_ENV, InputContentHash, UserCacheDirectory
+from metabgc.src.seqreader import CompressionExt, DecompressShellCmd, SeqFileStem
+from metabgc.src.pipelinestate import AtomicWriteText
+
+"""
+Registry of the BLAST databases of the sample reads, shared by build and quantify across
+runs and protein families, so the database of a sample is built once. A database is keyed
+by the SHA-256 of the sample content and saved under db/<key[:2]>/<key>/. The content hash
+of a sample path is memoized on its size and mtime with those of the result cache, so a
+known sample is found without reading it. Builds take an exclusive flock on the lock file of the key, build
+into a temporary directory and rename it into place, so concurrent runs and workers never
+build the same database twice or see a partial one. The registry is METABGC_BLASTDB_DIR,
+else the blastdb directory of the result cache, else metabgc/blastdb in the user cache
+directory (XDG_CACHE_HOME, ~/.cache by default), so the runs of a user share it.
+"""
+
+BLASTDB_REGISTRY_ENV = "METABGC_BLASTDB_DIR"
+BLASTDB_NAME = "reads"
+BLASTDB_DONE = "COMPLETE"
+
+"""
+Function sets the BLAST database registry for this process and its workers.
+"""
+def SetBlastDBRegistry(registryDir):
+    if registryDir:
+        os.makedirs(registryDir, 0o777, True)
+        os.environ[BLASTDB_REGISTRY_ENV] = os.path.abspath(registryDir)
+
+"""
+Function returns the BLAST database registry of the run.
+"""
+def BlastDBRegistry():
+    if os.environ.get(BLASTDB_REGISTRY_ENV):
+        return os.environ[BLASTDB_REGISTRY_ENV]
+    if os.environ.get(CACHE_DIR_ENV):
+        return os.path.join(os.environ[CACHE_DIR_ENV], "blastdb")
+    return os.path.join(UserCacheDirectory(), "blastdb")
+
+def _DBDir(registryDir, contentHash):
+    return os.path.join(registryDir, "db", contentHash[:2], contentHash)
+
+"""
+Function returns the path of the database of a content hash, None if it is not built.
+"""
+def RegisteredDBPath(registryDir, contentHash):
+    dbDir = _DBDir(registryDir, contentHash)
+    if os.path.exists(os.path.join(dbDir, BLASTDB_DONE)):
+        return os.path.join(dbDir, BLASTDB_NAME)
+    return None
+
+"""
+Function builds the database of a sample into the registry, unless it is built, under the
+lock of its content hash. Returns the exit status of makeblastdb.
+"""
+def BuildRegisteredDB(registryDir, sampleFile, contentHash):
+    lockDir = os.path.join(registryDir, "locks")
+    os.makedirs(lockDir, 0o777, True)
+    with open(os.path.join(lockDir, contentHash + ".lock"), 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            if RegisteredDBPath(registryDir, contentHash):
+                logging.info("Found registered BLAST DB for:" + sampleFile)
+                return 0
+            dbDir = _DBDir(registryDir, contentHash)
+            tmpDir = dbDir + ".tmp." + socket.gethostname() + "." + str(os.getpid())
+            if os.path.exists(tmpDir):
+                shutil.rmtree(tmpDir)
+            os.makedirs(tmpDir, 0o777, True)
+            dbName = SeqFileStem(os.path.basename(sampleFile))
+            dbOut = os.path.join(tmpDir, BLASTDB_NAME)
+            if CompressionExt(sampleFile):
+                cmd = DecompressShellCmd(sampleFile) + " | makeblastdb -in - -title " + dbName + " -dbtype nucl -out " + dbOut
+            else:
+                cmd = "makeblastdb -in " + sampleFile + " -title " + dbName + " -dbtype nucl -out " + dbOut
+            logging.info(cmd)
+            status = subprocess.call(cmd, shell=True)
+            if status != 0:
+                shutil.rmtree(tmpDir)
+                return status
+            AtomicWriteText(os.path.join(tmpDir, BLASTDB_DONE), sampleFile + "\n")
+            os.rename(tmpDir, dbDir)
+            return 0
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+"""
+Function returns the registered database of a sample, building it if needed.
+"""
+def RegisteredBlastDB(registryDir, sampleFile):
+    contentHash = InputContentHash(sampleFile)
+    if not RegisteredDBPath(registryDir, contentHash):
+        BuildRegisteredDB(registryDir, sampleFile, contentHash)
+    return RegisteredDBPath(registryDir, contentHash)
+
+"""
+Function returns the {sample file: database path} dict of the samples, building the
+missing databases in parallel. Samples whose database could not be built are left out.
+"""
+def RegisterBlastDBs(registryDir, sampleFileList, ncpus=4):
+    hashDict = {sampleFile: InputContentHash(sampleFile) for sampleFile in sampleFileList}
+    makeDBTaskList = []
+    for sampleFile, contentHash in hashDict.items():
+        if RegisteredDBPath(registryDir, contentHash):
+            logging.info("Found registered BLAST DB for:" + sampleFile)
+        elif contentHash not in [task.args[2] for task in makeDBTaskList]:
+            logging.info("Constructing BLAST DB for:" + sampleFile)
+            makeDBTaskList.append(Task("makeblastdb", sampleFile, BuildRegisteredDB, registryDir, sampleFile, contentHash))
+    if makeDBTaskList:
+        invoke_producer_consumer(makeDBTaskList, ncpus)
+    dbDict = {}
+    for sampleFile, contentHash in hashDict.items():
+        dbPath = RegisteredDBPath(registryDir, contentHash)
+        if dbPath:
+            dbDict[sampleFile] = dbPath
+        else:
+            logging.info("Failed to construct BLAST DB for:" + sampleFile)
+    return dbDict
@@ -1,8 +1,13 @@
 from metabgc.src.producer_consumer import *
+from metabgc.src.seqreader import SeqFileRegex, SeqFileStem, CompressionExt, DecompressShellCmd
+from metabgc.src.resultcache import RunCachedTask
+from metabgc.src.pipelinestate import TmpPath
+from metabgc.src.blastdbregistry import BlastDBRegistry, RegisteredBlastDB
 import os
 import re
 import csv
 import logging
+import subprocess
 
 """
 Function to run make BLAST db and search FASTA files. 
@@ -13,7 +18,7 @@ def BLASTN(blastdb, searchFileList,
     for i, queryFile in enumerate(searchFileList):
         outFile = outFileList[i]
         cmd = blastCmdString + " -num_threads 1 -query " + queryFile + " -db " + blastdb + " " + blastParamStr + " -out " + outFile
-        blastCmdList.append(cmd)
+        blastCmdList.append(ShellTask("blastn", cmd))
         logging.info(cmd)
 
     invoke_producer_consumer(blastCmdList, ncpus)
@@ -21,49 +26,50 @@ def BLASTN(blastdb, searchFileList,
 
 
 """
-Function to run make BLAST db and search FASTA files. 
+Function returns True if the path is a BLAST database, given by its name or one of its files.
 """
-def MakeDB_BLASTN(dbFileList, existing_map_dict, dbOpPath, searchFileList, blastCmdString, blastParamStr, outFileList, ncpus):
-    dbOutDict = {}
-    makeDBCmdList=[]
-    blastCmdList = []
-    for dbInputFile in dbFileList:
-        sample_basename = os.path.basename(dbInputFile)
-        dbOut = ""
-        if sample_basename in existing_map_dict:
-            dbOut = existing_map_dict[sample_basename]
-            dbOutDict[dbInputFile] = dbOut
-            logging.info("Found existing database path:" + dbOut)
-
-        if not os.path.isfile(dbOut):
-            logging.info("Constructing BLAST DB for:" + dbInputFile)
-            makeDBOpPath = dbOpPath + os.sep + sample_basename
-            os.makedirs(makeDBOpPath, 0o777, True)
-            dbName = os.path.splitext(sample_basename)[0]
-            dbOut = makeDBOpPath + os.sep + dbName
-            cmd = "makeblastdb -in " + dbInputFile + " -title " + dbName + " -dbtype nucl -out " + dbOut
-            dbOutDict[dbInputFile] = dbOut
-            makeDBCmdList.append(cmd)
-            logging.info(cmd)
-    if makeDBCmdList:
-        invoke_producer_consumer(makeDBCmdList, ncpus - 1)
-    logging.info("Done creating BLAST databases if any were needed.")
+def IsBlastDB(dbPath):
+    return os.path.isfile(dbPath) or any(os.path.exists(dbPath + ext) for ext in (".nin", ".nal"))
 
+"""
+Function searches queryFile against the database of a sample, the database of the mapping
+file if it exists, else the registered one, built if needed. The output is written to the
+temporary path of outFile. Returns the exit status of blastn, 1 if the database could not
+be built.
+"""
+def runMakeDBBlastNTask(dbInputFile, existingDb, queryFile, blastCmdString, blastParamStr, outFile):
+    if existingDb and IsBlastDB(existingDb):
+        dbOut = existingDb
+        logging.info("Found existing database path:" + dbOut)
+    else:
+        dbOut = RegisteredBlastDB(BlastDBRegistry(), dbInputFile)
+        if dbOut is None:
+            logging.info("Could not construct the BLAST database of: " + dbInputFile)
+            return 1
+    cmd = blastCmdString + " -num_threads 1 " + \
+          " -query " + queryFile + " -db " + dbOut + " " + blastParamStr + " -out " + TmpPath(outFile)
+    logging.info(cmd)
+    return subprocess.call(cmd, shell=True)
+
+"""
+Function to run make BLAST db and search FASTA files. Each sample is one task, which looks
+up its result in the result cache and only then finds or builds its BLAST database, so the
+samples are hashed and indexed by the workers. The databases of the mapping file are used
+as given, the others come from the BLAST database registry.
+"""
+def MakeDB_BLASTN(dbFileList, existing_map_dict, dbOpPath, searchFileList, blastCmdString, blastParamStr, outFileList, ncpus):
+    blast_task_list = []
     for i, dbInputFile in enumerate(dbFileList):
-        fastaFile = searchFileList[i]
-        dbOut = dbOutDict[dbInputFile]
-        outFile = outFileList[i]
-        if os.path.exists(outFile):
-            print("Metabgc-quantify is using the existing BLASTN hits : " + outFile)
-        else:
-            cmd = blastCmdString + " -num_threads 1 " + \
-                  " -query " + fastaFile + " -db " + dbOut + " " + blastParamStr + " -out " + outFile
-            blastCmdList.append(cmd)
-            logging.info(cmd)
-    if blastCmdList:
-        print("Invoking BLAST producer-consumer with " + str(len(blastCmdList)) + " processes.")
+        existingDb = existing_map_dict.get(os.path.basename(dbInputFile))
+        keyArgs = (blastCmdString, [dbInputFile], [searchFileList[i]], blastParamStr)
+        # Results are written to a temporary file, so an interrupted search leaves no partial result
+        blast_task_list.append(Task("blastn", dbInputFile, RunCachedTask, outFileList[i], keyArgs, runMakeDBBlastNTask,
+                                    dbInputFile, existingDb, searchFileList[i], blastCmdString, blastParamStr,
+                                    outFileList[i]))
+    if blast_task_list:
+        print("Invoking BLAST producer-consumer with " + str(len(blast_task_list)) + " processes.")
         print("# of CPUs:" + str(ncpus))
-        invoke_producer_consumer(blastCmdList, ncpus - 1)
+        checkResults(invoke_producer_consumer(blast_task_list, ncpus - 1), "BLAST search")
     logging.info("Done running BLAST searches.")
 
 """
@@ -85,8 +91,8 @@ def RunPCMakeDBandBlastN(dbDir, existingDbDirMapFile, queryFile, blastCmdString,
     for subdir, dirs, files in os.walk(dbDir):
         for file in files:
             filePath = os.path.join(subdir, file)
-            if re.match(r".*\.fasta$", file) and os.path.getsize(filePath) > 0:
-                sampleStr = os.path.splitext(file)[0]
+            if re.match(SeqFileRegex("fasta"), file) and os.path.getsize(filePath) > 0:
+                sampleStr = SeqFileStem(file)
                 outputFileName = sampleStr + ".txt"
                 outputFilePath = os.path.join(ouputDir, outputFileName)
                 dbFileList.append(filePath)
@@ -97,6 +103,73 @@ def RunPCMakeDBandBlastN(dbDir, existingDbDirMapFile, queryFile, blastCmdString,
     MakeDB_BLASTN(dbFileList,existing_map_dict,
                   ouputDir, searchFileList, blastCmdString, blastParamStr, outFileList,ncpus)
 
+"""
+Tabular format of the inverted search, with the read of the sample as query and the
+identified read as subject. The columns are swapped so the sample read comes first, as in
+the output of RunPCMakeDBandBlastN where the sample reads are the database.
+"""
+INVERTED_BLAST_OUTFMT = "-outfmt \"6 qseqid qlen qstart qend sseqid slen sstart send pident evalue\""
+
+"""
+Function keeps the HSPs of an inverted search covering at least minCoverage percent of the
+identified read, the subject of the search. This is the -qcov_hsp_perc filter of the search
+against the sample databases, which blastn does not provide for the subject.
+"""
+def FilterSubjectCoverage(blastFile, filteredFile, minCoverage):
+    with open(blastFile) as infile, open(filteredFile, 'w') as outfile:
+        for line in infile:
+            cols = line.split("\t")
+            if 100.0 * (abs(int(cols[7]) - int(cols[6])) + 1) >= minCoverage * int(cols[5]):
+                outfile.write(line)
+
+"""
+Function runs the inverted search of a read file, streamed as the query, against the BLAST
+database of the identified reads. The output is written to the temporary path of outFile.
+"""
+def runInvertedBlastNTask(readFile, blastdb, blastCmdString, blastParamStr, minCoverage, outFile, threads=1):
+    tmpFile = TmpPath(outFile)
+    cmd = blastCmdString + " -num_threads " + str(threads) + " -query - -db " + blastdb + " " + \
+          blastParamStr + " " + INVERTED_BLAST_OUTFMT + " -out " + tmpFile + ".raw"
+    if CompressionExt(readFile):
+        cmd = DecompressShellCmd(readFile) + " | " + cmd
+    else:
+        cmd = cmd + " < " + readFile
+    logging.info(cmd)
+    status = subprocess.call(cmd, shell=True)
+    if status == 0:
+        FilterSubjectCoverage(tmpFile + ".raw", tmpFile, minCoverage)
+    if os.path.exists(tmpFile + ".raw"):
+        os.remove(tmpFile + ".raw")
+    return status
+
+"""
+Function to search the read files in readDir against one BLAST database built from
+queryFile, the inverse of RunPCMakeDBandBlastN: no database is built for the samples, and
+each sample is read once as the query of a multi-threaded search. The database of
+queryFile is taken from the BLAST database registry, so it is only built for new reads.
+The output has the columns of RunPCMakeDBandBlastN. The HSPs are filtered on their
+coverage of the reads of queryFile.
+"""
+def RunPCInvertedBlastN(readDir, queryFile, blastCmdString, blastParamStr, minCoverage, ouputDir, ncpus=4):
+    blastdb = RegisteredBlastDB(BlastDBRegistry(), queryFile)
+    if blastdb is None:
+        raise RuntimeError("makeblastdb failed for: " + queryFile)
+
+    blast_task_list = []
+    for subdir, dirs, files in os.walk(readDir):
+        for file in files:
+            filePath = os.path.join(subdir, file)
+            if re.match(SeqFileRegex("fasta"), file) and os.path.getsize(filePath) > 0:
+                outFile = os.path.join(ouputDir, SeqFileStem(file) + ".txt")
+                keyArgs = (blastCmdString, [filePath], [queryFile], "inverted " + blastParamStr + " " + str(minCoverage))
+                blast_task_list.append(ThreadedTask("blastn", filePath, os.path.getsize(filePath), RunCachedTask,
+                                                    outFile, keyArgs, runInvertedBlastNTask, filePath, blastdb,
+                                                    blastCmdString, blastParamStr, minCoverage, outFile))
+    logging.info("Created inverted search list. # of BLAST searches:" + str(len(blast_task_list)))
+    if blast_task_list:
+        checkResults(invoke_adaptive_scheduler(blast_task_list, ncpus), "Inverted BLAST search")
+    logging.info("Done running BLAST searches.")
+
 """
 Function to search a bunch of blast queries against the database provided. 
 """
@@ -11,6 +11,7 @@ from Bio.Align import MultipleSeqAlignment
 import os 
 import subprocess
 from metabgc.src.hmmrecord import HMMFile
+from metabgc.src.producer_consumer import Task, invoke_producer_consumer, checkResults
 
 """
 Script takes in an alignment file (fasta format), kmer len, and sliding window len. The script 
@@ -28,15 +29,24 @@ def runHMMBuild(alnFile, modelName):
     hmmFile = alnFile.split('.fas')[0] +".hmm"
     cmd = "hmmbuild -n " + modelName + " --amino "+ hmmFile + " "+ alnFile 
     print(cmd) 
-    subprocess.call(cmd, shell=True)
+    status = subprocess.call(cmd, shell=True)
     print("Done Running HMM Build on:",alnFile)
-    return hmmFile
+    return hmmFile, status
+
+"""
+Function writes the alignment of a window and builds its HMM profile. Returns the
+hmmbuild exit status, as a scheduler task.
+"""
+def buildWindowHMM(spHMMAlign, alnFile, modelName):
+    AlignIO.write(spHMMAlign, alnFile, "fasta")
+    return runHMMBuild(alnFile, modelName)[1]
 
 """
 Function parses alignment file into kmer parts of the alignment file,
-with a sliding window method. 
+with a sliding window method. The HMM profiles of the windows are built
+on cpu processes.
 """
-def getKmers(k, interval, outdir, msaFile, tp_prot_file, modelName, start, end, gene_pos_file,gene_pos_file_aa):
+def getKmers(k, interval, outdir, msaFile, tp_prot_file, modelName, start, end, gene_pos_file,gene_pos_file_aa,cpu=1):
     pprot_TP_dict = {}
     for record in SeqIO.parse(tp_prot_file, "fasta"):
         pprot_TP_dict[record.id] = str(record.seq)
@@ -68,6 +78,7 @@ def getKmers(k, interval, outdir, msaFile, tp_prot_file, modelName, start, end,
     gene_pos_out_aa.write("gene_name\tstart\tend\tinterval\tprot_type\n")
     gene_pos_out = open(gene_pos_file, 'w')
     gene_pos_out.write("gene_name\tstart\tend\tinterval\tprot_type\n")
+    buildTaskList = []
     for i in range(counter):
         startPos = j 
         endPos = j+k
@@ -93,8 +104,8 @@ def getKmers(k, interval, outdir, msaFile, tp_prot_file, modelName, start, end,
                                       "\t" + modelName + "\n")
 
                 outputFile = outdir + os.sep +modelName + "__" + str(k)+ "_"+ str(interval) + "__"+ str(i*interval)+ "_"+ str(i*interval+k) + ".fas"
-                AlignIO.write(spHMMAlign, outputFile, "fasta")
-                hmmFile = runHMMBuild(outputFile, modelName)
+                buildTaskList.append(Task("hmmbuild", outputFile, buildWindowHMM, spHMMAlign, outputFile, modelName))
+                hmmFile = outputFile.split('.fas')[0] +".hmm"
                 hmmSegment = str(startPos)+ "_"+ str(endPos)
                 hmmDict[hmmSegment] = HMMFile(i*interval,i*interval+k,hmmFile)
 
@@ -103,8 +114,12 @@ def getKmers(k, interval, outdir, msaFile, tp_prot_file, modelName, start, end,
             break
     gene_pos_out_aa.close()
     gene_pos_out.close()
+
+    # The windows are built in parallel, hmmDict and the gene position files are in window order.
+    # A window without its profile would be dropped from the search, so any failed build raises.
+    checkResults(invoke_producer_consumer(buildTaskList, cpu), "hmmbuild of the spHMM windows")
     return hmmDict
 
-def GenerateSpHMM(aln_file, tp_prot_file, window_len, kmer_len, outdir, hmmName, start, end,gene_pos_file,gene_pos_file_aa):
-    return getKmers(kmer_len, window_len, outdir, aln_file, tp_prot_file, hmmName, start, end,gene_pos_file,gene_pos_file_aa)
+def GenerateSpHMM(aln_file, tp_prot_file, window_len, kmer_len, outdir, hmmName, start, end,gene_pos_file,gene_pos_file_aa,cpu=1):
+    return getKmers(kmer_len, window_len, outdir, aln_file, tp_prot_file, hmmName, start, end,gene_pos_file,gene_pos_file_aa,cpu)
 
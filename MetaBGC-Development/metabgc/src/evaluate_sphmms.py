@@ -6,6 +6,7 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import sys
+from metabgc.src.hitstore import ReadHitTable
 
 
 def getOverlap(row, b):
@@ -157,8 +158,7 @@ def evaluate_sphmms(HMMRunFile,
 
     ### Load segmented profiled HMMs for synthetic genomes
     #load HMM data and recode sampleType for the complexity of the synthetic sample (#of genomes in samples)
-    hmm_df = pd.read_csv(HMMRunFile, delimiter="\t", header=None)
-    hmm_df.columns=["readID", "sampleType", "sampleID", "protType", "HMMScore", "window","interval"]
+    hmm_df = ReadHitTable(HMMRunFile, ["readID", "sampleType", "sampleID", "protType", "HMMScore", "window","interval"])
     #Keep duplicated reads if they are in different reads
     hmm_df_recoded = formatHMM(hmm_df)
 
@@ -277,6 +277,10 @@ def evaluate_sphmms(HMMRunFile,
         spHMMFileName = HMM_Model_Name + "__30_10__" + spHMMInterval + ".hmm" # Not an error, but the __30_10__ shouldn't be hardcoded. I might want to check different read lengths with different intervals and overlaps, so that would lead to misleading filenames.
         try:
             shutil.copy(os.path.join(HMMOutDir,spHMMFileName), HMMHighPerfOutDir)
+            # Seed alignment of the spHMM, used by the identify prefilter
+            seedAlnFile = os.path.join(HMMOutDir, os.path.splitext(spHMMFileName)[0] + ".fas")
+            if os.path.exists(seedAlnFile):
+                shutil.copy(seedAlnFile, HMMHighPerfOutDir)
         except IOError as e:
             print("Unable to copy file. %s" % e)
         except:
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import json
+import logging
+import os
+import pickle
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing import Process
+from metabgc.src.pipelinestate import AtomicWriteText
+
+"""
+Execution backends of the hmmsearch, blastn and makeblastdb tasks. The local backend runs
+them on the consumer processes of this node. The queue and slurm backends write each task
+to a batch of a file-based work queue on a shared filesystem, which any number of
+"metabgc worker" processes pull from: a worker claims a task by renaming it into the
+running directory and writes its result as a JSON file. The queue backend can start local
+workers as a stand-in for a cluster, and the slurm backend submits a job array of workers.
+The submitting process waits for the results of the batch. While a task runs, its worker
+touches the claimed file every HEARTBEAT_INTERVAL seconds; a claim not touched for
+LEASE_TIMEOUT seconds is from a worker that was killed or preempted, and the submitting
+process puts it back in the queue, up to MAX_TASK_REQUEUES times.
+"""
+
+BACKEND_ENV = "METABGC_BACKEND"
+QUEUE_DIR_ENV = "METABGC_QUEUE_DIR"
+LOCAL_WORKERS_ENV = "METABGC_LOCAL_WORKERS"
+SLURM_OPTIONS_ENV = "METABGC_SLURM_OPTIONS"
+EXECUTION_BACKENDS = ["local", "queue", "slurm"]
+QUEUED_TASK_TYPES = ["hmmsearch", "blastn", "makeblastdb"]
+
+TASK_DIR = "tasks"
+RUNNING_DIR = "running"
+RESULT_DIR = "results"
+LOG_DIR = "logs"
+BATCH_ENV_FILE = "env.json"
+BATCH_TASKS_FILE = "tasks.json"
+BATCH_READY_FILE = "READY"
+SLURM_SCRIPT_FILE = "workers.sbatch"
+POLL_INTERVAL = 5
+HEARTBEAT_INTERVAL = 60
+LEASE_TIMEOUT = 600
+MAX_TASK_REQUEUES = 2
+
+_batchCtr = 0
+
+"""
+Function sets the execution backend for this process and its workers. The queue and slurm
+backends need a queue directory on a filesystem shared with the workers.
+"""
+def SetExecutionBackend(backend, queueDir=None, localWorkers=0, slurmOptions=None):
+    if not backend:
+        return
+    backend = backend.lower()
+    if backend not in EXECUTION_BACKENDS:
+        raise ValueError("Unknown execution backend: " + backend)
+    if backend != "local":
+        if not queueDir:
+            raise ValueError("The " + backend + " backend needs a queue directory.")
+        os.makedirs(queueDir, 0o777, True)
+        os.environ[QUEUE_DIR_ENV] = os.path.abspath(queueDir)
+    os.environ[BACKEND_ENV] = backend
+    os.environ[LOCAL_WORKERS_ENV] = str(localWorkers or 0)
+    if slurmOptions:
+        os.environ[SLURM_OPTIONS_ENV] = slurmOptions
+
+"""
+Function returns the execution backend of the run.
+"""
+def ExecutionBackend():
+    return os.environ.get(BACKEND_ENV) or "local"
+
+"""
+Function returns True if the task is run on the queue of the execution backend.
+"""
+def IsQueuedTask(task):
+    return ExecutionBackend() != "local" and task.taskType in QUEUED_TASK_TYPES
+
+def _TaskFileName(index):
+    return "{:06d}.pkl".format(index)
+
+"""
+Function writes the tasks to a new batch of the queue and returns the batch directory.
+Threaded tasks are run with the given number of threads. The environment of the run
+(cache directory, intermediate format) and the working directory are saved with the
+batch so the workers run the tasks in the same setting.
+"""
+def SubmitBatch(queueDir, task_list, threads=1):
+    global _batchCtr
+    _batchCtr = _batchCtr + 1
+    batchID = "{}.{}.{}.{}".format(time.strftime("%Y%m%d%H%M%S"), socket.gethostname(), os.getpid(), _batchCtr)
+    batchDir = os.path.join(queueDir, batchID)
+    for subDir in [TASK_DIR, RUNNING_DIR, RESULT_DIR, LOG_DIR]:
+        os.makedirs(os.path.join(batchDir, subDir), 0o777, True)
+    env_dict = {key: value for key, value in os.environ.items() if key.startswith("METABGC_")}
+    AtomicWriteText(os.path.join(batchDir, BATCH_ENV_FILE), json.dumps({"cwd": os.getcwd(), "env": env_dict}))
+    AtomicWriteText(os.path.join(batchDir, BATCH_TASKS_FILE),
+                    json.dumps([[task.taskType, task.name] for task in task_list]))
+    for index, task in enumerate(task_list):
+        task.threads = threads if task.threaded else 1
+        taskFile = os.path.join(batchDir, TASK_DIR, _TaskFileName(index))
+        with open(taskFile + ".tmp", 'wb') as outfile:
+            pickle.dump(task, outfile)
+        os.replace(taskFile + ".tmp", taskFile)
+    AtomicWriteText(os.path.join(batchDir, BATCH_READY_FILE), str(len(task_list)))
+    logging.info('Submitted {} tasks to batch {}.'.format(len(task_list), batchDir))
+    return batchDir
+
+"""
+Function claims the next pending task of a batch. The rename succeeds for one worker
+only. Returns the path of the claimed task, None if the batch has no pending task.
+"""
+def ClaimTask(batchDir):
+    taskDir = os.path.join(batchDir, TASK_DIR)
+    for taskFile in sorted(os.listdir(taskDir)):
+        if not taskFile.endswith(".pkl"):
+            continue
+        claimedFile = os.path.join(batchDir, RUNNING_DIR, taskFile)
+        try:
+            os.rename(os.path.join(taskDir, taskFile), claimedFile)
+            # The rename keeps the mtime of the submission, the lease starts with the claim
+            os.utime(claimedFile)
+        except FileNotFoundError:
+            continue
+        return claimedFile
+    return None
+
+def _Heartbeat(claimedFile, stopEvent, interval):
+    while not stopEvent.wait(interval):
+        try:
+            os.utime(claimedFile)
+        except FileNotFoundError:
+            return
+
+"""
+Function runs a claimed task and writes its result. The claimed file is touched every
+HEARTBEAT_INTERVAL seconds while the task runs to renew its lease.
+"""
+def RunClaimedTask(batchDir, claimedFile):
+    with open(claimedFile, 'rb') as infile:
+        task = pickle.load(infile)
+    logging.info('{} got {} task: {}'.format(os.getpid(), task.taskType, task.name))
+    stopEvent = threading.Event()
+    heartbeat = threading.Thread(target=_Heartbeat, args=(claimedFile, stopEvent, HEARTBEAT_INTERVAL), daemon=True)
+    heartbeat.start()
+    t0 = time.time()
+    try:
+        status = task.run()
+    except Exception as e:
+        logging.info("Failed to execute " + task.taskType + " task " + task.name + ": " + str(e))
+        status = -1
+    finally:
+        stopEvent.set()
+        heartbeat.join()
+    result_dict = {"taskType": task.taskType, "name": task.name, "status": status,
+                   "wallTime": time.time() - t0, "pid": os.getpid(),
+                   "host": socket.gethostname(), "threads": task.threads}
+    resultFile = os.path.join(batchDir, RESULT_DIR, os.path.basename(claimedFile)[:-len(".pkl")] + ".json")
+    AtomicWriteText(resultFile, json.dumps(result_dict))
+    try:
+        os.remove(claimedFile)
+    except FileNotFoundError:
+        # The lease expired and the task was put back in the queue
+        pass
+    return status
+
+def _ReadyBatches(queueDir):
+    return [os.path.join(queueDir, batchID) for batchID in sorted(os.listdir(queueDir))
+            if os.path.exists(os.path.join(queueDir, batchID, BATCH_READY_FILE))]
+
+"""
+Function runs the pending tasks of the queue, or of one batch of it, until none are left.
+Returns the number of tasks run.
+"""
+def RunWorker(queueDir, batchID=None):
+    batchList = [os.path.join(queueDir, batchID)] if batchID else _ReadyBatches(queueDir)
+    taskCtr = 0
+    for batchDir in batchList:
+        with open(os.path.join(batchDir, BATCH_ENV_FILE)) as infile:
+            batch_env = json.load(infile)
+        os.environ.update(batch_env["env"])
+        os.chdir(batch_env["cwd"])
+        claimedFile = ClaimTask(batchDir)
+        while claimedFile:
+            RunClaimedTask(batchDir, claimedFile)
+            taskCtr = taskCtr + 1
+            claimedFile = ClaimTask(batchDir)
+    logging.info('Worker {} ran {} tasks.'.format(os.getpid(), taskCtr))
+    return taskCtr
+
+"""
+Function writes the SLURM script of a job array of workers of a batch, one array job per
+task, each with the given number of cores. Extra sbatch options (e.g. "--partition=x
+--time=10:00:00") are added to the header. Returns the path of the script.
+"""
+def WriteSlurmArray(batchDir, taskCtr, threads=1, slurmOptions=None):
+    batchDir = os.path.abspath(batchDir)
+    queueDir, batchID = os.path.split(batchDir)
+    lines = ["#!/bin/bash",
+             "#SBATCH --job-name=metabgc-worker",
+             "#SBATCH --array=0-{}".format(max(taskCtr, 1) - 1),
+             "#SBATCH --ntasks=1",
+             "#SBATCH --cpus-per-task={}".format(threads),
+             "#SBATCH --output=" + os.path.join(batchDir, LOG_DIR, "worker_%A_%a.log")]
+    lines = lines + ["#SBATCH " + option for option in shlex.split(slurmOptions or "")]
+    lines.append(" ".join([shlex.quote(sys.executable), "-m", "metabgc.metabgc_cmds", "worker",
+                           "--queue_directory", shlex.quote(queueDir), "--batch", shlex.quote(batchID)]))
+    scriptFile = os.path.join(batchDir, SLURM_SCRIPT_FILE)
+    AtomicWriteText(scriptFile, "\n".join(lines) + "\n")
+    return scriptFile
+
+def _LostResult(taskType, name):
+    return {"taskType": taskType, "name": name, "status": -1, "wallTime": 0, "pid": 0, "host": "", "threads": 1}
+
+"""
+Function puts the claimed tasks of a batch whose lease expired back in the queue, or
+writes a result of exit status -1 for those already requeued maxRequeues times. The
+number of requeues of each task file is kept in requeueDict. Returns the number of tasks
+requeued.
+"""
+def RequeueStaleTasks(batchDir, task_names, requeueDict, leaseTimeout=LEASE_TIMEOUT, maxRequeues=MAX_TASK_REQUEUES):
+    runningDir = os.path.join(batchDir, RUNNING_DIR)
+    requeueCtr = 0
+    for taskFile in sorted(os.listdir(runningDir)):
+        claimedFile = os.path.join(runningDir, taskFile)
+        resultFile = os.path.join(batchDir, RESULT_DIR, taskFile[:-len(".pkl")] + ".json")
+        try:
+            if not taskFile.endswith(".pkl") or os.path.exists(resultFile) or \
+                    time.time() - os.path.getmtime(claimedFile) < leaseTimeout:
+                continue
+            if requeueDict.get(taskFile, 0) < maxRequeues:
+                os.rename(claimedFile, os.path.join(batchDir, TASK_DIR, taskFile))
+                requeueDict[taskFile] = requeueDict.get(taskFile, 0) + 1
+                requeueCtr = requeueCtr + 1
+                logging.info('Lease of task {} of batch {} expired, requeued it.'.format(taskFile, batchDir))
+            else:
+                os.remove(claimedFile)
+                taskType, name = task_names[int(taskFile[:-len(".pkl")])]
+                AtomicWriteText(resultFile, json.dumps(_LostResult(taskType, name)))
+                logging.info('Lease of task {} of batch {} expired {} times, reported it failed.'.format(
+                    taskFile, batchDir, maxRequeues + 1))
+        except FileNotFoundError:
+            # The worker finished the task meanwhile
+            continue
+    return requeueCtr
+
+"""
+Function waits for the results of a batch. When the batch is run by local workers, it
+stops waiting once they have all exited. Claims whose lease expired are requeued with
+RequeueStaleTasks, and onRequeue, if given, is called to start a worker for them. Tasks
+without a result are reported with exit status -1. Returns the list of result dicts.
+"""
+def WaitBatch(batchDir, workers=None, pollInterval=POLL_INTERVAL, leaseTimeout=LEASE_TIMEOUT, onRequeue=None):
+    with open(os.path.join(batchDir, BATCH_TASKS_FILE)) as infile:
+        task_names = json.load(infile)
+    resultDir = os.path.join(batchDir, RESULT_DIR)
+    requeueDict = {}
+    while True:
+        if RequeueStaleTasks(batchDir, task_names, requeueDict, leaseTimeout) > 0 and onRequeue is not None:
+            onRequeue()
+        resultCtr = len([f for f in os.listdir(resultDir) if f.endswith(".json")])
+        if resultCtr >= len(task_names):
+            break
+        if workers is not None and not any(worker.is_alive() for worker in workers):
+            logging.info('Workers of batch {} exited with {} of {} results.'.format(batchDir, resultCtr, len(task_names)))
+            break
+        time.sleep(pollInterval)
+    results = []
+    for index, (taskType, name) in enumerate(task_names):
+        resultFile = os.path.join(resultDir, _TaskFileName(index)[:-len(".pkl")] + ".json")
+        if os.path.exists(resultFile):
+            with open(resultFile) as infile:
+                results.append(json.load(infile))
+        else:
+            results.append(_LostResult(taskType, name))
+    return results
+
+"""
+Function runs the tasks on the queue of the execution backend and returns the list of
+result dicts. The queue backend starts localWorkers worker processes, or waits for
+workers started on other nodes if there are none. The slurm backend submits a job array
+of workers with sbatch.
+"""
+def RunQueuedTasks(task_list, ncpus):
+    backend = ExecutionBackend()
+    queueDir = os.environ[QUEUE_DIR_ENV]
+    localWorkers = int(os.environ.get(LOCAL_WORKERS_ENV) or 0)
+    threads = max(1, ncpus // localWorkers) if backend == "queue" and localWorkers > 0 else max(1, ncpus)
+    batchDir = SubmitBatch(queueDir, task_list, threads)
+    workers = None
+    onRequeue = None
+    if backend == "slurm":
+        def SubmitWorkers(taskCtr):
+            scriptFile = WriteSlurmArray(batchDir, taskCtr, threads, os.environ.get(SLURM_OPTIONS_ENV))
+            if shutil.which("sbatch"):
+                subprocess.call(["sbatch", scriptFile])
+            else:
+                logging.info("sbatch not found, submit " + scriptFile + " to run the batch.")
+        SubmitWorkers(len(task_list))
+        # The array jobs may all be gone when a task is requeued, so one more worker is submitted
+        onRequeue = lambda: SubmitWorkers(1)
+    elif localWorkers > 0:
+        workers = [Process(target=RunWorker, args=(queueDir, os.path.basename(batchDir)))
+                   for i in range(min(localWorkers, len(task_list)))]
+        for worker in workers:
+            worker.start()
+    else:
+        logging.info("Waiting for workers: metabgc worker --queue_directory " + queueDir)
+    results = WaitBatch(batchDir, workers, 1 if workers else POLL_INTERVAL, onRequeue=onRequeue)
+    if workers:
+        for worker in workers:
+            worker.join()
+    return results
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import os
+import socket
+import time
+import pandas as pd
+from metabgc.src.tableio import IntermediateFormat, ReadTable, IterTableChunks, TableRowCount, WriteTable
+
+"""
+Append-only store of the HMM hits of a run, replacing the per-sample hit tables and their
+concatenation into CombinedHmmSearch. The store is a directory with one shard per worker
+process: each search task appends its hits to the shard of its process, so the workers never
+share a file. In TSV the shard is one headerless table per process. In
+Parquet, files cannot be appended to, so each task adds a part file of the process. The
+readers take either a store directory or a single combined table.
+"""
+
+HIT_STORE_COLUMNS = ["readID", "sampleType", "sampleID", "protType", "HMMScore", "window", "interval"]
+HIT_SHARD_PREFIX = "hits."
+HIT_STORE_COMPLETE = "COMPLETE"
+
+"""
+Function creates an empty hit store, removing the shards of a previous incomplete run.
+"""
+def OpenHitStore(storeDir):
+    os.makedirs(storeDir, 0o777, True)
+    for filename in os.listdir(storeDir):
+        if filename.startswith(HIT_SHARD_PREFIX) or filename == HIT_STORE_COMPLETE:
+            os.remove(os.path.join(storeDir, filename))
+    return storeDir
+
+"""
+Function marks the hit store as complete once all the searches are done.
+"""
+def CloseHitStore(storeDir):
+    open(os.path.join(storeDir, HIT_STORE_COMPLETE), 'w').close()
+
+"""
+Function returns True if the hit store holds the hits of a completed search.
+"""
+def IsHitStoreComplete(storeDir):
+    return os.path.exists(os.path.join(storeDir, HIT_STORE_COMPLETE))
+
+"""
+Function returns the shard files of a hit store.
+"""
+def HitStoreShards(storeDir):
+    return sorted(os.path.join(storeDir, f) for f in os.listdir(storeDir)
+                  if f.startswith(HIT_SHARD_PREFIX) and os.path.getsize(os.path.join(storeDir, f)) > 0)
+
+"""
+Function appends the hits of a {read: bit score} dict, sorted by score, to the shard of
+the calling process. Returns the number of hits written.
+"""
+def AppendHits(storeDir, score_dict, sampleType, sampleID, protType, window, interval):
+    if not score_dict:
+        return 0
+    # Workers of the queue backends run on several nodes, so the shard name has the host
+    shardID = socket.gethostname() + "." + str(os.getpid())
+    if IntermediateFormat() == "parquet":
+        hitDF = pd.DataFrame({"readID": list(score_dict.keys()), "sampleType": sampleType, "sampleID": sampleID,
+                              "protType": protType, "HMMScore": list(score_dict.values()), "window": window,
+                              "interval": interval}, columns=HIT_STORE_COLUMNS)
+        hitDF = hitDF.sort_values(by=['HMMScore'], ascending=[False])
+        WriteTable(hitDF, os.path.join(storeDir, HIT_SHARD_PREFIX + shardID + "." + str(time.time_ns()) + ".parquet"))
+    else:
+        suffix = "\t" + "\t".join([str(sampleType), str(sampleID), str(protType)]) + "\t"
+        tail = "\t" + str(window) + "\t" + str(interval) + "\n"
+        lines = [read_name + suffix + repr(bitscore) + tail
+                 for read_name, bitscore in sorted(score_dict.items(), key=lambda item: -item[1])]
+        fd = os.open(os.path.join(storeDir, HIT_SHARD_PREFIX + shardID + ".txt"),
+                     os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        try:
+            # A write can be short (large buffers, full disks, signals), so loop until all is written
+            data = memoryview("".join(lines).encode())
+            while data:
+                written = os.write(fd, data)
+                if written <= 0:
+                    raise OSError("Short write to the hit store shard of " + shardID)
+                data = data[written:]
+        finally:
+            os.close(fd)
+    return len(score_dict)
+
+"""
+Function reads the hits of a store directory or of a combined table in chunks.
+"""
+def IterHitChunks(hitPath, names=None, dtype=None, chunkSize=1000000):
+    fileList = HitStoreShards(hitPath) if os.path.isdir(hitPath) else [hitPath]
+    for filePath in fileList:
+        for df in IterTableChunks(filePath, names, dtype, chunkSize):
+            yield df
+
+"""
+Function reads all the hits of a store directory or of a combined table.
+"""
+def ReadHitTable(hitPath, names=HIT_STORE_COLUMNS):
+    if not os.path.isdir(hitPath):
+        return ReadTable(hitPath, names=names, header=None)
+    dfList = [ReadTable(filePath, names=names, header=None) for filePath in HitStoreShards(hitPath)]
+    if not dfList:
+        return pd.DataFrame(columns=names)
+    return pd.concat(dfList, ignore_index=True)
+
+"""
+Function returns the number of hits of a store directory or of a combined table.
+"""
+def HitRowCount(hitPath):
+    fileList = HitStoreShards(hitPath) if os.path.isdir(hitPath) else [hitPath]
+    return sum(TableRowCount(filePath) for filePath in fileList)
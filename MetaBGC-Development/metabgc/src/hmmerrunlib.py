@@ -3,88 +3,270 @@ from metabgc.src.utils import *
 import os
 import subprocess
 import metabgc.src.hmmrecord as hmmrecord
+from metabgc.src.seqtranslate import ReadFastaBatches, TranslateBatch
+from metabgc.src.seqreader import SeqFileRegex, SeqFileStem, CompressionExt, DecompressShellCmd
+from metabgc.src.resultcache import ResultKey, IsCachedResult, StoreResult
+from metabgc.src.hitstore import AppendHits
+from metabgc.src.pipelinestate import TmpPath
+from metabgc.src.seedprefilter import FilterFastaBytes, SeedIndexKey, WritePrefilterStats
 import re
 import logging
 
+HMMER_PARAMS = "--F1 0.02 --F2 0.02 --F3 0.02"
+
+"""
+Function searches all FASTA file in a directory against a HMM in parallel.
+The hits are appended to hitStoreDir if given.
+"""
+def RunPCHMMDirectoryParallel(inputDir, hmmModel, sampleType, protType, window, interval, ouputDir, ncpus=4, hitStoreDir=None):
+    RunPCHMMDirectoryIntervals(inputDir, [(interval, hmmModel)], sampleType, protType, window, ouputDir, ncpus, hitStoreDir)
+
 """
-Function searches all FASTA file in a directory against a HMM in parallel. 
+Function searches all FASTA file in a directory against the HMM of each (interval, hmmModel)
+pair. All the searches are run by one adaptive scheduler, largest files first, so the cores
+freed at the end of the queue go to the --cpu of the last searches. Raises a RuntimeError if
+any search failed, so the hit store is not closed.
 """
-def RunPCHMMDirectoryParallel(inputDir, hmmModel, sampleType, protType, window, interval, ouputDir, ncpus=4):
-    logging.info('Number of pool processes:{0}.'.format(ncpus))
+def RunPCHMMDirectoryIntervals(inputDir, intervalHmmList, sampleType, protType, window, ouputDir, ncpus=4, hitStoreDir=None):
+    logging.info('Number of cores:{0}.'.format(ncpus))
     hmmsearch_task_list = []
     for subdir, dirs, files in os.walk(inputDir):
         for file in files:
             filePath = os.path.join(subdir, file)
-            if re.match(r".*.fasta$", file) and os.path.getsize(filePath) > 0:
-                sampleStr = os.path.splitext(file)[0]
-                hmm_task = hmmrecord.HMMTask(filePath,hmmModel,ouputDir,sampleType,sampleStr,protType, window, interval)
-                hmmsearch_task_list.append(hmm_task)
+            if re.match(SeqFileRegex("fasta"), file) and os.path.getsize(filePath) > 0:
+                sampleStr = SeqFileStem(file)
+                for interval, hmmModel in intervalHmmList:
+                    hmm_task = hmmrecord.HMMTask(filePath,hmmModel,ouputDir,sampleType,sampleStr,protType, window, interval,
+                                                 hitStoreDir=hitStoreDir)
+                    hmmsearch_task_list.append(ThreadedTask("hmmsearch", filePath + ":" + interval, os.path.getsize(filePath),
+                                                            runHMMSearchTask, hmm_task))
+
+    print('HMMER searching staring for ' + str(len(intervalHmmList)) + ' spHMMs.')
+    checkResults(invoke_adaptive_scheduler(hmmsearch_task_list, ncpus), "HMMER search")
+    print('HMMER searching exiting for ' + str(len(intervalHmmList)) + ' spHMMs.')
+
+"""
+Function returns the command prefix, format option and sequence argument for a HMMER input
+file. Compressed files are decompressed into the stdin of HMMER.
+"""
+def pipedSeqInput(fastaFile, formatOption):
+    if CompressionExt(fastaFile):
+        return DecompressShellCmd(fastaFile) + " | ", " " + formatOption + " fasta", "-"
+    return "", "", fastaFile
 
+"""
+Function searches FASTA file against HMM.
+"""
+def runHMMSearchTask(hmmsearch_task, threads=1):
+    status = 0
+    hmmsearch_task.ncpus = threads
+    hmmTblFileName = hmmsearch_task.sampleStr + "__" + hmmsearch_task.interval + ".tbl"
+    hmmTblFilePath = os.path.join(hmmsearch_task.ouputDir, hmmTblFileName)
+    cacheKey = ResultKey("hmmsearch", [hmmsearch_task.fastaFile], [hmmsearch_task.hmmFile], HMMER_PARAMS)
+    if not IsCachedResult(hmmTblFilePath, cacheKey):
+        cmdPrefix, seqFormat, seqInput = pipedSeqInput(hmmsearch_task.fastaFile, "--tformat")
+        cmd = cmdPrefix + "hmmsearch --cpu " + str(hmmsearch_task.ncpus) + seqFormat + " " + HMMER_PARAMS + " --tblout " + TmpPath(hmmTblFilePath) + " " + hmmsearch_task.hmmFile + " "+ seqInput + " > /dev/null"
+        logging.info('Running HMM Search with {0} against {1}.'.format(hmmsearch_task.fastaFile, hmmsearch_task.hmmFile))
+        logging.info(cmd)
+        status = subprocess.call(cmd, shell=True)
+        if status != 0:
+            logging.info("HMM search failed with exit status " + str(status) + " for: " + hmmsearch_task.fastaFile)
+            if os.path.exists(TmpPath(hmmTblFilePath)):
+                os.remove(TmpPath(hmmTblFilePath))
+            return status
+        os.replace(TmpPath(hmmTblFilePath), hmmTblFilePath)
+        StoreResult(hmmTblFilePath, cacheKey)
+    else:
+        logging.info("HMM search skipped... Using existing result for: " + hmmsearch_task.fastaFile)
+    writeHMMHits(hmmsearch_task, parseHMMScores(hmmTblFilePath), hmmsearch_task.interval)
+    logging.info("Done Running HMM search with:" + hmmsearch_task.fastaFile)
+    return status
 
-    print('HMMER searching staring for: ' + hmmModel)
-    # Create the Queue object
-    queue = JoinableQueue()
-    # Create a lock object to synchronize resource access
-    lock = Lock()
-    consumers = []
+"""
+Function concatenates the spHMMs of a directory into one profile database for hmmscan.
+Each model is renamed after its file so hits can be split back into intervals. Returns
+the dict of model name to interval. Raises a RuntimeError if hmmpress fails.
+"""
+def CombineHMMModels(sphmm_directory, combinedHmmFile):
+    modelIntervalDict = {}
+    with open(combinedHmmFile, 'w') as outfile:
+        for filename in sorted(os.listdir(sphmm_directory)):
+            if not filename.endswith(".hmm"):
+                continue
+            modelName = os.path.splitext(filename)[0]
+            modelIntervalDict[modelName] = modelName.split("__")[2]
+            with open(os.path.join(sphmm_directory, filename)) as infile:
+                for line in infile:
+                    if line.startswith("NAME "):
+                        line = "NAME  " + modelName + "\n"
+                    outfile.write(line)
+    cmd = "hmmpress -f " + combinedHmmFile + " > /dev/null"
+    logging.info(cmd)
+    if subprocess.call(cmd, shell=True) != 0:
+        raise RuntimeError("hmmpress failed for: " + combinedHmmFile)
+    return modelIntervalDict
+
+"""
+Function searches all FASTA file in a directory against a combined spHMM database in parallel.
+Each sample is read once and its hits are written per interval, to hitStoreDir if given.
+"""
+def RunPCHMMDirectoryMultiModel(inputDir, combinedHmmFile, modelIntervalDict, sampleType, protType, window, ouputDir, ncpus=4, hitStoreDir=None):
+    logging.info('Number of cores:{0}.'.format(ncpus))
+    hmmscan_task_list = []
+    for subdir, dirs, files in os.walk(inputDir):
+        for file in files:
+            filePath = os.path.join(subdir, file)
+            if re.match(SeqFileRegex("fasta"), file) and os.path.getsize(filePath) > 0:
+                sampleStr = SeqFileStem(file)
+                hmm_task = hmmrecord.HMMTask(filePath, combinedHmmFile, ouputDir, sampleType, sampleStr, protType,
+                                             window, "combined", modelIntervalDict, hitStoreDir)
+                hmmscan_task_list.append(ThreadedTask("hmmsearch", filePath, os.path.getsize(filePath), runHMMScanTask, hmm_task))
 
-    print('Setting up consumers.')
-    # Create consumer processes
-    for i in range(ncpus):
-        p = Process(target=HMMSearchConsumer, args=(queue, lock))
-        consumers.append(p)
-    # Start the producers and consumer
-    # The Python VM will launch new independent processes for each Process object
-    print('Starting up consumer sub-processes.')
-    for c in consumers:
-        c.start()
+    print('HMMER searching staring for: ' + combinedHmmFile)
+    checkResults(invoke_adaptive_scheduler(hmmscan_task_list, ncpus), "HMMER search")
+    print('HMMER searching exiting for: ' + combinedHmmFile)
 
-    print('Putting jobs in queue.')
-    # Create our producer processes by passing the producer function and it's arguments
-    for task_obj in hmmsearch_task_list:
-        queue.put(task_obj)
+"""
+Function scans FASTA file against the combined spHMM database.
+"""
+def runHMMScanTask(hmmscan_task, threads=1):
+    status = 0
+    hmmscan_task.ncpus = threads
+    hmmTblFileName = hmmscan_task.sampleStr + "__" + hmmscan_task.interval + ".tbl"
+    hmmTblFilePath = os.path.join(hmmscan_task.ouputDir, hmmTblFileName)
+    cacheKey = ResultKey("hmmscan", [hmmscan_task.fastaFile], [hmmscan_task.hmmFile], HMMER_PARAMS)
+    if not IsCachedResult(hmmTblFilePath, cacheKey):
+        cmdPrefix, seqFormat, seqInput = pipedSeqInput(hmmscan_task.fastaFile, "--qformat")
+        cmd = cmdPrefix + "hmmscan --cpu " + str(hmmscan_task.ncpus) + seqFormat + " " + HMMER_PARAMS + " --tblout " + TmpPath(hmmTblFilePath) + " " + hmmscan_task.hmmFile + " " + seqInput + " > /dev/null"
+        logging.info('Running HMM Scan with {0} against {1}.'.format(hmmscan_task.fastaFile, hmmscan_task.hmmFile))
+        logging.info(cmd)
+        status = subprocess.call(cmd, shell=True)
+        if status != 0:
+            logging.info("HMM scan failed with exit status " + str(status) + " for: " + hmmscan_task.fastaFile)
+            if os.path.exists(TmpPath(hmmTblFilePath)):
+                os.remove(TmpPath(hmmTblFilePath))
+            return status
+        os.replace(TmpPath(hmmTblFilePath), hmmTblFilePath)
+        StoreResult(hmmTblFilePath, cacheKey)
+    else:
+        logging.info("HMM scan skipped... Using existing result for: " + hmmscan_task.fastaFile)
+    writeHMMScanResults(hmmscan_task, hmmTblFilePath)
+    logging.info("Done Running HMM scan with:" + hmmscan_task.fastaFile)
+    return status
 
-    # join() method that synchronizes our program
-    queue.join()
-    print('Stopping sub-processes and terminating.')
-    for c in consumers:
-        c.terminate()
-    print('HMMER searching exiting for: ' + hmmModel)
+"""
+Function writes the hits of a sample for one interval, appended to the hit store of the
+task if it has one, otherwise to a per-sample result file.
+"""
+def writeHMMHits(hmm_task, score_dict, interval):
+    if hmm_task.hitStoreDir:
+        AppendHits(hmm_task.hitStoreDir, score_dict, hmm_task.sampleType, hmm_task.sampleStr,
+                   hmm_task.protType, hmm_task.window, interval)
+    else:
+        hmmSearchFileName = hmm_task.sampleStr + "__" + interval + ".txt"
+        hmmSearchFilePath = os.path.join(hmm_task.ouputDir, hmmSearchFileName)
+        createHitTable(score_dict, hmmSearchFilePath, hmm_task.sampleType, hmm_task.sampleStr,
+                       hmm_task.protType, hmm_task.window, interval)
 
 """
-Function searches FASTA file against HMM. 
+Function splits a hmmscan table into the per-interval results of a sample.
 """
-def HMMSearchConsumer(queue, lock):
+def writeHMMScanResults(hmmscan_task, hmmTblFilePath):
+    interval_scores_dict = parseHMMScanScores(hmmTblFilePath, hmmscan_task.modelIntervalDict)
+    for interval, score_dict in interval_scores_dict.items():
+        writeHMMHits(hmmscan_task, score_dict, interval)
 
-    # Synchronize access to the console
-    with lock:
-        logging.info('Starting consumer => {}'.format(os.getpid()))
-    # Run indefinitely
-    while True:
-        time.sleep(random.randint(0, 10))
-        # If the queue is empty, queue.get() will block until the queue has data
-        hmmsearch_task = queue.get()
-        # Synchronize access to the console
-        with lock:
-            logging.info('{} got {}'.format(os.getpid(), hmmsearch_task.fastaFile))
+"""
+Function translates all nucleotide FASTA files in a directory and pipes the 6 frames directly
+into hmmscan against the combined spHMM database, without writing the protein files.
+If protSeqDir is given, the translated reads are also kept there.
+The hits are appended to hitStoreDir if given. With a seedIndex, only the translated frames
+with seed hits are searched.
+"""
+def RunPCHMMStreamParallel(nuclSeqDir, combinedHmmFile, modelIntervalDict, sampleType, protType, window, ouputDir, ncpus=4, protSeqDir=None, hitStoreDir=None, seedIndex=None):
+    logging.info('Number of cores:{0}.'.format(ncpus))
+    hmmscan_task_list = []
+    for subdir, dirs, files in os.walk(nuclSeqDir):
+        for file in files:
+            filePath = os.path.join(subdir, file)
+            if re.match(SeqFileRegex("fasta"), file) and os.path.getsize(filePath) > 0:
+                sampleStr = SeqFileStem(file)
+                hmm_task = hmmrecord.HMMTask(filePath, combinedHmmFile, ouputDir, sampleType, sampleStr, protType,
+                                             window, "combined", modelIntervalDict, hitStoreDir)
+                protFile = None
+                if protSeqDir:
+                    protFile = os.path.join(protSeqDir, sampleStr + ".fasta")
+                hmmscan_task_list.append(ThreadedTask("hmmsearch", filePath, os.path.getsize(filePath), runHMMScanStreamTask,
+                                                      hmm_task, protFile, seedIndex))
 
-        hmmTblFileName = hmmsearch_task.sampleStr + "__" + hmmsearch_task.interval + ".tbl"
-        hmmTblFilePath = os.path.join(hmmsearch_task.ouputDir, hmmTblFileName)
-        if not os.path.exists(hmmTblFilePath):
-            cmd = "hmmsearch --cpu " + str(hmmsearch_task.ncpus) + " --F1 0.02 --F2 0.02 --F3 0.02 --tblout " + hmmTblFilePath + " " + hmmsearch_task.hmmFile + " "+ hmmsearch_task.fastaFile + " > /dev/null"
-            with lock:
-                logging.info('Running HMM Search with {0} against {1}.'.format(hmmsearch_task.fastaFile, hmmsearch_task.hmmFile))
-                logging.info(cmd)
-            subprocess.call(cmd, shell=True)
-        else:
-            with lock:
-                logging.info("HMM search skipped... Using existing result for: " + hmmsearch_task.fastaFile)
-        result_dict = parseHMM(hmmTblFilePath, "hmmer3-tab", hmmsearch_task.sampleType, hmmsearch_task.sampleStr,
-                               hmmsearch_task.protType, hmmsearch_task.window, hmmsearch_task.interval)
-        hmmSearchFileName = hmmsearch_task.sampleStr + "__" + hmmsearch_task.interval + ".txt"
-        hmmSearchFilePath = os.path.join(hmmsearch_task.ouputDir, hmmSearchFileName)
-        createPandaDF(result_dict, hmmSearchFilePath)
-        with lock:
-            logging.info("Done Running HMM search with:" + hmmsearch_task.fastaFile)
+    print('HMMER streaming search staring for: ' + combinedHmmFile)
+    checkResults(invoke_adaptive_scheduler(hmmscan_task_list, ncpus), "HMMER streaming search")
+    print('HMMER streaming search exiting for: ' + combinedHmmFile)
 
-        queue.task_done()
+"""
+Function translates a nucleotide FASTA file into the stdin of hmmscan.
+"""
+def runHMMScanStreamTask(hmmscan_task, protFile=None, seedIndex=None, threads=1):
+    hmmscan_task.ncpus = threads
+    hmmTblFileName = hmmscan_task.sampleStr + "__" + hmmscan_task.interval + ".tbl"
+    hmmTblFilePath = os.path.join(hmmscan_task.ouputDir, hmmTblFileName)
+    cacheParams = HMMER_PARAMS + " translate:table11"
+    if seedIndex is not None:
+        cacheParams = cacheParams + " prefilter:" + SeedIndexKey(seedIndex)
+    cacheKey = ResultKey("hmmscan", [hmmscan_task.fastaFile], [hmmscan_task.hmmFile], cacheParams)
+    # The translated reads are only written by a new search
+    cached = IsCachedResult(hmmTblFilePath, cacheKey) and (protFile is None or os.path.exists(protFile))
+    if not cached:
+        cmd = "hmmscan --cpu " + str(hmmscan_task.ncpus) + " " + HMMER_PARAMS + " --qformat fasta --tblout " + TmpPath(hmmTblFilePath) + " " + hmmscan_task.hmmFile + " - > /dev/null"
+        logging.info('Streaming translated {0} into HMM Scan against {1}.'.format(hmmscan_task.fastaFile, hmmscan_task.hmmFile))
+        logging.info(cmd)
+        proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE)
+        protHandle = None
+        totalCtr = 0
+        keptCtr = 0
+        streamed = False
+        try:
+            if protFile:
+                protHandle = open(protFile, 'wb')
+            for batch in ReadFastaBatches(hmmscan_task.fastaFile):
+                protBytes = TranslateBatch(batch)
+                if protHandle:
+                    protHandle.write(protBytes)
+                if seedIndex is not None:
+                    protBytes, batchTotal, batchKept = FilterFastaBytes(protBytes, seedIndex)
+                    totalCtr = totalCtr + batchTotal
+                    keptCtr = keptCtr + batchKept
+                proc.stdin.write(protBytes)
+            streamed = True
+        except BrokenPipeError:
+            # hmmscan exited, its exit status tells why
+            logging.info("HMM scan closed its input early for: " + hmmscan_task.fastaFile)
+            streamed = True
+        finally:
+            if protHandle:
+                protHandle.close()
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            # On any other error hmmscan is stopped, so no process or partial table is left
+            if not streamed:
+                proc.kill()
+                proc.wait()
+                if os.path.exists(TmpPath(hmmTblFilePath)):
+                    os.remove(TmpPath(hmmTblFilePath))
+        if seedIndex is not None:
+            WritePrefilterStats(os.path.join(hmmscan_task.ouputDir, hmmscan_task.sampleStr), totalCtr, keptCtr)
+        status = proc.wait()
+        if status != 0:
+            logging.info("HMM scan failed with exit status " + str(status) + " for: " + hmmscan_task.fastaFile)
+            if os.path.exists(TmpPath(hmmTblFilePath)):
+                os.remove(TmpPath(hmmTblFilePath))
+            return status
+        os.replace(TmpPath(hmmTblFilePath), hmmTblFilePath)
+        StoreResult(hmmTblFilePath, cacheKey)
+    else:
+        logging.info("HMM scan skipped... Using existing result for: " + hmmscan_task.fastaFile)
+    writeHMMScanResults(hmmscan_task, hmmTblFilePath)
+    logging.info("Done streaming HMM scan with:" + hmmscan_task.fastaFile)
+    return 0
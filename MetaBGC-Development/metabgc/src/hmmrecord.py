@@ -17,7 +17,7 @@ class HMMFile:
 		self.hmmFile = hmmFile
 
 class HMMTask:
-	def __init__(self, fastaFile, hmmFile, ouputDir, sampleType, sampleStr, protType, window, interval):
+	def __init__(self, fastaFile, hmmFile, ouputDir, sampleType, sampleStr, protType, window, interval, modelIntervalDict=None, hitStoreDir=None):
 		self.fastaFile = fastaFile
 		self.hmmFile = hmmFile
 		self.ouputDir = ouputDir
@@ -26,4 +26,6 @@ class HMMTask:
 		self.protType = protType
 		self.window = window
 		self.interval = interval
+		self.modelIntervalDict = modelIntervalDict
+		self.hitStoreDir = hitStoreDir
 		self.ncpus = 1
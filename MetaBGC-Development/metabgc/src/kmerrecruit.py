@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import logging
+import os
+import re
+import numpy as np
+from metabgc.src.producer_consumer import Task, invoke_producer_consumer, checkResults
+from metabgc.src.seqreader import SeqFileRegex, SeqFileStem, ReadFastxBatches, RecordId
+from metabgc.src.resultcache import RunCachedTask, FileSignature
+from metabgc.src.pipelinestate import TmpPath
+
+"""
+In-process read recruitment of quantify, a fast alternative to the blastn search of the
+sample reads against the dereplicated identified reads. Every k-mer of the identified reads
+and of their reverse complements is indexed. The k-mers of a sample read are looked up at
+a stride, and each (identified read, strand, diagonal) found is extended without gaps to
+the best scoring segment with the megablast scores (+1/-2). A hit is reported when the
+segment has the identity and the coverage of the identified read required of the BLAST
+HSPs (-perc_identity 95 -qcov_hsp_perc 50). An overlap of 50 bases with at most 2
+mismatches shares 16 exact bases, which always contain a k-mer at the default k and stride.
+The output has the columns of the quantify BLAST tables; no e-value is computed and the
+evalue column is 0. The stride k-mers of a batch of reads are first encoded in 2 bits per
+base and looked up with numpy in a bitmap of the codes of the index, so only the reads with a
+k-mer hit go through the Python extension. The index is loaded once per process and
+inherited by the forked workers, rather than sent with each sample task.
+"""
+
+KMER_LEN = 14
+KMER_STRIDE = 3
+MATCH_SCORE = 1
+MISMATCH_SCORE = -2
+MIN_IDENTITY = 95.0
+MIN_COVERAGE = 50.0
+
+_COMPLEMENT = bytes.maketrans(b"ACGTNacgtn", b"TGCANtgcan")
+# 2 bit codes of the bases, 4 for the other characters
+_BASE_CODE = np.full(256, 4, dtype=np.uint8)
+_BASE_CODE[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4, dtype=np.uint8)
+_indexDict = {}
+# Bases of the k-mer codes in the filter of the index, a bitmap of 4^14 bits (32 MB)
+CODE_FILTER_LEN = 14
+
+"""
+Function returns the reverse complement of a nucleotide byte string.
+"""
+def ReverseComplement(seq):
+    return seq.translate(_COMPLEMENT)[::-1]
+
+"""
+K-mer index of the identified reads. kmerDict maps each k-mer to the list of
+(read index, strand, position) where it occurs, the position being on the reverse
+complement for strand -1. codeFilter is a bitmap of the low bits of the 2 bit codes of the
+ACGT k-mers, exact up to k = 14; a longer k-mer may set the bit of another.
+"""
+class KmerIndex:
+    def __init__(self, kmerLen):
+        self.kmerLen = kmerLen
+        self.kmerDict = {}
+        self.idList = []
+        self.seqList = []
+        self.rcSeqList = []
+        self.codeFilter = np.zeros(1 << max(2 * min(kmerLen, CODE_FILTER_LEN) - 3, 0), dtype=np.uint8)
+
+"""
+Function builds the k-mer index of the reads of a FASTA file.
+"""
+def BuildKmerIndex(fastaFile, kmerLen=KMER_LEN):
+    index = KmerIndex(kmerLen)
+    for headerList, seqList in ReadFastxBatches(fastaFile, "fasta"):
+        for header, seq in zip(headerList, seqList):
+            seq = seq.upper()
+            readIdx = len(index.idList)
+            index.idList.append(RecordId(header).decode())
+            index.seqList.append(seq)
+            index.rcSeqList.append(ReverseComplement(seq))
+            for strand, strandSeq in ((1, seq), (-1, index.rcSeqList[-1])):
+                for pos in range(len(strandSeq) - kmerLen + 1):
+                    kmer = strandSeq[pos:pos + kmerLen]
+                    if b'N' not in kmer:
+                        index.kmerDict.setdefault(kmer, []).append((readIdx, strand, pos))
+    kmerList = [kmer for kmer in index.kmerDict if not kmer.strip(b"ACGT")]
+    if kmerList:
+        codes = KmerCodes(np.frombuffer(b"".join(kmerList), dtype=np.uint8),
+                          np.arange(0, len(kmerList) * kmerLen, kmerLen), kmerLen)[0]
+        bits = _FilterBits(index.codeFilter, codes)
+        np.bitwise_or.at(index.codeFilter, bits >> np.uint64(3), np.left_shift(1, bits & np.uint64(7)).astype(np.uint8))
+    logging.info("Indexed " + str(len(index.kmerDict)) + " k-mers of " + str(len(index.idList)) + " reads in " + fastaFile)
+    return index
+
+"""
+Function returns the k-mer index of a FASTA file, built once per process.
+"""
+def LoadKmerIndex(fastaFile, kmerLen=KMER_LEN):
+    indexKey = (FileSignature(fastaFile), kmerLen)
+    if indexKey not in _indexDict:
+        _indexDict[indexKey] = BuildKmerIndex(fastaFile, kmerLen)
+    return _indexDict[indexKey]
+
+"""
+Function returns the 2 bit codes of the k-mers of a uint8 sequence array starting at the
+given positions, and the mask of the k-mers made only of ACGT.
+"""
+def KmerCodes(seqArray, posArray, kmerLen):
+    codes = np.zeros(len(posArray), dtype=np.uint64)
+    valid = np.ones(len(posArray), dtype=bool)
+    for j in range(kmerLen):
+        base = _BASE_CODE[seqArray[posArray + j]]
+        valid &= base < 4
+        codes = (codes << np.uint64(2)) | (base & 3).astype(np.uint64)
+    return codes, valid
+
+"""
+Function returns the bits of the codes in the k-mer code filter.
+"""
+def _FilterBits(codeFilter, codes):
+    return codes & np.uint64(len(codeFilter) * 8 - 1)
+
+"""
+Function returns the mask of the codes whose bit is set in the k-mer code filter.
+"""
+def CodeFilterHits(codeFilter, codes):
+    bits = _FilterBits(codeFilter, codes)
+    return (codeFilter[bits >> np.uint64(3)] >> (bits & np.uint64(7)).astype(np.uint8)) & 1 == 1
+
+"""
+Function returns the mask of the reads of a batch with a stride k-mer in the index. Reads
+with a k-mer of characters other than ACGT and N are always kept, as the dictionary of
+the index may hold such k-mers.
+"""
+def CandidateReads(seqList, index, stride=KMER_STRIDE):
+    kmerLen = index.kmerLen
+    lengths = np.fromiter((len(seq) for seq in seqList), dtype=np.int64, count=len(seqList))
+    kmerCtrs = np.where(lengths >= kmerLen, (lengths - kmerLen) // stride + 1, 0)
+    candidate = np.zeros(len(seqList), dtype=bool)
+    if kmerCtrs.sum() == 0:
+        return candidate
+    seqArray = np.frombuffer(b"".join(seqList), dtype=np.uint8)
+    readOffsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    readIdx = np.repeat(np.arange(len(seqList)), kmerCtrs)
+    kmerStarts = np.concatenate([[0], np.cumsum(kmerCtrs)[:-1]])
+    posArray = readOffsets[readIdx] + (np.arange(len(readIdx)) - kmerStarts[readIdx]) * stride
+    codes, valid = KmerCodes(seqArray, posArray, kmerLen)
+    found = valid & CodeFilterHits(index.codeFilter, codes)
+    candidate[readIdx[found]] = True
+    # K-mers with other characters than ACGT and N are looked up in the dictionary
+    other = (_BASE_CODE[seqArray] == 4) & (seqArray != ord("N"))
+    if other.any():
+        otherReads = np.zeros(len(seqList), dtype=bool)
+        otherReads[np.searchsorted(readOffsets, np.flatnonzero(other), side="right") - 1] = True
+        candidate |= otherReads
+    return candidate
+
+"""
+Function returns the best scoring ungapped segment of a read on a diagonal of an indexed
+sequence, where read position i faces position i + diag. Returns (score, start, end,
+matches) with the read coordinates of the segment, end excluded.
+"""
+def BestSegment(readSeq, refSeq, diag):
+    start = max(0, -diag)
+    end = min(len(readSeq), len(refSeq) - diag)
+    best = (0, start, start, 0)
+    score = 0
+    segStart = start
+    matches = 0
+    for i in range(start, end):
+        if readSeq[i] == refSeq[i + diag]:
+            score = score + MATCH_SCORE
+            matches = matches + 1
+        else:
+            score = score + MISMATCH_SCORE
+        if score <= 0:
+            score = 0
+            segStart = i + 1
+            matches = 0
+        elif score > best[0]:
+            best = (score, segStart, i + 1, matches)
+    return best
+
+"""
+Function returns the hit lines of a read against the index, one per identified read, in
+the columns of the quantify BLAST tables (sseqid slen sstart send qseqid qlen qstart qend
+pident evalue) with the sample read as subject.
+"""
+def RecruitRead(readID, readSeq, index, stride=KMER_STRIDE, minIdentity=MIN_IDENTITY, minCoverage=MIN_COVERAGE):
+    kmerLen = index.kmerLen
+    diagSet = set()
+    for i in range(0, len(readSeq) - kmerLen + 1, stride):
+        hitList = index.kmerDict.get(readSeq[i:i + kmerLen])
+        if hitList:
+            for readIdx, strand, pos in hitList:
+                diagSet.add((readIdx, strand, pos - i))
+    bestDict = {}
+    for readIdx, strand, diag in diagSet:
+        refSeq = index.seqList[readIdx] if strand == 1 else index.rcSeqList[readIdx]
+        segment = BestSegment(readSeq, refSeq, diag)
+        if segment[0] > bestDict.get((readIdx, strand), (0,))[0]:
+            bestDict[(readIdx, strand)] = segment + (diag,)
+    lineDict = {}
+    for (readIdx, strand), (score, start, end, matches, diag) in bestDict.items():
+        refLen = len(index.seqList[readIdx])
+        length = end - start
+        pident = 100.0 * matches / length
+        if pident < minIdentity or 100.0 * length < minCoverage * refLen:
+            continue
+        if readIdx in lineDict and lineDict[readIdx][0] >= score:
+            continue
+        if strand == 1:
+            sstart, send, qstart, qend = start + 1, end, start + diag + 1, end + diag
+        else:
+            sstart, send, qstart, qend = end, start + 1, refLen - (end + diag) + 1, refLen - (start + diag)
+        lineDict[readIdx] = (score, "\t".join([readID, str(len(readSeq)), str(sstart), str(send),
+                                               index.idList[readIdx], str(refLen), str(qstart), str(qend),
+                                               "{:.3f}".format(pident), "0"]) + "\n")
+    return [line for score, line in lineDict.values()]
+
+"""
+Function recruits the reads of a FASTA file against the index of queryFile and writes the
+hit table. Returns the exit status.
+"""
+def RecruitReadFile(readFile, queryFile, outFile, stride=KMER_STRIDE, kmerLen=KMER_LEN,
+                    minIdentity=MIN_IDENTITY, minCoverage=MIN_COVERAGE):
+    index = LoadKmerIndex(queryFile, kmerLen)
+    hitCtr = 0
+    with open(outFile, 'w') as outfile:
+        for headerList, seqList in ReadFastxBatches(readFile, "fasta"):
+            seqList = [seq.upper() for seq in seqList]
+            for header, seq, candidate in zip(headerList, seqList, CandidateReads(seqList, index, stride)):
+                if not candidate:
+                    continue
+                lines = RecruitRead(RecordId(header).decode(), seq, index, stride, minIdentity, minCoverage)
+                if lines:
+                    outfile.write("".join(lines))
+                    hitCtr = hitCtr + len(lines)
+    logging.info("Recruited " + str(hitCtr) + " hits from " + readFile)
+    return 0
+
+"""
+Function recruits the reads of the FASTA files in readDir against the reads of queryFile,
+writing a table per sample into ouputDir as RunPCMakeDBandBlastN does.
+"""
+def RunPCKmerRecruit(readDir, queryFile, ouputDir, ncpus=4, kmerLen=KMER_LEN, stride=KMER_STRIDE):
+    recruit_task_list = []
+    params = " ".join(str(p) for p in [kmerLen, stride, MIN_IDENTITY, MIN_COVERAGE])
+    for subdir, dirs, files in os.walk(readDir):
+        for file in files:
+            filePath = os.path.join(subdir, file)
+            if re.match(SeqFileRegex("fasta"), file) and os.path.getsize(filePath) > 0:
+                outFile = os.path.join(ouputDir, SeqFileStem(file) + ".txt")
+                keyArgs = ("metabgc-kmerrecruit", [filePath], [queryFile], params)
+                recruit_task_list.append(Task("recruit", filePath, RunCachedTask, outFile, keyArgs, RecruitReadFile,
+                                              filePath, queryFile, TmpPath(outFile), stride, kmerLen))
+    logging.info("Created recruitment list. # of samples:" + str(len(recruit_task_list)))
+    if recruit_task_list:
+        # Built before the consumers are forked, so they share it
+        LoadKmerIndex(queryFile, kmerLen)
+        checkResults(invoke_producer_consumer(recruit_task_list, ncpus), "Read recruitment")
+    logging.info("Done recruiting reads.")
+
+def _HitPairs(hitDir):
+    pairSet = set()
+    for file in os.listdir(hitDir):
+        filePath = os.path.join(hitDir, file)
+        if file.endswith(".txt") and os.path.isfile(filePath):
+            sample = file[:-len(".txt")]
+            with open(filePath) as infile:
+                for line in infile:
+                    cols = line.split()
+                    pairSet.add((sample, cols[4], cols[0]))
+    return pairSet
+
+"""
+Function compares the (sample, identified read, sample read) pairs of a recruitment against
+a reference BLAST search. Returns a dict with the pair counts, recall and precision.
+"""
+def CompareRecruitment(referenceDir, recruitDir):
+    referencePairs = _HitPairs(referenceDir)
+    recruitPairs = _HitPairs(recruitDir)
+    sharedCtr = len(referencePairs & recruitPairs)
+    return {"reference": len(referencePairs), "recruited": len(recruitPairs), "shared": sharedCtr,
+            "recall": sharedCtr / len(referencePairs) if referencePairs else 1.0,
+            "precision": sharedCtr / len(recruitPairs) if recruitPairs else 1.0}
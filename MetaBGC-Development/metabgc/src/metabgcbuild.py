@@ -1,6 +1,8 @@
 from Bio import AlignIO
 from metabgc.src.hmmerrunlib import *
 from metabgc.src.blastrunlib import *
+from metabgc.src.resultcache import SetProvidedResultDirectory
+from metabgc.src.hitstore import OpenHitStore, CloseHitStore, IsHitStoreComplete
 import metabgc.src.createsphmms as createhmm
 import metabgc.src.evaluate_sphmms as evaluate
 import os
@@ -25,9 +27,9 @@ def ungappedseqsearch(reference_str, query_str):
             return [i, k]
     return [-1, -1]
 
-def gensphmmfiles(prot_family_name,prot_aln_file,tp_prot_file,hmm_directory,gene_pos_file,gene_pos_file_aa):
+def gensphmmfiles(prot_family_name,prot_aln_file,tp_prot_file,hmm_directory,gene_pos_file,gene_pos_file_aa,cpu=1):
     alignment = AlignIO.read(prot_aln_file, "fasta")
-    hmmDict = createhmm.GenerateSpHMM(prot_aln_file, tp_prot_file,10, 30, hmm_directory, prot_family_name, 1, alignment.get_alignment_length()+1, gene_pos_file,gene_pos_file_aa)
+    hmmDict = createhmm.GenerateSpHMM(prot_aln_file, tp_prot_file,10, 30, hmm_directory, prot_family_name, 1, alignment.get_alignment_length()+1, gene_pos_file,gene_pos_file_aa,cpu)
     return hmmDict
 
 def gengeneposlist(prot_family_name,protAlnSeqs,hmmDict,alnOutput,gene_pos_file):
@@ -85,9 +87,16 @@ def mbgcbuild(prot_alignment, prot_family_name, cohort_name,
         gene_pos_file_aa = os.path.join(build_op_dir, 'Gene_Interval_Pos_AA.txt')
         if hmm_search_directory is None:
             hmm_search_directory = os.path.join(build_op_dir, 'hmm_result')
-        allHMMResult = os.path.join(build_op_dir,"CombinedHmmSearch.txt")
+        else:
+            SetProvidedResultDirectory(hmm_search_directory)
+        allHMMResult = os.path.join(build_op_dir,"CombinedHmmSearch")
+        # Combined table of an earlier version
+        if os.path.exists(allHMMResult + ".txt"):
+            allHMMResult = allHMMResult + ".txt"
         if blastn_search_directory is None:
             blastn_search_directory = os.path.join(build_op_dir, 'blastn_result')
+        else:
+            SetProvidedResultDirectory(blastn_search_directory)
         allBLASTResult = os.path.join(build_op_dir,"CombinedBLASTSearch.txt")
         if prot_seq_directory is None:
             prot_seq_directory = ""
@@ -120,7 +129,7 @@ def mbgcbuild(prot_alignment, prot_family_name, cohort_name,
         # Gen spHMMs and interval pos
         # Extract spHMM coordinates from MUSCLE alignment
         hmmDict = gensphmmfiles(prot_family_name, alnOutput, tp_genes_prot,
-                                hmm_directory, gene_pos_file, gene_pos_file_aa)
+                                hmm_directory, gene_pos_file, gene_pos_file_aa, CPU_THREADS)
 
         if r1_file_suffix is None:
             r1_file_suffix = ""
@@ -144,20 +153,15 @@ def mbgcbuild(prot_alignment, prot_family_name, cohort_name,
             prot_seq_directory = TranseqReadsDir(build_op_dir, nucl_seq_directory, CPU_THREADS)
 
         # HMMER Search
-        if not os.path.exists(allHMMResult):
+        if not os.path.isfile(allHMMResult) and not IsHitStoreComplete(allHMMResult):
             os.makedirs(hmm_search_directory,0o777,True)
+            OpenHitStore(allHMMResult)
+            intervalHmmList = []
             for hmmSeqPosKey, hmmFileObj in hmmDict.items():
                 hmmInterval = str(hmmDict[hmmSeqPosKey].intervalStart)+"_"+str(hmmDict[hmmSeqPosKey].intervalEnd)
-                RunPCHMMDirectoryParallel(prot_seq_directory,hmmFileObj.hmmFile, cohort_name, prot_family_name, "30_10", hmmInterval, hmm_search_directory, CPU_THREADS)
-
-            with open(allHMMResult, 'w') as outfile:
-                for subdir, dirs, files in os.walk(hmm_search_directory):
-                    for file in files:
-                        filePath = os.path.join(subdir, file)
-                        if re.match(r".*txt$", file) and os.path.getsize(filePath) > 0:
-                            with open(filePath) as infile:
-                                for line in infile:
-                                    outfile.write(line)
+                intervalHmmList.append((hmmInterval, hmmFileObj.hmmFile))
+            RunPCHMMDirectoryIntervals(prot_seq_directory, intervalHmmList, cohort_name, prot_family_name, "30_10", hmm_search_directory, CPU_THREADS, allHMMResult)
+            CloseHitStore(allHMMResult)
         else:
             print("Using existing HMM search result file:" + allHMMResult)
 
@@ -8,128 +8,506 @@
 
 import pandas as pd
 from sklearn.cluster import DBSCAN
-from collections import Counter
+from collections import Counter, OrderedDict
 from statistics import mean
 from Bio import SeqIO
 import numpy as np
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 import json
 import re
 import os
+from metabgc.src.tableio import ReadTable
+from metabgc.src.producer_consumer import Task, invoke_producer_consumer, checkResults
 
+BIN_FASTA_MAX_OPEN = 256
+
+"""
+Class of a bounded pool of FASTA files open for appending, the least recently written
+file is closed when the pool is full. A file is truncated when first opened.
+"""
+class BinFastaPool:
+    def __init__(self, maxOpen):
+        self.maxOpen = maxOpen
+        self.handles = OrderedDict()
+        self.opened = set()
+
+    def write(self, path, text):
+        handle = self.handles.get(path)
+        if handle is None:
+            if len(self.handles) >= self.maxOpen:
+                self.handles.popitem(last=False)[1].close()
+            handle = open(path, "a" if path in self.opened else "w")
+            self.opened.add(path)
+            self.handles[path] = handle
+        else:
+            self.handles.move_to_end(path)
+        handle.write(text)
+
+    def close(self):
+        for handle in self.handles.values():
+            handle.close()
+        self.handles.clear()
+
+"""
+Function writes the reads of the bins in one pass over the identified reads: bins with at
+least readThresh reads in bin_fasta/gt<readThresh>, bins of 2 or more reads in
+bin_fasta/rem, single read bins in bin_fasta/rem/singleton.fasta and all the binned reads
+in identified_quantified_reads.fasta.
+"""
 def PrintBinSeqs(binIds,df_read_labels,identifiedReadFile,readThresh,outDir):
-    seq_dict = SeqIO.index(identifiedReadFile, "fasta")
-    single_records = []
-    all_quantified_records = []
     fastaDirGT10 = outDir + "/bin_fasta/gt" + str(readThresh)
     fastaDirRem = outDir + "/bin_fasta/rem"
     os.makedirs(fastaDirGT10, 0o777, True)
     os.makedirs(fastaDirRem, 0o777, True)
-    for bin in binIds:
-        df_bin_reads = df_read_labels[df_read_labels['bin']==bin]
-        records = []
-        count_row = df_bin_reads.shape[0]
+    df_read_labels = df_read_labels[df_read_labels['bin'].isin(list(binIds))]
+    binSizes = df_read_labels.groupby('bin').size()
+    binFiles = {}
+    for bin, count_row in binSizes.items():
         if count_row >= readThresh:
-            for index, row in df_bin_reads.iterrows():
-                seq_record = seq_dict[row['qseqid']]
-                records.append(seq_record)
-                all_quantified_records.append(seq_record)
-            output_file = os.path.join(fastaDirGT10,str(bin)+".fasta")
-            SeqIO.write(records, output_file, "fasta")
+            binFiles[bin] = os.path.join(fastaDirGT10, str(bin) + ".fasta")
         elif count_row >= 2:
-            for index, row in df_bin_reads.iterrows():
-                seq_record = seq_dict[row['qseqid']]
+            binFiles[bin] = os.path.join(fastaDirRem, str(bin) + ".fasta")
+        else:
+            binFiles[bin] = os.path.join(fastaDirRem, "singleton.fasta")
+    readFiles = dict(zip(df_read_labels['qseqid'], df_read_labels['bin'].map(binFiles)))
+
+    pool = BinFastaPool(BIN_FASTA_MAX_OPEN)
+    try:
+        # Written even without single read bins
+        pool.write(os.path.join(fastaDirRem, "singleton.fasta"), "")
+        with open(os.path.join(outDir, "identified_quantified_reads.fasta"), "w") as quantFile:
+            for seq_record in SeqIO.parse(identifiedReadFile, "fasta"):
+                binFile = readFiles.pop(seq_record.id, None)
+                if binFile is not None:
+                    text = seq_record.format("fasta")
+                    pool.write(binFile, text)
+                    quantFile.write(text)
+    finally:
+        pool.close()
+
+
+CLUSTER_CHUNK_SIZE = 500
+
+"""
+Function returns the read names, in the sorted order of the abundance table, the sample
+names and the sparse read x sample CSR matrix of the long abundance table (Sample, qseqid,
+count).
+"""
+def SparseAbundance(df_abundance):
+    reads = pd.Categorical(df_abundance['qseqid'].astype(str))
+    samples = pd.Categorical(df_abundance['Sample'].astype(str))
+    mat = sparse.csr_matrix((df_abundance['count'].to_numpy(dtype=np.float64), (reads.codes, samples.codes)),
+                            shape=(len(reads.categories), len(samples.categories)))
+    return np.asarray(reads.categories), np.asarray(samples.categories), mat
+
+"""
+Function returns the sparse graph of the correlation distances <= max_dist between the
+rows of a sparse matrix. The correlation of two rows is computed from their dot product,
+means and centered norms, so the rows are never centered into dense vectors. Two rows with
+no column in common have a correlation <= 0, a distance >= 1, so for max_dist < 1 all the
+neighbors are among the non zero entries of the sparse product, computed by chunks of
+rows. Rows with a constant profile have no correlation and no neighbors. With a list of
+row indices, only the graph rows of these reads are computed, against all the reads.
+"""
+def CorrelationRadiusGraph(mat, max_dist, chunkSize=CLUSTER_CHUNK_SIZE, rows=None):
+    numReads, numSamples = mat.shape
+    rowIdx = np.arange(numReads) if rows is None else np.asarray(rows, dtype=np.int64)
+    means = np.asarray(mat.sum(axis=1)).ravel() / numSamples
+    norms = np.sqrt(np.maximum(np.asarray(mat.multiply(mat).sum(axis=1)).ravel() - numSamples * means ** 2, 0))
+    matT = mat.T.tocsr()
+    row_list = []
+    col_list = []
+    dist_list = []
+    for start in range(0, len(rowIdx), chunkSize):
+        prod = (mat[rowIdx[start:start + chunkSize]] @ matT).tocoo()
+        rows = prod.row + start
+        reads = rowIdx[rows]
+        cols = prod.col
+        denom = norms[reads] * norms[cols]
+        valid = denom > 0
+        rows, reads, cols = rows[valid], reads[valid], cols[valid]
+        dist = 1 - (prod.data[valid] - numSamples * means[reads] * means[cols]) / denom[valid]
+        keep = dist <= max_dist
+        row_list.append(rows[keep])
+        col_list.append(cols[keep])
+        dist_list.append(dist[keep])
+    # Stored entries are the neighbors of the precomputed graph, so the zero distances of
+    # identical profiles are kept as the smallest positive value rather than dropped
+    dist = np.maximum(np.concatenate(dist_list), np.finfo(np.float64).tiny)
+    return sparse.csr_matrix((dist, (np.concatenate(row_list), np.concatenate(col_list))), shape=(len(rowIdx), numReads))
+
+"""
+Function runs DBSCAN with the correlation distance on the rows of the sparse abundance
+matrix, on the radius graph of CorrelationRadiusGraph. The labels are those of DBSCAN on
+the dense matrix. A max_dist of 1 or more reaches rows without common samples, which
+falls back to the dense brute force DBSCAN.
+"""
+def ClusterReads(mat, max_dist, min_samples, cpu=1):
+    return ClusterReadsCore(mat, max_dist, min_samples, cpu)[0]
+
+"""
+Function returns the DBSCAN labels of ClusterReads and the boolean mask of the core reads.
+"""
+def ClusterReadsCore(mat, max_dist, min_samples, cpu=1):
+    if max_dist >= 1:
+        db = DBSCAN(eps=max_dist, min_samples=min_samples, metric="correlation",
+                    algorithm="brute", n_jobs=cpu).fit(mat.toarray())
+    else:
+        graph = CorrelationRadiusGraph(mat, max_dist)
+        db = DBSCAN(eps=max_dist, min_samples=min_samples, metric="precomputed", n_jobs=cpu).fit(graph)
+    core = np.zeros(mat.shape[0], dtype=bool)
+    core[db.core_sample_indices_] = True
+    return db.labels_, core
+
+CLUSTER_MODEL_FILE = "ClusterModel.json"
+CLUSTER_MODEL_MATRIX = "ClusterModel.npz"
+CLUSTER_MODEL_READS = "ClusterModelReads.fasta"
+
+"""
+Function saves the cluster model of a run in its directory, for the incremental updates
+with new samples: the DBSCAN parameters, read and sample names, bin labels and core reads
+in ClusterModel.json, the read x sample abundance matrix in ClusterModel.npz and the reads
+of the bins in ClusterModelReads.fasta. Returns the path of the model file.
+"""
+def SaveClusterModel(dir_path, read_names, sample_names, mat, labels, core, max_dist, min_samples, readFileList):
+    model = {"max_dist": float(max_dist), "min_samples": min_samples,
+             "reads": [str(r) for r in read_names], "samples": [str(s) for s in sample_names],
+             "labels": [int(l) for l in labels], "core": np.flatnonzero(core).tolist(),
+             "matrix": CLUSTER_MODEL_MATRIX, "read_fasta": CLUSTER_MODEL_READS}
+    sparse.save_npz(os.path.join(dir_path, CLUSTER_MODEL_MATRIX), sparse.csr_matrix(mat))
+    # Reads of the previous model come first so a read of the new batch never replaces them
+    readIDs = set()
+    records = []
+    for readFile in readFileList:
+        for seq_record in SeqIO.parse(readFile, "fasta"):
+            if seq_record.id not in readIDs:
+                readIDs.add(seq_record.id)
                 records.append(seq_record)
-                all_quantified_records.append(seq_record)
-            output_file = os.path.join(fastaDirRem,str(bin)+".fasta")
-            SeqIO.write(records, output_file, "fasta")
+    SeqIO.write(records, os.path.join(dir_path, CLUSTER_MODEL_READS), "fasta")
+    model_file = os.path.join(dir_path, CLUSTER_MODEL_FILE)
+    with open(model_file, "w") as h:
+        json.dump(model, h)
+    return model_file
+
+"""
+Function loads a cluster model saved by SaveClusterModel. Returns the model dict with the
+abundance matrix, labels and core mask as arrays and the paths of the model files.
+"""
+def LoadClusterModel(model_file):
+    model_dir = os.path.dirname(os.path.realpath(model_file))
+    with open(model_file) as h:
+        model = json.load(h)
+    model["matrix"] = sparse.load_npz(os.path.join(model_dir, model["matrix"])).tocsr()
+    model["read_fasta"] = os.path.join(model_dir, model["read_fasta"])
+    model["labels"] = np.asarray(model["labels"], dtype=np.int64)
+    core = np.zeros(len(model["reads"]), dtype=bool)
+    core[np.asarray(model["core"], dtype=np.int64)] = True
+    model["core"] = core
+    return model
+
+"""
+Function adds the samples of a long abundance table to the abundance matrix of a model.
+New reads are added as rows and the new samples as columns. Returns the read names, sample
+names, the combined matrix and the row indices of the affected reads: the new reads and
+the reads found in the new samples. Samples already in the model raise a ValueError.
+"""
+def AddSamples(read_names, sample_names, mat, df_abundance):
+    new_samples = sorted(set(df_abundance['Sample'].astype(str)))
+    overlap = set(new_samples) & set(sample_names)
+    if overlap:
+        raise ValueError("Samples already in the cluster model: " + ", ".join(sorted(overlap)))
+    read_index = {read: i for i, read in enumerate(read_names)}
+    new_reads = sorted(set(df_abundance['qseqid'].astype(str)) - set(read_index))
+    for read in new_reads:
+        read_index[read] = len(read_index)
+    all_reads = list(read_names) + new_reads
+    all_samples = list(sample_names) + new_samples
+    sample_index = {sample: i + len(sample_names) for i, sample in enumerate(new_samples)}
+    rows = df_abundance['qseqid'].astype(str).map(read_index).to_numpy()
+    cols = df_abundance['Sample'].astype(str).map(sample_index).to_numpy()
+    new_mat = sparse.csr_matrix((df_abundance['count'].to_numpy(dtype=np.float64), (rows, cols)),
+                                shape=(len(all_reads), len(all_samples)))
+    old_mat = sparse.vstack([mat, sparse.csr_matrix((len(new_reads), mat.shape[1]))])
+    combined = sparse.hstack([old_mat, sparse.csr_matrix((len(all_reads), len(new_samples)))]).tocsr() + new_mat
+    affected = np.unique(np.concatenate([np.unique(rows), np.arange(len(read_names), len(all_reads))]))
+    return np.asarray(all_reads), np.asarray(all_samples), combined, affected
+
+"""
+Function updates the bins of a model with the reads of new samples, re-clustering only the
+neighborhoods of the affected reads. The core reads among the affected reads are recomputed
+from their radius graph rows and grouped by the DBSCAN connectivity of the affected core
+reads. A group touching core reads of existing bins joins the bin with most links, else it
+keeps the most common previous bin of its reads, unless another group took it, else it is a
+new bin. Border reads take the bin of their nearest core read, and noise reads of the
+model within max_dist of an affected core read join its bin. Reads outside the affected
+neighborhoods keep their bins, and the existing bins are never merged or split, so the bins
+drift from a full re-clustering as batches are added. A max_dist of 1 or more links all the
+reads, which re-clusters the full matrix. Returns the labels and core mask of all the reads.
+"""
+def UpdateClusterLabels(mat, labels, core, affected, max_dist, min_samples, cpu=1):
+    numReads = mat.shape[0]
+    if max_dist >= 1:
+        return ClusterReadsCore(mat, max_dist, min_samples, cpu)
+    labels = np.concatenate([labels, np.full(numReads - len(labels), -1, dtype=np.int64)])
+    core = np.concatenate([core, np.zeros(numReads - len(core), dtype=bool)])
+    nextLabel = max(labels.max() + 1, 0) if numReads > 0 else 0
+    graph = CorrelationRadiusGraph(mat, max_dist, rows=affected)
+    # DBSCAN counts the read itself as a neighbor, stored or not
+    self_stored = np.asarray(graph[np.arange(len(affected)), affected]).ravel() > 0
+    core[affected] = np.diff(graph.indptr) + ~self_stored >= min_samples
+    isAffected = np.zeros(numReads, dtype=bool)
+    isAffected[affected] = True
+    prevLabels = labels[affected].copy()
+    labels[affected] = -1
+
+    # Groups of the affected core reads connected within max_dist
+    coreAffected = affected[core[affected]]
+    coreGraph = graph[core[affected]][:, coreAffected]
+    numGroups, groups = connected_components(coreGraph, directed=False)
+    groupLinks = [Counter() for i in range(numGroups)]
+    coo = graph[core[affected]].tocoo()
+    linked = core[coo.col] & ~isAffected[coo.col] & (labels[coo.col] >= 0)
+    for group, label in zip(groups[coo.row[linked]], labels[coo.col[linked]]):
+        groupLinks[group][label] += 1
+    # Groups of affected reads alone keep their most common previous bin, if still free
+    groupPrev = [Counter() for i in range(numGroups)]
+    for group, label in zip(groups, prevLabels[core[affected]]):
+        if label >= 0:
+            groupPrev[group][label] += 1
+    usedLabels = set(labels[labels >= 0].tolist())
+    groupLabels = np.empty(numGroups, dtype=np.int64)
+    for group in range(numGroups):
+        prev = [label for label, count in groupPrev[group].most_common() if label not in usedLabels]
+        if groupLinks[group]:
+            groupLabels[group] = groupLinks[group].most_common(1)[0][0]
+        elif prev:
+            groupLabels[group] = prev[0]
+            usedLabels.add(prev[0])
         else:
-            seq_record = seq_dict[df_bin_reads['qseqid'].iloc[0]]
-            single_records.append(seq_record)
-            all_quantified_records.append(seq_record)
-    output_file = os.path.join(fastaDirRem, "singleton.fasta")
-    SeqIO.write(single_records, output_file, "fasta")
+            groupLabels[group] = nextLabel
+            nextLabel += 1
+    labels[coreAffected] = groupLabels[groups]
 
-    output_file = os.path.join(outDir, "identified_quantified_reads.fasta")
-    SeqIO.write(all_quantified_records, output_file, "fasta")
+    # Border reads, affected or noise of the model, join the bin of their nearest core read
+    for i, read in enumerate(affected):
+        if core[read]:
+            continue
+        cols = graph.indices[graph.indptr[i]:graph.indptr[i + 1]]
+        dist = graph.data[graph.indptr[i]:graph.indptr[i + 1]]
+        cand = core[cols] & (labels[cols] >= 0)
+        if cand.any():
+            labels[read] = labels[cols[cand][np.argmin(dist[cand])]]
+    coo = graph.tocoo()
+    border = core[affected[coo.row]] & ~isAffected[coo.col] & (labels[coo.col] < 0)
+    order = np.argsort(coo.data[border], kind="stable")
+    noise_reads, noise_idx = np.unique(coo.col[border][order], return_index=True)
+    labels[noise_reads] = labels[affected[coo.row[border][order][noise_idx]]]
+    return labels, core
 
+"""
+Function writes the bins of the reads: the read labels, the bin summary, the read and
+sample level bin abundances and the FASTA files of the bins. Returns the summary and read
+level abundance files.
+"""
+def ReportBins(read_names, cl, df_abundance, abundance_matrix, identifiedReadFile, readThresh, abundThresh):
+    read_labels = dict(zip(read_names, cl.tolist()))
+    out_file_json = re.sub("(.*)\\..*", r"\1_DBSCAN.json", abundance_matrix)
+    dir_path = os.path.dirname(os.path.realpath(abundance_matrix))
+    out_file_abund = os.path.join(dir_path,"ReadLevelAbundance.tsv")
+    out_file_summary = os.path.join(dir_path, "BinSummary.txt")
+    out_file_abund_sample = os.path.join(dir_path, "SampleAbundanceMatrix.tsv")
+    with open(out_file_json, "w") as h:
+        json.dump(read_labels, h, indent=4)
+
+    clusterLabels = cl.tolist()
+    noiseCluster = 0
+    if -1 in clusterLabels:
+        noiseCluster = 1
+    clusterIDs = Counter(clusterLabels).keys()
+    clusterCtr = len(Counter(clusterLabels).keys()) - noiseCluster
+
+    clusterFreq = Counter(clusterLabels).values()
+    clusterFreqGTThresh = [i for i in clusterFreq if i >= readThresh]
+    clusterIdsGTThresh = [i for i,j in zip(clusterIDs,clusterFreq) if j >= readThresh]
+
+    outF = open(out_file_summary, "w")
+    outF.write("Number of Reads Quantified: {0}\n".format(len(clusterLabels)))
+    outF.write("Number of Samples Quantified: {0}\n".format(len(Counter(df_abundance['Sample'].tolist()).keys())))
+    outF.write("Number of Bins: {0}\n".format(clusterCtr))
+    outF.write("Number of Bins with >= {0} Reads: {1}\n".format(readThresh,len(clusterFreqGTThresh)))
+    outF.write("Number of Bins with >= 5 Reads: {0}\n".format(len([i for i in clusterFreq if i >= 5])))
+    outF.write("Number of Bins with 2-4 Reads: {0}\n".format(len([i for i in clusterFreq if i >= 2 and i<=4])))
+    outF.write("Number of Singleton Read Bins: {0}\n".format(len([i for i in clusterFreq if i == 1])))
+
+    if len(clusterFreqGTThresh) > 0:
+        df_read_labels = pd.DataFrame(list(read_labels.items()),columns=['qseqid', 'bin'])
+        df_abundance = pd.merge(df_abundance, df_read_labels, how='inner')
+        PrintBinSeqs(clusterIDs,df_read_labels,identifiedReadFile,readThresh,dir_path)
+
+        df_abundance = df_abundance[df_abundance['bin'].isin(clusterIdsGTThresh)]
+        df_abundance.rename(columns={'count': 'ReadAbundance'}, inplace=True)
+
+        df_abundance_sample = df_abundance.groupby(['Sample', 'bin'])['ReadAbundance'].sum().reset_index()
+        df_abundance_sample.rename(columns={'ReadAbundance': 'BinAbundance'}, inplace=True)
+
+        df_bins = df_abundance_sample.groupby(['bin'])['BinAbundance'].sum().reset_index()
+
+        outF.write("Average Bin Abundance of Bins with >= {0} Reads: {1}\n".format(readThresh,round(mean(df_bins['BinAbundance'].tolist()),2)))
+        outF.write("Maximum Bin Abundance of Bins with >= {0} Reads: {1}\n".format(readThresh,round(max(df_bins['BinAbundance'].tolist()),2)))
+        outF.write("Minimum Bin Abundance of Bins with >= {0} Reads: {1}\n".format(readThresh,round(min(df_bins['BinAbundance'].tolist()),2)))
+
+        df_abundance_sample = df_abundance_sample[df_abundance_sample['BinAbundance']>=abundThresh]
+        df_abundance_sample_pivot = df_abundance_sample.pivot_table(index='Sample', columns='bin',values='BinAbundance', fill_value=0)
+        df_abundance_sample_pivot.to_csv(out_file_abund_sample,sep='\t')
+        outF.write("Number of Bins with >= {0} Reads and Bin Abundance >= {1}: {2}\n".format(readThresh, abundThresh, len(df_abundance_sample_pivot.columns)))
+
+
+        df_abundance = pd.merge(df_abundance, df_abundance_sample, how='inner')
+        df_abundance['log10BinAdbundance'] = np.log10(df_abundance['BinAbundance'])
+        df_abundance.to_csv(out_file_abund, index=False,sep='\t')
+
+        outF.write("Average Number of Reads in Bins with >= {0} Reads: {1}\n".format(readThresh,round(mean(clusterFreqGTThresh),2)))
+        outF.write("Average Abundance of Bins with >= {0} Reads: {1}\n".format(readThresh,round(mean(clusterFreqGTThresh),2)))
+        outF.write("Number of Samples containing Bins with >= {0} Reads and Bin Abundance >= {1}: {2}\n".format(readThresh, abundThresh, len(Counter(df_abundance_sample['Sample'].tolist()).keys())))
+    else:
+        print("Metabgc-cluster detected only bins with very low abundance. No further analytics will be performed. Please adjust --min_reads_bin and --min_abund_bin.")
+    outF.close()
+    return out_file_summary,out_file_abund
+
+CLUSTER_SWEEP_DIR = "cluster_sweep"
+CLUSTER_SWEEP_TABLE = "ClusterSweep.tsv"
+
+"""
+Function returns the BinSummary.txt statistics of a labelling of the reads of the sparse
+abundance matrix as a dict, counted as in ReportBins.
+"""
+def BinStatistics(cl, mat, readThresh, abundThresh):
+    binIds, binReads = np.unique(cl, return_counts=True)
+    gtThresh = binReads >= readThresh
+    # Read x bin indicator of the bins with >= readThresh reads, summed into bin x sample abundances
+    binPos = np.searchsorted(binIds, cl)
+    inBin = gtThresh[binPos]
+    indicator = sparse.csr_matrix((np.ones(inBin.sum()), (np.flatnonzero(inBin), (np.cumsum(gtThresh) - 1)[binPos[inBin]])),
+                                  shape=(len(cl), int(gtThresh.sum())))
+    binSample = (indicator.T @ mat).toarray()
+    abundBins = (binSample >= abundThresh).any(axis=1)
+    return {"Reads": len(cl),
+            "Bins": len(binIds) - int((binIds == -1).any()),
+            "NoiseReads": int((cl == -1).sum()),
+            "BinsGTReadThresh": int(gtThresh.sum()),
+            "BinsGE5Reads": int((binReads >= 5).sum()),
+            "Bins2to4Reads": int(((binReads >= 2) & (binReads <= 4)).sum()),
+            "SingletonBins": int((binReads == 1).sum()),
+            "BinsGTReadThreshAbundThresh": int(abundBins.sum()),
+            "SamplesWithBins": int((binSample >= abundThresh).any(axis=0).sum()),
+            "AvgReadsGTReadThresh": round(float(binReads[gtThresh].mean()), 2) if gtThresh.any() else 0}
+
+"""
+Function runs DBSCAN for one point of the parameter sweep and saves the labels. The radius
+graph is that of the largest max_dist below 1, DBSCAN only follows its edges within
+max_dist. A max_dist of 1 or more clusters the abundance matrix with ClusterReads.
+"""
+def SweepClusterPoint(graphFile, matFile, max_dist, min_samples, labelFile):
+    if max_dist >= 1:
+        cl = ClusterReads(sparse.load_npz(matFile).tocsr(), max_dist, min_samples)
+    else:
+        graph = sparse.load_npz(graphFile).tocsr()
+        cl = DBSCAN(eps=max_dist, min_samples=min_samples, metric="precomputed").fit_predict(graph)
+    np.save(labelFile, cl)
+    return 0
+
+"""
+Function clusters the reads for all the (max_dist, min_samples) pairs of the grid, with
+the radius graph computed once at the largest max_dist below 1 and the points of the grid
+run in parallel. The labels of each point are saved in outDir, replacing those of an
+earlier sweep. Raises a RuntimeError if a point fails. Returns the data frame of the
+BinStatistics of the points.
+"""
+def SweepClusterReads(mat, max_dist_list, min_samples_list, readThresh, abundThresh, outDir, cpu=1):
+    os.makedirs(outDir, 0o777, True)
+    matFile = os.path.join(outDir, "abundance.npz")
+    graphFile = os.path.join(outDir, "graph.npz")
+    sparse.save_npz(matFile, mat)
+    graphDists = [max_dist for max_dist in max_dist_list if max_dist < 1]
+    if graphDists:
+        sparse.save_npz(graphFile, CorrelationRadiusGraph(mat, max(graphDists)))
+    taskList = []
+    labelFiles = {}
+    for max_dist in max_dist_list:
+        for min_samples in min_samples_list:
+            name = "DBSCAN_{0}_{1}".format(max_dist, min_samples)
+            labelFiles[(max_dist, min_samples)] = os.path.join(outDir, name + ".npy")
+            if os.path.exists(labelFiles[(max_dist, min_samples)]):
+                os.remove(labelFiles[(max_dist, min_samples)])
+            taskList.append(Task("cluster", name, SweepClusterPoint, graphFile, matFile, max_dist, min_samples,
+                                 labelFiles[(max_dist, min_samples)]))
+    checkResults(invoke_producer_consumer(taskList, cpu), "Cluster sweep")
+    rows = []
+    for (max_dist, min_samples), labelFile in labelFiles.items():
+        stats = {"max_dist": max_dist, "min_samples": min_samples}
+        stats.update(BinStatistics(np.load(labelFile), mat, readThresh, abundThresh))
+        rows.append(stats)
+    return pd.DataFrame(rows)
 
 def mbgccluster(abundance_matrix, abundance_table_pivot,
                 identifiedReadFile,
                 max_dist, min_samples,
                 readThresh, abundThresh, cpu):
     try:
-        df = pd.read_csv(abundance_matrix, delimiter="\t")
-        df_abundance = pd.read_csv(abundance_table_pivot, delimiter="\t")
-        mat = df.iloc[:,1:df.shape[1]].values
-        read_names = df.iloc[:,0].values
+        df_abundance = ReadTable(abundance_table_pivot)
+        df_abundance['Sample'] = df_abundance['Sample'].astype(str)
+        df_abundance['qseqid'] = df_abundance['qseqid'].astype(str)
+        read_names, sample_names, mat = SparseAbundance(df_abundance)
 
         #Run clustering
-        cl = DBSCAN(eps=max_dist, min_samples=min_samples, metric="correlation",
-                    algorithm="brute", n_jobs=cpu).fit_predict(mat)
+        cl, core = ClusterReadsCore(mat, max_dist, min_samples, cpu)
 
-        read_labels = dict(zip(read_names, cl.tolist()))
-        out_file_json = re.sub("(.*)\\..*", r"\1_DBSCAN.json", abundance_matrix)
+        # Saved for the incremental updates of the bins with new samples
         dir_path = os.path.dirname(os.path.realpath(abundance_matrix))
-        out_file_abund = os.path.join(dir_path,"ReadLevelAbundance.tsv")
-        out_file_summary = os.path.join(dir_path, "BinSummary.txt")
-        out_file_abund_sample = os.path.join(dir_path, "SampleAbundanceMatrix.tsv")
-        with open(out_file_json, "w") as h:
-            json.dump(read_labels, h, indent=4)
-
-        clusterLabels = cl.tolist()
-        noiseCluster = 0
-        if -1 in clusterLabels:
-            noiseCluster = 1
-        clusterIDs = Counter(clusterLabels).keys()
-        clusterCtr = len(Counter(clusterLabels).keys()) - noiseCluster
-
-        clusterFreq = Counter(clusterLabels).values()
-        clusterFreqGTThresh = [i for i in clusterFreq if i >= readThresh]
-        clusterIdsGTThresh = [i for i,j in zip(clusterIDs,clusterFreq) if j >= readThresh]
-
-        outF = open(out_file_summary, "w")
-        outF.write("Number of Reads Quantified: {0}\n".format(len(clusterLabels)))
-        outF.write("Number of Samples Quantified: {0}\n".format(len(Counter(df_abundance['Sample'].tolist()).keys())))
-        outF.write("Number of Bins: {0}\n".format(clusterCtr))
-        outF.write("Number of Bins with >= {0} Reads: {1}\n".format(readThresh,len(clusterFreqGTThresh)))
-        outF.write("Number of Bins with >= 5 Reads: {0}\n".format(len([i for i in clusterFreq if i >= 5])))
-        outF.write("Number of Bins with 2-4 Reads: {0}\n".format(len([i for i in clusterFreq if i >= 2 and i<=4])))
-        outF.write("Number of Singleton Read Bins: {0}\n".format(len([i for i in clusterFreq if i == 1])))
-
-        if len(clusterFreqGTThresh) > 0:
-            df_read_labels = pd.DataFrame(list(read_labels.items()),columns=['qseqid', 'bin'])
-            df_abundance = pd.merge(df_abundance, df_read_labels, how='inner')
-            PrintBinSeqs(clusterIDs,df_read_labels,identifiedReadFile,readThresh,dir_path)
-
-            df_abundance = df_abundance[df_abundance['bin'].isin(clusterIdsGTThresh)]
-            df_abundance.rename(columns={'count': 'ReadAbundance'}, inplace=True)
-
-            df_abundance_sample = df_abundance.groupby(['Sample', 'bin'])['ReadAbundance'].sum().reset_index()
-            df_abundance_sample.rename(columns={'ReadAbundance': 'BinAbundance'}, inplace=True)
-
-            df_bins = df_abundance_sample.groupby(['bin'])['BinAbundance'].sum().reset_index()
-
-            outF.write("Average Bin Abundance of Bins with >= {0} Reads: {1}\n".format(readThresh,round(mean(df_bins['BinAbundance'].tolist()),2)))
-            outF.write("Maximum Bin Abundance of Bins with >= {0} Reads: {1}\n".format(readThresh,round(max(df_bins['BinAbundance'].tolist()),2)))
-            outF.write("Minimum Bin Abundance of Bins with >= {0} Reads: {1}\n".format(readThresh,round(min(df_bins['BinAbundance'].tolist()),2)))
-
-            df_abundance_sample = df_abundance_sample[df_abundance_sample['BinAbundance']>=abundThresh]
-            df_abundance_sample_pivot = df_abundance_sample.pivot_table(index='Sample', columns='bin',values='BinAbundance', fill_value=0)
-            df_abundance_sample_pivot.to_csv(out_file_abund_sample,sep='\t')
-            outF.write("Number of Bins with >= {0} Reads and Bin Abundance >= {1}: {2}\n".format(readThresh, abundThresh, len(df_abundance_sample_pivot.columns)))
-
-
-            df_abundance = pd.merge(df_abundance, df_abundance_sample, how='inner')
-            df_abundance['log10BinAdbundance'] = np.log10(df_abundance['BinAbundance'])
-            df_abundance.to_csv(out_file_abund, index=False,sep='\t')
-
-            outF.write("Average Number of Reads in Bins with >= {0} Reads: {1}\n".format(readThresh,round(mean(clusterFreqGTThresh),2)))
-            outF.write("Average Abundance of Bins with >= {0} Reads: {1}\n".format(readThresh,round(mean(clusterFreqGTThresh),2)))
-            outF.write("Number of Samples containing Bins with >= {0} Reads and Bin Abundance >= {1}: {2}\n".format(readThresh, abundThresh, len(Counter(df_abundance_sample['Sample'].tolist()).keys())))
-        else:
-            print("Metabgc-cluster detected only bins with very low abundance. No further analytics will be performed. Please adjust --min_reads_bin and --min_abund_bin.")
-        outF.close()
-        return out_file_summary,out_file_abund
+        SaveClusterModel(dir_path, read_names, sample_names, mat, cl, core, max_dist, min_samples,
+                         [identifiedReadFile])
+        return ReportBins(read_names, cl, df_abundance, abundance_matrix, identifiedReadFile, readThresh, abundThresh)
     except:
         print("Metabgc-cluster has failed. Please check your inputs and contact support on : https://github.com/donia-lab/MetaBGC")
         exit()
+
+"""
+Function adds the samples of a new abundance table to the cluster model of a previous run,
+updating its bins with UpdateClusterLabels at the max_dist and min_samples of the model.
+The outputs of the cluster are written for all the samples of the model and the new table,
+with the updated model, in the directory of abundance_matrix.
+"""
+def mbgcclusterupdate(model_file, abundance_matrix, abundance_table_pivot,
+                      identifiedReadFile, readThresh, abundThresh, cpu):
+    model = LoadClusterModel(model_file)
+    df_new = ReadTable(abundance_table_pivot)
+    read_names, sample_names, mat, affected = AddSamples(model["reads"], model["samples"], model["matrix"], df_new)
+    cl, core = UpdateClusterLabels(mat, model["labels"], model["core"], affected,
+                                   model["max_dist"], model["min_samples"], cpu)
+    coo = mat.tocoo()
+    df_abundance = pd.DataFrame({"Sample": sample_names[coo.col], "qseqid": read_names[coo.row],
+                                 "count": coo.data.astype(np.int64)})
+    df_abundance = df_abundance.sort_values(["Sample", "qseqid"]).reset_index(drop=True)
+
+    dir_path = os.path.dirname(os.path.realpath(abundance_matrix))
+    SaveClusterModel(dir_path, read_names, sample_names, mat, cl, core, model["max_dist"], model["min_samples"],
+                     [model["read_fasta"], identifiedReadFile])
+    return ReportBins(read_names, cl, df_abundance, abundance_matrix,
+                      os.path.join(dir_path, CLUSTER_MODEL_READS), readThresh, abundThresh)
+
+"""
+Function runs the DBSCAN parameter sweep of SweepClusterReads on the abundance table and
+writes the comparison table ClusterSweep.tsv, with the labels of the points in the
+cluster_sweep directory, in the directory of abundance_matrix. Returns the table path.
+"""
+def mbgcclustersweep(abundance_matrix, abundance_table_pivot, max_dist_list, min_samples_list,
+                     readThresh, abundThresh, cpu):
+    df_abundance = ReadTable(abundance_table_pivot)
+    read_names, sample_names, mat = SparseAbundance(df_abundance)
+    dir_path = os.path.dirname(os.path.realpath(abundance_matrix))
+    df_sweep = SweepClusterReads(mat, max_dist_list, min_samples_list, readThresh, abundThresh,
+                                 os.path.join(dir_path, CLUSTER_SWEEP_DIR), cpu)
+    out_file_sweep = os.path.join(dir_path, CLUSTER_SWEEP_TABLE)
+    df_sweep.to_csv(out_file_sweep, index=False, sep='\t')
+    return out_file_sweep
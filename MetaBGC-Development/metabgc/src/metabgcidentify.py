@@ -7,54 +7,157 @@
 #####################################################################################
 from metabgc.src.extractfastaseq import RunExtractDirectoryPar
 from metabgc.src.hmmerrunlib import *
+from metabgc.src.resultcache import SetProvidedResultDirectory
+from metabgc.src.tableio import TableFileName
+from metabgc.src.pipelinestate import IsTaskDone, MarkTaskDone
+from metabgc.src.hitstore import OpenHitStore, CloseHitStore, IsHitStoreComplete, IterHitChunks, HitRowCount
+from metabgc.src.seedprefilter import SeedAlignmentFiles, BuildSeedIndex, RunPrefilterDirectoryPar, ReadPrefilterStats
 import os
 import pandas as pd
 from pathlib import Path
 import logging
 
 
+HMM_RESULT_COLUMNS = ["readID", "sampleType", "Sample", "protType", "HMMScore", "window", "interval"]
+HMM_RESULT_DTYPES = {"readID": str, "sampleType": "category", "Sample": "category", "protType": "category",
+                     "HMMScore": "float64", "window": "category", "interval": "category"}
+HMM_RESULT_CHUNK_SIZE = 2000000
+HMM_READ_KEYS = ['readID', 'Sample', 'sampleType', 'protType']
+
+
 # Filter HMM results using predetermined spHMM models score cutoffs
 def filter_spHMM_data(spHMM_df, cutoff_df):
-    filter_spHMM_df = pd.DataFrame()
-    for index, row in cutoff_df.iterrows():
-        model_interval = cutoff_df.at[index, 'interval']
-        cutoff = cutoff_df.at[index, 'cutoff']
-        # filter spHMM dataframe with designated cutoffs
-        filter_df = spHMM_df.query("HMMScore >= @cutoff & interval == @model_interval").reset_index(drop=True)
-        filter_spHMM_df = filter_spHMM_df.append(filter_df)
-    return (filter_spHMM_df)
+    cutoff_df = cutoff_df[['interval', 'cutoff']].astype({'interval': str})
+    merged_df = spHMM_df.astype({'interval': str}).merge(cutoff_df, on='interval', how='inner')
+    filter_spHMM_df = merged_df[merged_df['HMMScore'] >= merged_df['cutoff']]
+    return filter_spHMM_df.drop(columns='cutoff').reset_index(drop=True)
 
 
-def runidentify(hmm_file, cutoff_file, filteredTableFile, identifyReadIdFile):
-    spHMM_df = pd.read_csv(hmm_file, sep="\t",
-                           names=["readID", "sampleType", "Sample", "protType", "HMMScore", "window", "interval"])
+# Remove the frame identifier added by the translation from the read IDs
+def strip_frame_suffix(read_ids):
+    return read_ids.str.rsplit('_', n=1).str[0]
 
-    # Reformat IDs to remove frame identifier from transeq
-    for i, row in spHMM_df.iterrows():
-        translated_read_id = spHMM_df.at[i, 'readID']
-        if translated_read_id.rfind('_') != -1:
-            nucl_read_id = translated_read_id[:translated_read_id.rfind('_')]
-            spHMM_df.at[i, 'readID'] = nucl_read_id
 
+def runidentify(hmm_file, cutoff_file, filteredTableFile, identifyReadIdFile):
     cutoff_df = pd.read_csv(cutoff_file, sep="\t", header=0)
-    spHMM_df_filtered = filter_spHMM_data(spHMM_df, cutoff_df)
+
+    # Threshold the HMM results chunk by chunk, only the hits passing a cutoff are kept
+    filtered_chunks = []
+    for spHMM_df in IterHitChunks(hmm_file, HMM_RESULT_COLUMNS, HMM_RESULT_DTYPES, HMM_RESULT_CHUNK_SIZE):
+        spHMM_df['readID'] = strip_frame_suffix(spHMM_df['readID'])
+        filtered_chunks.append(filter_spHMM_data(spHMM_df, cutoff_df))
+    spHMM_df_filtered = pd.concat(filtered_chunks, ignore_index=True)[HMM_RESULT_COLUMNS]
 
     # Filter duplicate readIDs and keep the highest HMM Score
-    spHMM_df_filtered_uniq = spHMM_df_filtered.groupby(['readID', 'Sample', 'sampleType', 'protType'])[
-        'HMMScore'].max().reset_index()
-    spHMM_df_filtered_uniq_interval = pd.merge(spHMM_df_filtered, spHMM_df_filtered_uniq, how='inner')
+    max_score = spHMM_df_filtered.groupby(HMM_READ_KEYS, observed=True)['HMMScore'].transform('max')
+    spHMM_df_filtered_uniq_interval = spHMM_df_filtered[spHMM_df_filtered['HMMScore'] == max_score]
 
     spHMM_df_filtered_uniq_interval.to_csv(filteredTableFile, sep="\t", index=False)
-    identifyReadIdList = list(set(spHMM_df_filtered_uniq_interval.readID.values.tolist()))
+    identifyReadIdList = spHMM_df_filtered_uniq_interval['readID'].unique()
 
     with open(identifyReadIdFile, 'w') as outfile:
         for readID in identifyReadIdList:
             outfile.write(readID + '\n')
 
 
+# Streaming version of runidentify with bounded memory. The hits passing the cutoffs are
+# written to a temporary file while the best score of each read is kept in a dict, then
+# a second pass writes the hits that have the best score of their read.
+def runidentifystreaming(hmm_file, cutoff_file, filteredTableFile, identifyReadIdFile):
+    cutoff_df = pd.read_csv(cutoff_file, sep="\t", header=0)
+    passedTableFile = filteredTableFile + ".tmp"
+    max_score_dict = {}
+    with open(passedTableFile, 'w') as outfile:
+        for spHMM_df in IterHitChunks(hmm_file, HMM_RESULT_COLUMNS, HMM_RESULT_DTYPES, HMM_RESULT_CHUNK_SIZE):
+            spHMM_df['readID'] = strip_frame_suffix(spHMM_df['readID'])
+            filter_df = filter_spHMM_data(spHMM_df, cutoff_df)[HMM_RESULT_COLUMNS]
+            if filter_df.empty:
+                continue
+            chunk_max = filter_df.groupby(HMM_READ_KEYS, observed=True)['HMMScore'].max()
+            for read_key, score in zip(chunk_max.index, chunk_max.values):
+                if score > max_score_dict.get(read_key, float('-inf')):
+                    max_score_dict[read_key] = score
+            filter_df.to_csv(outfile, sep="\t", index=False, header=False)
+
+    identifyReadIdSet = set()
+    with open(filteredTableFile, 'w') as outfile:
+        outfile.write("\t".join(HMM_RESULT_COLUMNS) + "\n")
+        if os.path.getsize(passedTableFile) > 0:
+            for filter_df in pd.read_csv(passedTableFile, sep="\t", names=HMM_RESULT_COLUMNS, dtype=HMM_RESULT_DTYPES,
+                                         chunksize=HMM_RESULT_CHUNK_SIZE):
+                read_keys = pd.MultiIndex.from_frame(filter_df[HMM_READ_KEYS].astype(str))
+                max_score = read_keys.map(max_score_dict.get).to_numpy(dtype=float)
+                filter_df = filter_df[filter_df['HMMScore'].to_numpy() == max_score]
+                filter_df.to_csv(outfile, sep="\t", index=False, header=False)
+                identifyReadIdSet.update(filter_df['readID'])
+    os.remove(passedTableFile)
+
+    with open(identifyReadIdFile, 'w') as outfile:
+        for readID in identifyReadIdSet:
+            outfile.write(readID + '\n')
+
+
+# Run the HMMER search of all the samples against the spHMMs, appending the hits to the
+# hit store. In stream mode, prot_seq_directory is where the translated reads are kept.
+def run_hmm_search(sphmm_directory, prot_family_name, cohort_name, nucl_seq_directory, prot_seq_directory,
+                   hmm_search_output_directory, hitStoreDir, single_pass, stream_translation, CPU_THREADS,
+                   seedIndex=None):
+    os.makedirs(hmm_search_output_directory, 0o777, True)
+    OpenHitStore(hitStoreDir)
+    if single_pass or stream_translation:
+        # Search each sample once against all the spHMMs
+        combinedHmmFile = os.path.join(hmm_search_output_directory, prot_family_name + "_Combined.hmm")
+        modelIntervalDict = CombineHMMModels(sphmm_directory, combinedHmmFile)
+        if stream_translation:
+            RunPCHMMStreamParallel(nucl_seq_directory, combinedHmmFile, modelIntervalDict, cohort_name,
+                                   prot_family_name, "30_10", hmm_search_output_directory, CPU_THREADS,
+                                   prot_seq_directory, hitStoreDir, seedIndex)
+        else:
+            RunPCHMMDirectoryMultiModel(prot_seq_directory, combinedHmmFile, modelIntervalDict, cohort_name,
+                                        prot_family_name, "30_10", hmm_search_output_directory, CPU_THREADS,
+                                        hitStoreDir)
+    else:
+        intervalHmmList = []
+        for filename in os.listdir(sphmm_directory):
+            fileBase = Path(filename).resolve().stem
+            if filename.endswith(".hmm"):
+                hmmInterval = fileBase.split("__")[2]
+                intervalHmmList.append((hmmInterval, os.path.join(sphmm_directory, filename)))
+        RunPCHMMDirectoryIntervals(prot_seq_directory, intervalHmmList, cohort_name, prot_family_name, "30_10",
+                                   hmm_search_output_directory, CPU_THREADS, hitStoreDir)
+
+
+# Write the recall of the prefiltered identification against the identification from
+# the search of all the reads, and the fraction of translated reads sent to HMMER.
+def write_prefilter_report(reportFile, unfilteredHMMResult, cutoff_file, identifyReadIds, prefilter_directory):
+    unfilteredTableFile = reportFile + ".filtered.tmp"
+    unfilteredReadIds = reportFile + ".ids.tmp"
+    runidentifystreaming(unfilteredHMMResult, cutoff_file, unfilteredTableFile, unfilteredReadIds)
+    with open(unfilteredReadIds) as infile:
+        unfilteredSet = set(infile.read().split())
+    with open(identifyReadIds) as infile:
+        prefilterSet = set(infile.read().split())
+    os.remove(unfilteredTableFile)
+    os.remove(unfilteredReadIds)
+    totalCtr, keptCtr = ReadPrefilterStats(prefilter_directory)
+    foundCtr = len(unfilteredSet & prefilterSet)
+    recall = foundCtr / len(unfilteredSet) if unfilteredSet else 1.0
+    with open(reportFile, 'w') as outfile:
+        outfile.write("translated_reads\t" + str(totalCtr) + "\n")
+        outfile.write("forwarded_reads\t" + str(keptCtr) + "\n")
+        outfile.write("forwarded_fraction\t" + "{0:.4f}".format(keptCtr / totalCtr if totalCtr else 0.0) + "\n")
+        outfile.write("identified_reads_unfiltered\t" + str(len(unfilteredSet)) + "\n")
+        outfile.write("identified_reads_prefilter\t" + str(len(prefilterSet)) + "\n")
+        outfile.write("missed_reads\t" + str(len(unfilteredSet - prefilterSet)) + "\n")
+        outfile.write("recall\t" + "{0:.4f}".format(recall) + "\n")
+    print("Metabgc-identify prefilter recall: " + "{0:.4f}".format(recall) + " (" + reportFile + ")")
+    return recall
+
+
 def mbgcidentify(sphmm_directory, cohort_name, nucl_seq_directory, prot_seq_directory,
                  seq_fmt, pair_fmt, r1_file_suffix, r2_file_suffix,
-                 prot_family_name, hmm_search_output_directory, output_directory, cpu):
+                 prot_family_name, hmm_search_output_directory, output_directory, cpu, single_pass=False,
+                 stream_translation=False, keep_prot_seq=False, prefilter=False, prefilter_report=False):
     try:
         if cpu is not None:
             CPU_THREADS = int(cpu)
@@ -68,13 +171,18 @@ def mbgcidentify(sphmm_directory, cohort_name, nucl_seq_directory, prot_seq_dire
 
         if hmm_search_output_directory is None:
             hmm_search_output_directory = os.path.join(output_directory, 'hmm_identify_search')
+        else:
+            SetProvidedResultDirectory(hmm_search_output_directory)
         identify_directory = os.path.join(output_directory, 'identify_result')
         os.makedirs(identify_directory, 0o777, True)
 
         fasta_seq_dir = os.path.join(output_directory, 'fasta_seq_result')
         identifyReadIds = identify_directory + os.sep + "CombinedReadIds.txt"
         filteredHMMResult = identify_directory + os.sep + "spHMM-filtered-results.txt"
-        allHMMResult = identify_directory + os.sep + "CombinedHmmSearch.txt"
+        allHMMResult = identify_directory + os.sep + "CombinedHmmSearch"
+        # Combined table of an earlier version
+        if os.path.exists(TableFileName(allHMMResult + ".txt")):
+            allHMMResult = TableFileName(allHMMResult + ".txt")
         multiFastaFile = identify_directory + os.sep + "identified-biosynthetic-reads.fasta"
 
         nucl_seq_directory = PreProcessReadsPar(nucl_seq_directory,
@@ -84,39 +192,51 @@ def mbgcidentify(sphmm_directory, cohort_name, nucl_seq_directory, prot_seq_dire
                                                 output_directory,
                                                 CPU_THREADS)
 
-        # Translate nucleotide seq
-        if not os.path.isdir(prot_seq_directory):
+        # Translate nucleotide seq, unless the translation is piped straight into the search
+        stream_translation = stream_translation and not os.path.isdir(prot_seq_directory)
+        if stream_translation:
+            prot_seq_directory = None
+            if keep_prot_seq:
+                prot_seq_directory = os.path.join(output_directory, 'prot_seq_dir')
+                os.makedirs(prot_seq_directory, 0o777, True)
+        elif not os.path.isdir(prot_seq_directory):
             prot_seq_directory = TranseqReadsDir(output_directory, nucl_seq_directory, CPU_THREADS)
 
+        # Seed index of the prefilter
+        seedIndex = None
+        if prefilter:
+            fasFileList = SeedAlignmentFiles(sphmm_directory)
+            if fasFileList:
+                seedIndex = BuildSeedIndex(fasFileList)
+            else:
+                print("Metabgc-identify did not find the spHMM seed alignments (.fas), the prefilter is disabled.")
+                prefilter_report = False
+
         # HMMER search
-        if not os.path.exists(multiFastaFile):
-            if not os.path.exists(allHMMResult):
-                os.makedirs(hmm_search_output_directory, 0o777, True)
-                for filename in os.listdir(sphmm_directory):
-                    fileBase = Path(filename).resolve().stem
-                    if filename.endswith(".hmm"):
-                        hmmInterval = fileBase.split("__")[2]
-                        hmmfilename = os.path.join(sphmm_directory, filename)
-                        RunPCHMMDirectoryParallel(prot_seq_directory, hmmfilename, cohort_name, prot_family_name, "30_10",
-                                                hmmInterval,
-                                                hmm_search_output_directory, CPU_THREADS)
-                found_hit_ctr = 0
-                with open(allHMMResult, 'w') as outfile:
-                    for subdir, dirs, files in os.walk(hmm_search_output_directory):
-                        for file in files:
-                            filePath = os.path.join(subdir, file)
-                            if re.match(r".*txt$", file) and os.path.getsize(filePath) > 0:
-                                with open(filePath) as infile:
-                                    for line in infile:
-                                        outfile.write(line)
-                                        found_hit_ctr = found_hit_ctr + 1
+        if not IsTaskDone(multiFastaFile):
+            if not os.path.isfile(allHMMResult) and not IsHitStoreComplete(allHMMResult):
+                search_prot_directory = prot_seq_directory
+                prefilter_directory = hmm_search_output_directory
+                if seedIndex is not None and not stream_translation:
+                    prefilter_directory = os.path.join(output_directory, 'prefilter_prot_seq')
+                    search_prot_directory = RunPrefilterDirectoryPar(prot_seq_directory, seedIndex, prefilter_directory,
+                                                                     CPU_THREADS)
+                run_hmm_search(sphmm_directory, prot_family_name, cohort_name, nucl_seq_directory, search_prot_directory,
+                               hmm_search_output_directory, allHMMResult, single_pass, stream_translation,
+                               CPU_THREADS, seedIndex)
+                found_hit_ctr = HitRowCount(allHMMResult)
                 if found_hit_ctr == 0:
                     logging.info("Metabgc-identify has failed to identify any reads for this protein family model. "
                                  "Please try with a different metagenome.")
                     print("Metabgc-identify has failed to identify any reads for this protein family model. "
                         "Please try with a different metagenome.")
                     exit()
+                CloseHitStore(allHMMResult)
                 print("Metabgc-identify HMMER search is complete.")
+                if seedIndex is not None:
+                    totalCtr, keptCtr = ReadPrefilterStats(prefilter_directory)
+                    print("Metabgc-identify prefilter forwarded " + str(keptCtr) + " of " + str(totalCtr) +
+                          " translated reads to HMMER.")
             else:
                 print("Metabgc-identify is using the existing HMMER search result found.")
 
@@ -126,11 +246,27 @@ def mbgcidentify(sphmm_directory, cohort_name, nucl_seq_directory, prot_seq_dire
                 raise
 
             ##Run identify thresholding
-            runidentify(allHMMResult, cutoff_file, filteredHMMResult, identifyReadIds)
+            runidentifystreaming(allHMMResult, cutoff_file, filteredHMMResult, identifyReadIds)
+
+            # Recall of the prefilter against a search of all the reads
+            if prefilter_report and seedIndex is not None:
+                unfilteredHMMResult = identify_directory + os.sep + "CombinedHmmSearch_Unfiltered"
+                if not IsHitStoreComplete(unfilteredHMMResult):
+                    unfiltered_search_directory = hmm_search_output_directory.rstrip(os.sep) + "_unfiltered"
+                    run_hmm_search(sphmm_directory, prot_family_name, cohort_name, nucl_seq_directory,
+                                   None if stream_translation else prot_seq_directory,
+                                   unfiltered_search_directory, unfilteredHMMResult, single_pass, stream_translation,
+                                   CPU_THREADS)
+                    CloseHitStore(unfilteredHMMResult)
+                prefilter_directory = hmm_search_output_directory if stream_translation \
+                    else os.path.join(output_directory, 'prefilter_prot_seq')
+                write_prefilter_report(os.path.join(identify_directory, "prefilter-recall-report.txt"),
+                                       unfilteredHMMResult, cutoff_file, identifyReadIds, prefilter_directory)
 
             os.makedirs(fasta_seq_dir, 0o777, True)
             RunExtractDirectoryPar(nucl_seq_directory, filteredHMMResult, fasta_seq_dir, multiFastaFile, "fasta",
                                    CPU_THREADS)
+            MarkTaskDone(multiFastaFile)
         else:
             print("Metabgc-identify is returning the existing identified reads found.")
         return multiFastaFile
@@ -7,11 +7,17 @@
 #####################################################################################
 from metabgc.src.utils import *
 from metabgc.src.blastrunlib import *
+from metabgc.src.kmerrecruit import RunPCKmerRecruit
+import numpy as np
+from scipy import sparse
+from metabgc.src.tableio import WriteTable, WriteTableBlocks, ReadTable, TableFileName
+from metabgc.src.pipelinestate import IsTaskDone, MarkTaskDone
+from metabgc.src.resultcache import SetProvidedResultDirectory
 
 
 
 def combine_blast_results(blast_dir_path, combinedBLASTFile, cohort_name):
-	filenames = [os.path.join(blast_dir_path, f) for f in os.listdir(blast_dir_path) if os.path.isfile(os.path.join(blast_dir_path, f)) and os.path.getsize(os.path.join(blast_dir_path, f)) > 0]
+	filenames = [os.path.join(blast_dir_path, f) for f in os.listdir(blast_dir_path) if f.endswith(".txt") and os.path.isfile(os.path.join(blast_dir_path, f)) and os.path.getsize(os.path.join(blast_dir_path, f)) > 0]
 	tabular_colnames = "sseqid slen sstart send qseqid qlen qstart qend qcovs pident evalue"
 	df_colnames = tabular_colnames.split()
 	list_of_dfs = [pd.read_csv(filename, names=df_colnames, header=None, delim_whitespace=True) for filename in filenames]
@@ -19,21 +25,86 @@ def combine_blast_results(blast_dir_path, combinedBLASTFile, cohort_name):
 		dataframe['Sample'] = os.path.basename(filename).split(".txt")[0]
 		dataframe['cohort'] = cohort_name
 	combined_df = pd.concat(list_of_dfs, ignore_index=True)
-	combined_df.to_csv(combinedBLASTFile, index=False, sep='\t', header=False)
+	WriteTable(combined_df, combinedBLASTFile)
 	numOfRows = combined_df.shape[0]
 	return 	numOfRows
 
 def create_clustering_file(blast_result,abundFile,abundWideFile):
-	all_domains_blast_df = pd.read_csv(blast_result, sep="\t",
+	all_domains_blast_df = ReadTable(blast_result,
 						   names=["sseqid", "slen","sstart", "send", "qseqid", "qlen", "qstart", "qend", "qcovs", "pident"," evalue", "Sample", "cohort"])
-	all_domains_blast_df_count = all_domains_blast_df.groupby(['Sample','qseqid']).qseqid.agg('count').to_frame('count').reset_index()
-	all_domains_blast_df_count_table = all_domains_blast_df_count.pivot_table(index='qseqid', columns='Sample', values='count',fill_value=0)
-	all_domains_blast_df_count_table.to_csv(abundFile,sep='\t')
-	all_domains_blast_df_count.to_csv(abundWideFile, index=False,sep='\t')
+	all_domains_blast_df_count = all_domains_blast_df.groupby(['Sample','qseqid'], observed=True).qseqid.agg('count').to_frame('count').reset_index()
+	all_domains_blast_df_count_table = all_domains_blast_df_count.pivot_table(index='qseqid', columns='Sample', values='count',fill_value=0, observed=True)
+	all_domains_blast_df_count_table.columns = all_domains_blast_df_count_table.columns.astype(str)
+	WriteTable(all_domains_blast_df_count_table.reset_index(), abundFile, header=True)
+	WriteTable(all_domains_blast_df_count, abundWideFile, header=True)
+
+"""
+Function counts the hits of each (Sample, qseqid) while reading each BLAST output once, in
+chunks of its qseqid column. Returns the sorted read ids, the sorted sample names and the
+sparse read x sample matrix of the counts.
+"""
+def count_blast_hits(blast_dir_path, chunkSize=1000000):
+	filenames = sorted(os.path.join(blast_dir_path, f) for f in os.listdir(blast_dir_path) if f.endswith(".txt") and os.path.isfile(os.path.join(blast_dir_path, f)) and os.path.getsize(os.path.join(blast_dir_path, f)) > 0)
+	read_index_dict = {}
+	sample_list = []
+	row_list = []
+	col_list = []
+	count_list = []
+	for filename in filenames:
+		sample_counts = None
+		for chunk in pd.read_csv(filename, sep='\t', header=None, usecols=[4], dtype=str, chunksize=chunkSize):
+			chunk_counts = chunk[4].value_counts()
+			sample_counts = chunk_counts if sample_counts is None else sample_counts.add(chunk_counts, fill_value=0)
+		if sample_counts is None:
+			continue
+		col = len(sample_list)
+		sample_list.append(os.path.basename(filename).split(".txt")[0])
+		for read_id in sample_counts.index:
+			if read_id not in read_index_dict:
+				read_index_dict[read_id] = len(read_index_dict)
+		row_list.append(np.fromiter((read_index_dict[read_id] for read_id in sample_counts.index), dtype=np.int64, count=len(sample_counts)))
+		col_list.append(np.full(len(sample_counts), col, dtype=np.int64))
+		count_list.append(sample_counts.to_numpy(dtype=np.int64))
+	read_list = list(read_index_dict)
+	if not count_list:
+		return [], [], sparse.csr_matrix((0, 0), dtype=np.int64)
+	count_matrix = sparse.coo_matrix((np.concatenate(count_list), (np.concatenate(row_list), np.concatenate(col_list))),
+									 shape=(len(read_list), len(sample_list))).tocsr()
+	# Sorted rows and columns, as in a pivot table
+	read_order = np.argsort(np.array(read_list, dtype=object), kind="stable")
+	sample_order = np.argsort(np.array(sample_list, dtype=object), kind="stable")
+	count_matrix = count_matrix[read_order][:, sample_order]
+	return [read_list[i] for i in read_order], [sample_list[i] for i in sample_order], count_matrix
+
+ABUND_BLOCK_ROWS = 2000
+
+"""
+Function returns the read x sample table of the sparse counts as data frames of blockRows
+reads, so the dense table is never built in full.
+"""
+def abundance_table_blocks(read_list, sample_list, count_matrix, blockRows=ABUND_BLOCK_ROWS):
+	columns = [str(sample) for sample in sample_list]
+	for start in range(0, max(count_matrix.shape[0], 1), blockRows):
+		abund_df = pd.DataFrame(count_matrix[start:start + blockRows].toarray(), columns=columns)
+		abund_df.insert(0, 'qseqid', read_list[start:start + blockRows])
+		yield abund_df
+
+"""
+Function writes the abundance tables of the (Sample, qseqid) counts: the read x sample
+table, written by blocks of reads, and the long table of the non zero counts.
+"""
+def write_abundance_tables(read_list, sample_list, count_matrix, abundFile, abundWideFile):
+	WriteTableBlocks(abundance_table_blocks(read_list, sample_list, count_matrix), abundFile, header=True)
+	count_coo = count_matrix.tocoo()
+	order = np.lexsort((count_coo.row, count_coo.col))
+	wide_df = pd.DataFrame({'Sample': np.array(sample_list, dtype=object)[count_coo.col[order]] if len(order) else [],
+							'qseqid': np.array(read_list, dtype=object)[count_coo.row[order]] if len(order) else [],
+							'count': count_coo.data[order]})
+	WriteTable(wide_df, abundWideFile, header=True)
 
 def mbgcquantify(identify_fasta, prot_family_name, cohort_name, nucl_seq_directory,
              seq_fmt, pair_fmt, r1_file_suffix, r2_file_suffix,blast_db_directory_map_file,
-			 blastn_search_directory,output_directory, cpu):
+			 blastn_search_directory,output_directory, cpu, inverted_blast=False, recruit_method="blastn"):
 	try:
 		CPU_THREADS = 4
 		if cpu is not None:
@@ -48,9 +119,10 @@ def mbgcquantify(identify_fasta, prot_family_name, cohort_name, nucl_seq_directo
 
 		if blastn_search_directory is None:
 			blastn_search_directory = os.path.join(output_directory, 'quantify_blastn_result')
-		combinedBLASTFile = os.path.join(output_directory, "CombinedQuantifyBLAST.txt")
-		abundFile = os.path.join(output_directory, "unique-biosynthetic-reads-abundance-table.txt")
-		abundWideFile = os.path.join(output_directory, "unique-biosynthetic-reads-abundance-table-wide.txt")
+		else:
+			SetProvidedResultDirectory(blastn_search_directory)
+		abundFile = TableFileName(os.path.join(output_directory, "unique-biosynthetic-reads-abundance-table.txt"))
+		abundWideFile = TableFileName(os.path.join(output_directory, "unique-biosynthetic-reads-abundance-table-wide.txt"))
 
 
 		nucl_seq_directory = PreProcessReadsPar(nucl_seq_directory, seq_fmt, pair_fmt,
@@ -58,25 +130,38 @@ def mbgcquantify(identify_fasta, prot_family_name, cohort_name, nucl_seq_directo
 											 output_directory, CPU_THREADS)
 
 		cdHitFile = os.path.join(output_directory,"CombinedIDFASTASeqs_Drep.fasta")
-		try:
-			runCDHit(identify_fasta,cdHitFile,CPU_THREADS)
-		except:
-			print("Metabgc-quantify has failed during clustering of identified reads.")
-			raise
+		if not IsTaskDone(cdHitFile):
+			try:
+				status = runCDHit(identify_fasta,cdHitFile,CPU_THREADS)
+			except:
+				print("Metabgc-quantify has failed during clustering of identified reads.")
+				raise
+			if status == 0 and os.path.exists(cdHitFile):
+				MarkTaskDone(cdHitFile)
 
 		if not os.path.exists(blastn_search_directory):
 			os.makedirs(blastn_search_directory, 0o777, True)
 
-		RunPCMakeDBandBlastN(nucl_seq_directory, blast_db_directory_map_file,
-							 cdHitFile, "blastn", "-dust no -max_target_seqs 1000000 -perc_identity 95.0 -qcov_hsp_perc 50 -window_size 11 -outfmt \"6 sseqid slen sstart send qseqid qlen qstart qend pident evalue\" ",
-							 blastn_search_directory, CPU_THREADS)
+		if recruit_method == "kmer":
+			# The reads are recruited in process with the k-mer index of the identified reads
+			RunPCKmerRecruit(nucl_seq_directory, cdHitFile, blastn_search_directory, CPU_THREADS)
+		elif inverted_blast:
+			# The sample reads are the queries of one database of the identified reads
+			RunPCInvertedBlastN(nucl_seq_directory, cdHitFile, "blastn",
+								"-dust no -max_target_seqs 1000000 -perc_identity 95.0 -window_size 11", 50,
+								blastn_search_directory, CPU_THREADS)
+		else:
+			RunPCMakeDBandBlastN(nucl_seq_directory, blast_db_directory_map_file,
+								 cdHitFile, "blastn", "-dust no -max_target_seqs 1000000 -perc_identity 95.0 -qcov_hsp_perc 50 -window_size 11 -outfmt \"6 sseqid slen sstart send qseqid qlen qstart qend pident evalue\" ",
+								 blastn_search_directory, CPU_THREADS)
 
-		blastCount = combine_blast_results(blastn_search_directory, combinedBLASTFile, cohort_name)
+		read_list, sample_list, count_matrix = count_blast_hits(blastn_search_directory)
+		blastCount = int(count_matrix.sum())
 		if blastCount == 0:
 			print("Metabgc-quantify could not find any reads during quanify BLAST search.")
 		else:
 			print("Metabgc-quantify found " + str(blastCount) + " BLAST hits.")
-		create_clustering_file(combinedBLASTFile, abundFile, abundWideFile)
+		write_abundance_tables(read_list, sample_list, count_matrix, abundFile, abundWideFile)
 		return abundFile, abundWideFile
 	except:
 		print("Metabgc-quantify has failed because no reads could be quantified. Please check your inputs and contact support on : https://github.com/donia-lab/MetaBGC")
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import hashlib
+import json
+import logging
+import os
+
+"""
+Checkpointed state of a MetaBGC run, so a killed run resumes at the unfinished work. Each
+task writes its output to a temporary file that is renamed into place once complete, then
+writes a .done marker next to it; an output without a marker is treated as partial and
+recomputed. The stages of metabgc search (identify, quantify, cluster) are recorded in a
+JSON manifest in the output directory, rewritten atomically, with the parameters and the
+outputs of each completed stage.
+"""
+
+MANIFEST_FILE = "metabgc_state.json"
+DONE_EXT = ".done"
+TMP_EXT = ".tmp"
+
+"""
+Function writes text to a file through a temporary file and a rename, so the file is either
+the old or the new content.
+"""
+def AtomicWriteText(filePath, text):
+    tmpFile = filePath + "." + str(os.getpid()) + TMP_EXT
+    with open(tmpFile, 'w') as outfile:
+        outfile.write(text)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(tmpFile, filePath)
+
+"""
+Function returns the temporary path an output is written to before it is complete.
+"""
+def TmpPath(outputFile):
+    return outputFile + TMP_EXT
+
+"""
+Function returns True if the task writing outputFile has completed.
+"""
+def IsTaskDone(outputFile):
+    return os.path.exists(outputFile) and os.path.exists(outputFile + DONE_EXT)
+
+"""
+Function writes the completion marker of outputFile.
+"""
+def MarkTaskDone(outputFile):
+    open(outputFile + DONE_EXT, 'w').close()
+
+"""
+Function removes the completion marker of outputFile, before it is rewritten.
+"""
+def ClearTaskDone(outputFile):
+    if os.path.exists(outputFile + DONE_EXT):
+        os.remove(outputFile + DONE_EXT)
+
+"""
+Function moves a completed temporary output into place and marks it done.
+"""
+def CommitOutput(tmpFile, outputFile):
+    os.replace(tmpFile, outputFile)
+    MarkTaskDone(outputFile)
+
+"""
+Function runs func(*args, tmpFile) unless outputFile is done, then commits the temporary
+output. A non-zero status or a missing output leaves the task unfinished. Returns the
+exit status.
+"""
+def runCheckpointed(outputFile, func, *args):
+    if IsTaskDone(outputFile):
+        logging.info("Skipping completed task: " + outputFile)
+        return 0
+    ClearTaskDone(outputFile)
+    tmpFile = TmpPath(outputFile)
+    status = func(*args, tmpFile)
+    if status not in (None, 0) or not os.path.exists(tmpFile):
+        logging.info("Task did not complete: " + outputFile)
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        return status if status else 1
+    CommitOutput(tmpFile, outputFile)
+    return 0
+
+def _ManifestPath(outputDir):
+    return os.path.join(outputDir, MANIFEST_FILE)
+
+"""
+Function returns the manifest of a run, empty if the run has not started.
+"""
+def LoadManifest(outputDir):
+    manifestPath = _ManifestPath(outputDir)
+    if os.path.exists(manifestPath):
+        with open(manifestPath) as infile:
+            return json.load(infile)
+    return {"stages": {}}
+
+def _SaveManifest(outputDir, manifest):
+    AtomicWriteText(_ManifestPath(outputDir), json.dumps(manifest, indent=2, sort_keys=True))
+
+"""
+Function returns the key of the parameters of a stage.
+"""
+def StageKey(params):
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+"""
+Function returns True if the stage completed with the same parameters and its outputs
+still exist.
+"""
+def IsStageDone(outputDir, stage, params):
+    stageDict = LoadManifest(outputDir)["stages"].get(stage)
+    if not stageDict or stageDict.get("status") != "done" or stageDict.get("key") != StageKey(params):
+        return False
+    return all(os.path.exists(path) for path in stageDict.get("outputs", {}).values())
+
+"""
+Function returns the dict of outputs of a completed stage.
+"""
+def StageOutputs(outputDir, stage):
+    return LoadManifest(outputDir)["stages"][stage]["outputs"]
+
+"""
+Function records that a stage is running.
+"""
+def MarkStageStarted(outputDir, stage, params):
+    manifest = LoadManifest(outputDir)
+    manifest["stages"][stage] = {"status": "running", "key": StageKey(params), "outputs": {}}
+    _SaveManifest(outputDir, manifest)
+
+"""
+Function records a completed stage with its parameters and outputs.
+"""
+def MarkStageDone(outputDir, stage, params, outputs):
+    manifest = LoadManifest(outputDir)
+    manifest["stages"][stage] = {"status": "done", "key": StageKey(params), "outputs": outputs}
+    _SaveManifest(outputDir, manifest)
+
+"""
+Function runs a stage of a pipeline unless it completed with the same parameters, in
+which case its recorded outputs are returned. outputNames name the values returned by
+func(*args). The stage is only marked done when func returns; the stages raise when any of
+their tasks failed, so a resumed run reruns them and picks up the unfinished tasks.
+"""
+def RunStage(outputDir, stage, params, outputNames, func, *args):
+    if IsStageDone(outputDir, stage, params):
+        logging.info("Skipping completed stage: " + stage)
+        outputs = StageOutputs(outputDir, stage)
+        result = tuple(outputs[name] for name in outputNames)
+        return result if len(result) > 1 else result[0]
+    MarkStageStarted(outputDir, stage, params)
+    result = func(*args)
+    resultTuple = result if isinstance(result, tuple) else (result,)
+    MarkStageDone(outputDir, stage, params, dict(zip(outputNames, resultTuple)))
+    return result
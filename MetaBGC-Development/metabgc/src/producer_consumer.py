@@ -1,61 +1,313 @@
 import time
 import os
-import random
 import subprocess
 import logging
-from multiprocessing import Process, JoinableQueue, Lock
+from queue import Empty
+from multiprocessing import Process, JoinableQueue, Queue, SimpleQueue, Lock
+from metabgc.src.executionbackend import IsQueuedTask, RunQueuedTasks
 
-# The consumer function takes data off of the Queue and runs the command line
-def consumer(queue, lock):
+"""
+Task submitted to the scheduler. The taskType is one of hmmsearch, blastn, makeblastdb,
+transeq, extract or cmd and name identifies the task in the log. The callable func is
+run with args in a consumer process and returns an exit status (0 on success).
+A threaded task is also given the number of threads assigned to it by the scheduler, as
+the threads keyword argument of func. The size (e.g. input bytes) orders the tasks in the
+adaptive scheduler.
+"""
+class Task:
+    def __init__(self, taskType, name, func, *args):
+        self.taskType = taskType
+        self.name = name
+        self.func = func
+        self.args = args
+        self.size = 0
+        self.threaded = False
+        self.threads = 1
+
+    def run(self):
+        if self.threaded:
+            status = self.func(*self.args, threads=self.threads)
+        else:
+            status = self.func(*self.args)
+        if status is None:
+            return 0
+        return status
+
+"""
+Wall time, exit status and number of threads of a completed task.
+"""
+class TaskResult:
+    def __init__(self, taskType, name, status, wallTime, pid, threads=1):
+        self.taskType = taskType
+        self.name = name
+        self.status = status
+        self.wallTime = wallTime
+        self.pid = pid
+        self.threads = threads
+
+# Seconds between the checks of the consumers while waiting for a task result
+RESULT_POLL_SECS = 5
+
+"""
+Function runs a command line in the shell and returns its exit status.
+"""
+def runShellCmd(cmd):
+    return subprocess.call(cmd, shell=True)
+
+"""
+Function wraps a command line into a scheduler task.
+"""
+def ShellTask(taskType, cmd):
+    return Task(taskType, cmd, runShellCmd, cmd)
+
+"""
+Function returns a threaded task of the given size. The func is called with args and the
+threads keyword argument.
+"""
+def ThreadedTask(taskType, name, size, func, *args):
+    task = Task(taskType, name, func, *args)
+    task.size = size
+    task.threaded = True
+    return task
+
+# The consumer function takes tasks off of the Queue until it receives the stop sentinel
+# Start notices are written to start_queue without a feeder thread, so they are not lost if
+# the consumer is killed while running the task
+def consumer(queue, result_queue, lock, start_queue):
     # Synchronize access to the console
     with lock:
-        print('Starting consumer => {}'.format(os.getpid()))
-    # Run indefinitely
+        logging.info('Starting consumer => {}'.format(os.getpid()))
     while True:
-        time.sleep(random.randint(0, 10))
         # If the queue is empty, queue.get() will block until the queue has data
-        query_cmd = queue.get()
-        # Synchronize access to the console
+        task = queue.get()
+        if task is None:
+            queue.task_done()
+            break
         with lock:
-            logging.info('{} got {}'.format(os.getpid(), query_cmd))
+            logging.info('{} got {} task: {}'.format(os.getpid(), task.taskType, task.name))
+        t0 = time.time()
+        start_queue.put(TaskResult(task.taskType, task.name, None, t0, os.getpid(), task.threads))
         try:
-            subprocess.call(query_cmd, shell=True)
+            status = task.run()
         except Exception as e:
             with lock:
-                logging.info("Failed to execute " + query_cmd)
+                logging.info("Failed to execute " + task.taskType + " task " + task.name + ": " + str(e))
+            status = -1
+        result_queue.put(TaskResult(task.taskType, task.name, status, time.time() - t0, os.getpid(), task.threads))
         queue.task_done()
+    with lock:
+        logging.info('Stopping consumer => {}'.format(os.getpid()))
+
+"""
+Function returns the task results received from the consumers, waiting for at least one.
+The start notices of the tasks, results of status None with the start time as wallTime,
+are kept in running by consumer pid. A consumer that died is joined and passed with its
+index and start notice, None if it had not posted one, to restart, which starts its
+replacement and returns the results of the tasks it lost. Results of consumers that are
+no longer in consumers are dropped, as their tasks were reported lost. Returns an empty
+list if all the consumers have stopped.
+"""
+def collectResults(consumers, running, result_queue, start_queue, restart):
+    while True:
+        try:
+            result = result_queue.get(timeout=RESULT_POLL_SECS)
+        except Empty:
+            result = None
+        # The start notice of a task is always written before its result
+        while not start_queue.empty():
+            notice = start_queue.get()
+            running[notice.pid] = notice
+        if result is None:
+            lost = []
+            for i, c in enumerate(consumers):
+                if c.exitcode is None or c.exitcode == 0:
+                    continue
+                c.join()
+                lost.extend(restart(i, c, running.pop(c.pid, None)))
+            if lost or all(c.exitcode == 0 for c in consumers):
+                return lost
+            continue
+        running.pop(result.pid, None)
+        if any(c.pid == result.pid for c in consumers):
+            return [result]
 
-def invoke_producer_consumer(cmd_list, consumer_ctr):
-    print('Parent process staring...')
-    # Create the Queue object
+"""
+Function returns the result of a task lost with a consumer that died, with the exit code
+of the consumer as status.
+"""
+def lostResult(task, dead, startTime):
+    logging.info('Consumer {} died with exit code {} running {} task: {}'.format(
+        dead.pid, dead.exitcode, task.taskType, task.name))
+    return TaskResult(task.taskType, task.name, dead.exitcode, time.time() - startTime, dead.pid, task.threads)
+
+"""
+Function runs the tasks on a fixed pool of consumer processes. Tasks are dispatched as soon
+as a consumer is free and the consumers are stopped with a sentinel once the queue drains.
+Plain command strings are wrapped into tasks of type cmd. Returns the list of TaskResult.
+"""
+def invoke_producer_consumer(task_list, consumer_ctr, taskType="cmd"):
+    task_list = [ShellTask(taskType, task) if isinstance(task, str) else task for task in task_list]
+    if any(IsQueuedTask(task) for task in task_list):
+        return invoke_backend(task_list, consumer_ctr, invoke_producer_consumer)
+    if not task_list:
+        return []
+    consumer_ctr = max(1, min(consumer_ctr, len(task_list)))
+    # Create the Queue objects
     queue = JoinableQueue()
+    result_queue = Queue()
+    start_queue = SimpleQueue()
     # Create a lock object to synchronize resource access
     lock = Lock()
+    consumerArgs = (queue, result_queue, lock, start_queue)
     consumers = []
 
-    print('Setting up consumers.')
-    # Create consumer processes
+    logging.info('Starting {} consumers for {} tasks.'.format(consumer_ctr, len(task_list)))
     for i in range(consumer_ctr):
-        p = Process(target=consumer, args=(queue, lock))
+        p = Process(target=consumer, args=consumerArgs)
         consumers.append(p)
-    # Start the producers and consumer
-    # The Python VM will launch new independent processes for each Process object
-    print('Starting up consumer sub-processes.')
     for c in consumers:
         c.start()
 
-    print('Putting jobs in queue.')
-    # Create our producer processes by passing the producer function and it's arguments
-    for cmd_str in cmd_list:
-        queue.put(cmd_str)
+    for task in task_list:
+        queue.put(task)
+    for c in consumers:
+        queue.put(None)
 
-    # join() method that synchronizes our program
-    queue.join()
-    print('Stopping sub-processes and terminating.')
+    # Collect one result per task before joining so the result queue never blocks a consumer
+    def restart(i, dead, notice):
+        consumers[i] = Process(target=consumer, args=consumerArgs)
+        consumers[i].start()
+        return [lostResult(notice, dead, notice.wallTime)] if notice else []
+    results = []
+    running = {}
+    while len(results) < len(task_list):
+        received = collectResults(consumers, running, result_queue, start_queue, restart)
+        if not received:
+            break
+        for result in received:
+            logging.info('{} task {} finished in {:.2f}s with exit status {}.'.format(
+                result.taskType, result.name, result.wallTime, result.status))
+            results.append(result)
+    # Tasks taken by a consumer that died before its start notice have no result
+    missing = [task.name for task in task_list]
+    for result in results:
+        if result.name in missing:
+            missing.remove(result.name)
+    for name in missing:
+        task = next(task for task in task_list if task.name == name)
+        logging.info('No result for {} task: {}'.format(task.taskType, task.name))
+        results.append(TaskResult(task.taskType, task.name, -1, 0.0, None, task.threads))
     for c in consumers:
-        c.terminate()
+        c.join()
+
+    logResults(results)
+    return results
+
+"""
+Function runs the hmmsearch, blastn and makeblastdb tasks on the queue of the execution
+backend and the other tasks locally with invoke_local. Returns the list of TaskResult.
+"""
+def invoke_backend(task_list, ncpus, invoke_local):
+    queued_list = [task for task in task_list if IsQueuedTask(task)]
+    results = invoke_local([task for task in task_list if not IsQueuedTask(task)], ncpus)
+    queued_results = [TaskResult(r["taskType"], r["name"], r["status"], r["wallTime"], r["pid"], r["threads"])
+                      for r in RunQueuedTasks(queued_list, ncpus)]
+    logResults(queued_results)
+    return results + queued_results
+
+def logResults(results):
+    failed = [r for r in results if r.status != 0]
+    logging.info('Completed {} tasks, {} failed, total task time {:.2f}s.'.format(
+        len(results), len(failed), sum(r.wallTime for r in results)))
+    for r in failed:
+        logging.info('Failed {} task: {} (exit status {}).'.format(r.taskType, r.name, r.status))
 
-    print('Parent process exiting...')
+"""
+Function raises a RuntimeError naming the failed tasks if any task of the results did not
+exit with status 0, so the outputs of an incomplete stage are never marked complete.
+"""
+def checkResults(results, stage):
+    failed = [r for r in results if r.status != 0]
+    if failed:
+        raise RuntimeError('{} failed for {} of {} tasks: {}'.format(
+            stage, len(failed), len(results), ", ".join(r.name for r in failed)))
 
+"""
+Function returns the number of threads of the next task of the adaptive scheduler. A task
+gets the share of the cores matching its share of the pending work, and the free cores are
+split among the last tasks once there are fewer tasks than free cores.
+"""
+def taskThreads(task, pendingCtr, pendingSize, freeCores, totalCores):
+    threads = freeCores // pendingCtr
+    if pendingSize > 0:
+        threads = max(threads, int(round(totalCores * task.size / pendingSize)))
+    return max(1, min(threads, freeCores))
 
+"""
+Function runs the tasks largest first on a budget of ncpus cores. Each task is dispatched
+when cores are free, with the number of threads given by taskThreads, so the big samples
+start first and the tasks at the end of the queue use the cores left idle. The threads are
+passed to threaded tasks; other tasks use one core. Returns the list of TaskResult.
+"""
+def invoke_adaptive_scheduler(task_list, ncpus):
+    if any(IsQueuedTask(task) for task in task_list):
+        return invoke_backend(task_list, ncpus, invoke_adaptive_scheduler)
+    if not task_list:
+        return []
+    ncpus = max(1, ncpus)
+    pending = sorted(task_list, key=lambda task: task.size, reverse=True)
+    pendingSize = sum(task.size for task in pending)
+    result_queue = Queue()
+    start_queue = SimpleQueue()
+    lock = Lock()
+    # Each consumer has its own task queue, so the task of a consumer is known even if it
+    # dies before its start notice
+    queues = []
+    consumers = []
+    for i in range(min(ncpus, len(task_list))):
+        queues.append(JoinableQueue())
+        consumers.append(Process(target=consumer, args=(queues[i], result_queue, lock, start_queue)))
+    for c in consumers:
+        c.start()
+    # Index of consumer: (task, dispatch time)
+    assigned = {}
+    def restart(i, dead, notice):
+        queues[i] = JoinableQueue()
+        consumers[i] = Process(target=consumer, args=(queues[i], result_queue, lock, start_queue))
+        consumers[i].start()
+        if i not in assigned:
+            return []
+        task, startTime = assigned.pop(i)
+        return [lostResult(task, dead, notice.wallTime if notice else startTime)]
 
+    logging.info('Starting {} consumers for {} tasks on {} cores.'.format(len(consumers), len(task_list), ncpus))
+    results = []
+    freeCores = ncpus
+    runningCtr = 0
+    running = {}
+    while pending or runningCtr > 0:
+        while pending and freeCores > 0 and len(assigned) < len(consumers):
+            task = pending.pop(0)
+            task.threads = taskThreads(task, len(pending) + 1, pendingSize, freeCores, ncpus) if task.threaded else 1
+            pendingSize = pendingSize - task.size
+            freeCores = freeCores - task.threads
+            runningCtr = runningCtr + 1
+            logging.info('Dispatching {} task {} with {} threads.'.format(task.taskType, task.name, task.threads))
+            i = next(i for i in range(len(consumers)) if i not in assigned)
+            assigned[i] = (task, time.time())
+            queues[i].put(task)
+        for result in collectResults(consumers, running, result_queue, start_queue, restart):
+            for i, c in enumerate(consumers):
+                if c.pid == result.pid:
+                    assigned.pop(i, None)
+            logging.info('{} task {} finished in {:.2f}s with exit status {}.'.format(
+                result.taskType, result.name, result.wallTime, result.status))
+            freeCores = freeCores + result.threads
+            runningCtr = runningCtr - 1
+            results.append(result)
+    for q in queues:
+        q.put(None)
+    for c in consumers:
+        c.join()
+    logResults(results)
+    return results
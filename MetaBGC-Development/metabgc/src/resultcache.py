@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+from metabgc.src.pipelinestate import TmpPath
+
+"""
+Content-addressed cache of hmmsearch/hmmscan tables and BLAST outputs. A result is keyed by
+the content hash of its read and model inputs, the tool version and the search parameters,
+so the same reads preprocessed into another output directory have the same key. The content
+hash of a read file is memoized on its path, size and mtime in a sig directory, of the
+shared cache when one is set, else of the user cache directory (XDG_CACHE_HOME/metabgc,
+~/.cache/metabgc by default), so a file is only read again once it changes. The key is saved next to each output in a .key file, so an
+existing output is only reused when the key matches. When METABGC_CACHE_DIR is set, the
+outputs are also copied into that directory and reused across output directories. Outputs
+without a key are only reused from the search directories given by the user.
+"""
+
+CACHE_DIR_ENV = "METABGC_CACHE_DIR"
+PROVIDED_RESULT_DIRS_ENV = "METABGC_PROVIDED_RESULT_DIRS"
+KEY_FILE_EXT = ".key"
+
+_contentHashDict = {}
+_toolVersionDict = {}
+
+"""
+Function sets the shared cache directory for this process and its workers.
+"""
+def SetCacheDirectory(cacheDir):
+    if cacheDir:
+        os.makedirs(cacheDir, 0o777, True)
+        os.environ[CACHE_DIR_ENV] = os.path.abspath(cacheDir)
+
+"""
+Function returns the MetaBGC directory of the user cache.
+"""
+def UserCacheDirectory():
+    userCacheDir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(userCacheDir, "metabgc")
+
+"""
+Function returns the directory of the memoized content hashes.
+"""
+def ContentHashDirectory():
+    return os.path.join(os.environ.get(CACHE_DIR_ENV) or UserCacheDirectory(), "sig")
+
+"""
+Function records a search directory given by the user, whose outputs without a cache key
+were computed outside of MetaBGC and are reused as they are.
+"""
+def SetProvidedResultDirectory(resultDir):
+    if resultDir:
+        resultDirs = [d for d in os.environ.get(PROVIDED_RESULT_DIRS_ENV, "").split(os.pathsep) if d]
+        resultDirs.append(os.path.realpath(resultDir))
+        os.environ[PROVIDED_RESULT_DIRS_ENV] = os.pathsep.join(resultDirs)
+
+def _IsProvidedResult(outputFile):
+    resultDirs = os.environ.get(PROVIDED_RESULT_DIRS_ENV, "").split(os.pathsep)
+    return os.path.dirname(os.path.realpath(outputFile)) in resultDirs
+
+"""
+Function returns a signature of a large input file from its path, size and mtime.
+"""
+def FileSignature(filePath):
+    stat = os.stat(filePath)
+    return os.path.realpath(filePath) + ":" + str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+
+"""
+Function returns the signatures of the files of a directory tree, in path order, so a
+stage reading it reruns when a file is added, removed or replaced. Returns None if no
+directory is given.
+"""
+def DirectorySignature(dirPath):
+    if not dirPath:
+        return None
+    signatureList = []
+    for subdir, dirs, files in os.walk(dirPath):
+        dirs.sort()
+        signatureList.extend(FileSignature(os.path.join(subdir, file)) for file in sorted(files))
+    return signatureList
+
+"""
+Function returns the SHA-256 of a file's content, memoized on its signature.
+"""
+def FileContentHash(filePath):
+    signature = FileSignature(filePath)
+    if signature not in _contentHashDict:
+        sha = hashlib.sha256()
+        with open(filePath, 'rb') as infile:
+            for block in iter(lambda: infile.read(1024 * 1024), b''):
+                sha.update(block)
+        _contentHashDict[signature] = sha.hexdigest()
+    return _contentHashDict[signature]
+
+def _ReadMemo(sigFile):
+    if os.path.exists(sigFile):
+        with open(sigFile) as infile:
+            return infile.read().strip()
+    return None
+
+"""
+Function returns the content hash of a file, memoized on its signature in memoDir so a
+known file is not read again by later runs. The hash is computed under an exclusive flock
+of the signature, so the concurrent tasks of a sample read it once.
+"""
+def MemoizedContentHash(memoDir, filePath):
+    sigName = hashlib.sha256(FileSignature(filePath).encode()).hexdigest()
+    sigFile = os.path.join(memoDir, sigName)
+    contentHash = _ReadMemo(sigFile)
+    if contentHash:
+        return contentHash
+    lockDir = os.path.join(memoDir, "locks")
+    os.makedirs(lockDir, 0o777, True)
+    with open(os.path.join(lockDir, sigName + ".lock"), 'w') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            contentHash = _ReadMemo(sigFile)
+            if contentHash:
+                return contentHash
+            contentHash = FileContentHash(filePath)
+            tmpFile = sigFile + "." + str(os.getpid()) + ".tmp"
+            with open(tmpFile, 'w') as outfile:
+                outfile.write(contentHash)
+            os.replace(tmpFile, sigFile)
+            return contentHash
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+
+"""
+Function returns the content hash of an input file, memoized in ContentHashDirectory.
+"""
+def InputContentHash(filePath):
+    return MemoizedContentHash(ContentHashDirectory(), filePath)
+
+"""
+Function returns the version banner of a tool, or 'unknown' if it cannot be run.
+"""
+def ToolVersion(tool):
+    if tool not in _toolVersionDict:
+        version = "unknown"
+        for option in ("-version", "-h"):
+            try:
+                output = subprocess.run([tool, option], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                        timeout=60).stdout.decode(errors="replace")
+            except (OSError, subprocess.SubprocessError):
+                break
+            lines = [line.strip("# \t") for line in output.splitlines() if any(c.isdigit() for c in line)]
+            if lines:
+                version = lines[0]
+                break
+        _toolVersionDict[tool] = version
+    return _toolVersionDict[tool]
+
+"""
+Function returns the cache key of a result computed by tool from inputFiles and modelFiles
+with the given parameter string.
+"""
+def ResultKey(tool, inputFiles, modelFiles, params):
+    keyDict = {"tool": tool,
+               "version": ToolVersion(tool),
+               "inputs": [InputContentHash(f) for f in inputFiles],
+               "models": [InputContentHash(f) for f in modelFiles],
+               "params": params}
+    return hashlib.sha256(json.dumps(keyDict, sort_keys=True).encode()).hexdigest()
+
+def _CachePath(key, outputFile):
+    cacheDir = os.environ.get(CACHE_DIR_ENV)
+    if not cacheDir:
+        return None
+    return os.path.join(cacheDir, key[:2], key + os.path.splitext(outputFile)[1])
+
+def _ReadKey(outputFile):
+    keyFile = outputFile + KEY_FILE_EXT
+    if os.path.exists(keyFile):
+        with open(keyFile) as infile:
+            return infile.read().strip()
+    return None
+
+def _WriteKey(outputFile, key):
+    tmpFile = outputFile + KEY_FILE_EXT + ".tmp"
+    with open(tmpFile, 'w') as outfile:
+        outfile.write(key + "\n")
+    os.replace(tmpFile, outputFile + KEY_FILE_EXT)
+
+"""
+Function returns True if outputFile holds the result for key, restoring it from the shared
+cache directory if needed. Outputs with a different key are removed, as are the outputs
+without a key file (partial, foreign or of an older run) unless they are in a search
+directory given by the user.
+"""
+def IsCachedResult(outputFile, key):
+    if os.path.exists(outputFile):
+        existingKey = _ReadKey(outputFile)
+        if existingKey == key:
+            return True
+        if existingKey is None and _IsProvidedResult(outputFile):
+            logging.info("Using existing result of a provided search directory: " + outputFile)
+            return True
+    for staleFile in (outputFile, outputFile + KEY_FILE_EXT):
+        if os.path.exists(staleFile):
+            logging.info("Removing stale result: " + staleFile)
+            os.remove(staleFile)
+    cachePath = _CachePath(key, outputFile)
+    if cachePath and os.path.exists(cachePath):
+        tmpFile = outputFile + ".tmp"
+        shutil.copyfile(cachePath, tmpFile)
+        os.replace(tmpFile, outputFile)
+        _WriteKey(outputFile, key)
+        logging.info("Restored " + outputFile + " from cache: " + cachePath)
+        return True
+    return False
+
+"""
+Function records outputFile as the result for key and copies it into the shared cache
+directory if one is set.
+"""
+def StoreResult(outputFile, key):
+    _WriteKey(outputFile, key)
+    cachePath = _CachePath(key, outputFile)
+    if cachePath and not os.path.exists(cachePath):
+        os.makedirs(os.path.dirname(cachePath), 0o777, True)
+        tmpFile = cachePath + "." + str(os.getpid()) + ".tmp"
+        shutil.copyfile(outputFile, tmpFile)
+        os.replace(tmpFile, cachePath)
+
+"""
+Function runs a task writing the temporary path of outputFile, unless the result of key
+(tool, inputFiles, modelFiles, params) is cached. The key is computed in the task, so the
+inputs of the samples are hashed by the workers rather than in turn by the parent. The
+output is moved into place and stored when func returns 0. Returns the exit status.
+"""
+def RunCachedTask(outputFile, keyArgs, func, *args, **kwargs):
+    key = ResultKey(*keyArgs)
+    if IsCachedResult(outputFile, key):
+        logging.info("Using the existing result: " + outputFile)
+        return 0
+    status = func(*args, **kwargs)
+    if status == 0 and os.path.exists(TmpPath(outputFile)):
+        os.replace(TmpPath(outputFile), outputFile)
+        StoreResult(outputFile, key)
+    else:
+        if os.path.exists(TmpPath(outputFile)):
+            os.remove(TmpPath(outputFile))
+        if status == 0:
+            status = 1
+    return status
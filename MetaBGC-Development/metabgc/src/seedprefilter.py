@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import hashlib
+import os
+import re
+import logging
+import numpy as np
+from metabgc.src.producer_consumer import Task, invoke_producer_consumer, checkResults
+from metabgc.src.seqreader import ReadFastxBatches, SeqFileRegex, SeqFileStem
+
+"""
+Seed prefilter of the translated reads before the HMMER search. The ungapped sequences of
+the spHMM seed alignments (the .fas files written next to each spHMM by createsphmms) are
+recoded in a reduced protein alphabet and all their k-mers are put in a lookup table. Only
+the translated frames sharing at least minSeedHits k-mers with a seed are forwarded to
+HMMER. The k-mers of a block of frames are computed with array operations: each residue
+is a 4 bit code, so a k-mer is an integer index into the table.
+"""
+
+# Murphy et al. 10 letter alphabet. Residues outside these groups (X, *, gaps) break k-mers.
+REDUCED_ALPHABET_GROUPS = ["LVIMJ", "C", "A", "G", "ST", "P", "FYW", "EDNQBZ", "KR", "H"]
+SEED_KMER_LEN = 5
+SEED_MIN_HITS = 1
+PREFILTER_STATS_EXT = ".prefilter"
+
+def _BuildReducedCodes():
+    codes = np.zeros(256, dtype=np.uint32)
+    for groupCode, group in enumerate(REDUCED_ALPHABET_GROUPS, start=1):
+        for aa in group:
+            codes[ord(aa)] = groupCode
+            codes[ord(aa.lower())] = groupCode
+    return codes
+
+REDUCED_CODES = _BuildReducedCodes()
+
+"""
+Function returns the k-mer table indices of a byte string and the mask of the k-mers made
+only of residues of the reduced alphabet.
+"""
+def KmerCodes(seqBytes, k=SEED_KMER_LEN):
+    codes = REDUCED_CODES[np.frombuffer(seqBytes, dtype=np.uint8)]
+    numKmers = len(codes) - k + 1
+    if numKmers <= 0:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+    kmerCodes = np.zeros(numKmers, dtype=np.uint32)
+    for i in range(k):
+        kmerCodes = (kmerCodes << 4) | codes[i:i + numKmers]
+    invalid = np.concatenate(([0], np.cumsum(codes == 0)))
+    valid = (invalid[k:] - invalid[:numKmers]) == 0
+    return kmerCodes, valid
+
+"""
+Function returns the seed alignment (.fas) files of the spHMMs of a directory. The
+alignments are looked up next to each spHMM, then in the spHMMs directory of the build.
+"""
+def SeedAlignmentFiles(sphmmDir):
+    searchDirs = [sphmmDir, os.path.join(os.path.dirname(os.path.abspath(sphmmDir)), "spHMMs")]
+    fasFileList = []
+    for filename in sorted(os.listdir(sphmmDir)):
+        if not filename.endswith(".hmm"):
+            continue
+        fasName = os.path.splitext(filename)[0] + ".fas"
+        for searchDir in searchDirs:
+            if os.path.exists(os.path.join(searchDir, fasName)):
+                fasFileList.append(os.path.join(searchDir, fasName))
+                break
+        else:
+            logging.info("No seed alignment found for spHMM: " + filename)
+    return fasFileList
+
+"""
+Function builds the k-mer lookup table of the ungapped seed alignment sequences.
+"""
+def BuildSeedIndex(fasFileList, k=SEED_KMER_LEN):
+    seedIndex = np.zeros(1 << (4 * k), dtype=bool)
+    for fasFile in fasFileList:
+        for headerList, seqList in ReadFastxBatches(fasFile, "fasta"):
+            for seq in seqList:
+                kmerCodes, valid = KmerCodes(seq.replace(b'-', b'').replace(b'.', b''), k)
+                seedIndex[kmerCodes[valid]] = True
+    logging.info("Seed index of {0} k-mers built from {1} alignments.".format(int(seedIndex.sum()), len(fasFileList)))
+    return seedIndex
+
+"""
+Function returns a digest of a seed index, used in the cache key of prefiltered searches.
+"""
+def SeedIndexKey(seedIndex):
+    return hashlib.sha256(np.packbits(seedIndex).tobytes()).hexdigest()[:16]
+
+"""
+Function returns the boolean mask of the sequences of seqList with at least minSeedHits
+k-mers in the seed index.
+"""
+def SeedHitMask(seqList, seedIndex, k=SEED_KMER_LEN, minSeedHits=SEED_MIN_HITS):
+    if not seqList:
+        return np.zeros(0, dtype=bool)
+    # Sequences are joined with a residue outside the alphabet so no k-mer spans two of them
+    kmerCodes, valid = KmerCodes(b'*'.join(seqList), k)
+    hitCumSum = np.concatenate(([0], np.cumsum(valid & seedIndex[kmerCodes])))
+    seqLens = np.array([len(seq) for seq in seqList], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(seqLens + 1)[:-1]))
+    ends = starts + seqLens - k + 1
+    starts = np.minimum(starts, len(hitCumSum) - 1)
+    ends = np.clip(ends, starts, len(hitCumSum) - 1)
+    return (hitCumSum[ends] - hitCumSum[starts]) >= minSeedHits
+
+"""
+Function filters a protein FASTA byte string. Returns the FASTA bytes of the records with
+seed hits, the number of records read and the number kept.
+"""
+def FilterFastaBytes(fastaBytes, seedIndex, k=SEED_KMER_LEN, minSeedHits=SEED_MIN_HITS):
+    records = fastaBytes.strip().lstrip(b'>').split(b'\n>') if fastaBytes.strip() else []
+    headerList = []
+    seqList = []
+    for record in records:
+        header, sep, seq = record.partition(b'\n')
+        headerList.append(header)
+        seqList.append(seq.replace(b'\n', b''))
+    mask = SeedHitMask(seqList, seedIndex, k, minSeedHits)
+    keptBytes = b''.join(b'>' + headerList[i] + b'\n' + seqList[i] + b'\n' for i in np.flatnonzero(mask))
+    return keptBytes, len(records), int(mask.sum())
+
+"""
+Function writes the records of a protein FASTA file with seed hits to outputFile, and
+the numbers of records read and kept to outputFile.prefilter.
+"""
+def PrefilterProtFile(protFile, seedIndex, outputFile, k=SEED_KMER_LEN, minSeedHits=SEED_MIN_HITS):
+    totalCtr = 0
+    keptCtr = 0
+    with open(outputFile, 'wb') as outfile:
+        for headerList, seqList in ReadFastxBatches(protFile, "fasta"):
+            mask = SeedHitMask(seqList, seedIndex, k, minSeedHits)
+            outfile.write(b''.join(b'>' + headerList[i] + b'\n' + seqList[i] + b'\n' for i in np.flatnonzero(mask)))
+            totalCtr = totalCtr + len(seqList)
+            keptCtr = keptCtr + int(mask.sum())
+    WritePrefilterStats(outputFile, totalCtr, keptCtr)
+    logging.info("Prefilter kept {0} of {1} sequences of: {2}".format(keptCtr, totalCtr, protFile))
+    return 0
+
+"""
+Function records the numbers of sequences read and kept by the prefilter for a sample.
+"""
+def WritePrefilterStats(outputFile, totalCtr, keptCtr):
+    with open(outputFile + PREFILTER_STATS_EXT, 'w') as outfile:
+        outfile.write(str(totalCtr) + "\t" + str(keptCtr) + "\n")
+
+"""
+Function returns the total numbers of sequences read and kept by the prefilter in a directory.
+"""
+def ReadPrefilterStats(outputDir):
+    totalCtr = 0
+    keptCtr = 0
+    for filename in os.listdir(outputDir):
+        if filename.endswith(PREFILTER_STATS_EXT):
+            with open(os.path.join(outputDir, filename)) as infile:
+                total, kept = infile.read().split()
+                totalCtr = totalCtr + int(total)
+                keptCtr = keptCtr + int(kept)
+    return totalCtr, keptCtr
+
+"""
+Function prefilters all the protein FASTA files of a directory in parallel into outputDir.
+"""
+def RunPrefilterDirectoryPar(protSeqDir, seedIndex, outputDir, ncpus=4, k=SEED_KMER_LEN, minSeedHits=SEED_MIN_HITS):
+    os.makedirs(outputDir, 0o777, True)
+    prefilter_task_list = []
+    for subdir, dirs, files in os.walk(protSeqDir):
+        for file in files:
+            filePath = os.path.join(subdir, file)
+            if re.match(SeqFileRegex("fasta"), file) and os.path.getsize(filePath) > 0:
+                outputFile = os.path.join(outputDir, SeqFileStem(file) + ".fasta")
+                prefilter_task_list.append(Task("prefilter", filePath, PrefilterProtFile, filePath, seedIndex,
+                                                outputFile, k, minSeedHits))
+    checkResults(invoke_producer_consumer(prefilter_task_list, ncpus), "Seed prefilter")
+    return outputDir
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import gzip
+import logging
+import os
+import re
+import shutil
+import subprocess
+from contextlib import contextmanager
+
+"""
+Buffer-level FASTA/FASTQ reader for the read preprocessing hot paths. Files are read in
+large blocks and split into header and sequence byte strings in bulk, without building a
+SeqRecord per read. FASTQ records are expected on 4 lines, as written by Illumina
+pipelines. Headers are returned without the leading '>' or '@'.
+Files ending in .gz, .bgz or .zst are decompressed on the fly, with pigz, bgzip or zstd
+threads when those tools are on the PATH.
+"""
+
+BLOCK_SIZE = 16 * 1024 * 1024
+COMPRESSED_EXT_RE = r"(\.gz|\.bgz|\.zst)?"
+DECOMPRESS_THREADS = 4
+
+"""
+Function returns the regex matching file names with extension ext, compressed or not.
+"""
+def SeqFileRegex(ext):
+    return r".*\." + ext + COMPRESSED_EXT_RE + "$"
+
+"""
+Function returns the compression extension of a file name, or an empty string.
+"""
+def CompressionExt(fileName):
+    return re.search(COMPRESSED_EXT_RE + "$", fileName).group(0)
+
+"""
+Function returns the file name without the compression and sequence extensions.
+"""
+def SeqFileStem(fileName):
+    fileName = os.path.basename(fileName)
+    compressionExt = CompressionExt(fileName)
+    if compressionExt:
+        fileName = fileName[:-len(compressionExt)]
+    return os.path.splitext(fileName)[0]
+
+"""
+Function returns the multi-threaded decompression command for a compressed file as an
+argument list, or None if the file is not compressed or no decompression tool is found.
+"""
+def DecompressCommand(seqFile, threads=DECOMPRESS_THREADS):
+    compressionExt = CompressionExt(seqFile)
+    if compressionExt == ".zst" and shutil.which("zstd"):
+        return ["zstd", "-dcq", "-T" + str(threads), seqFile]
+    if compressionExt == ".bgz" and shutil.which("bgzip"):
+        return ["bgzip", "-dc", "-@", str(threads), seqFile]
+    if compressionExt in (".gz", ".bgz") and shutil.which("pigz"):
+        return ["pigz", "-dc", "-p", str(threads), seqFile]
+    return None
+
+"""
+Function returns a shell command that writes the decompressed content of a file to stdout.
+"""
+def DecompressShellCmd(seqFile, threads=DECOMPRESS_THREADS):
+    cmd = DecompressCommand(seqFile, threads)
+    if cmd is None:
+        cmd = ["zstd", "-dcq", seqFile] if CompressionExt(seqFile) == ".zst" else ["gzip", "-dc", seqFile]
+    return " ".join(cmd)
+
+"""
+Function opens a plain or compressed sequence file as a binary read handle. Compressed
+files are read through a decompression subprocess when one is available, otherwise with
+the gzip or zstandard python modules.
+"""
+@contextmanager
+def OpenSeqFile(seqFile, threads=DECOMPRESS_THREADS):
+    compressionExt = CompressionExt(seqFile)
+    cmd = DecompressCommand(seqFile, threads)
+    if cmd:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+        try:
+            yield proc.stdout
+        finally:
+            proc.stdout.close()
+            status = proc.wait()
+        if status > 0:
+            raise IOError(cmd[0] + " failed with exit status " + str(status) + " for: " + seqFile)
+    elif compressionExt == ".zst":
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading " + seqFile + " needs zstd on the PATH or the zstandard python package.")
+        with open(seqFile, 'rb') as rawHandle:
+            with zstandard.ZstdDecompressor().stream_reader(rawHandle) as handle:
+                yield handle
+    elif compressionExt:
+        with gzip.open(seqFile, 'rb') as handle:
+            yield handle
+    else:
+        with open(seqFile, 'rb') as handle:
+            yield handle
+
+def _SplitFastqLines(lines, fastqFile):
+    if lines[2::4] and not all(line[:1] == b'+' for line in lines[2::4]):
+        raise ValueError("FASTQ records are not on 4 lines in: " + fastqFile)
+    return [header[1:] for header in lines[0::4]], lines[1::4]
+
+def _ReadFastqBlocks(handle, fastqFile, blockSize):
+    carry = b''
+    while True:
+        data = handle.read(blockSize)
+        if not data:
+            break
+        block = carry + data
+        if b'\r' in block:
+            block = block.replace(b'\r', b'')
+        lines = block.split(b'\n')
+        last = lines.pop()
+        numLines = len(lines) - len(lines) % 4
+        carry = b'\n'.join(lines[numLines:] + [last])
+        del lines[numLines:]
+        if lines:
+            yield _SplitFastqLines(lines, fastqFile)
+    # Empty lines are kept as in the blocks, as they are zero-length reads or qualities;
+    # only the empty line after the final newline is dropped
+    lines = carry.replace(b'\r', b'').split(b'\n')
+    if not lines[-1]:
+        lines.pop()
+    if lines:
+        yield _SplitFastqLines(lines, fastqFile)
+
+def _SplitFastaRecords(records):
+    headerList = []
+    seqList = []
+    for record in records:
+        header, sep, seq = record.partition(b'\n')
+        headerList.append(header)
+        seqList.append(seq.replace(b'\n', b''))
+    return headerList, seqList
+
+# Unwrapped FASTA, as written by the pipeline, is split into lines in one pass, without a
+# byte string per record. The even lines after the first must all start with '>' and be the
+# only ones to, otherwise the records are split one by one.
+def _SplitFastaBlock(block):
+    lines = block.split(b'\n')
+    headerLines = b'\n'.join(lines[0::2])
+    recordCtr = block.count(b'\n>') + 1
+    if len(lines) == 2 * recordCtr and headerLines.count(b'\n>') == recordCtr - 1:
+        return headerLines.split(b'\n>'), lines[1::2]
+    return _SplitFastaRecords(block.split(b'\n>'))
+
+def _ReadFastaBlocks(handle, blockSize):
+    carry = b''
+    first = True
+    while True:
+        data = handle.read(blockSize)
+        if not data:
+            break
+        block = carry + data
+        if b'\r' in block:
+            block = block.replace(b'\r', b'')
+        if first:
+            block = block.lstrip()
+            if block[:1] == b'>':
+                block = block[1:]
+            first = False
+        lastRecord = block.rfind(b'\n>')
+        if lastRecord < 0:
+            carry = block
+            continue
+        carry = block[lastRecord + 2:]
+        yield _SplitFastaBlock(block[:lastRecord])
+    carry = carry.rstrip()
+    if carry:
+        yield _SplitFastaBlock(carry)
+
+"""
+Function reads a FASTA or FASTQ file in blocks and yields (headerList, seqList) byte string
+lists for the whole records of each block.
+"""
+def ReadFastxBatches(seqFile, seq_fmt="fasta", blockSize=BLOCK_SIZE):
+    with OpenSeqFile(seqFile) as handle:
+        if seq_fmt.lower() == "fastq":
+            for batch in _ReadFastqBlocks(handle, seqFile, blockSize):
+                yield batch
+        else:
+            for batch in _ReadFastaBlocks(handle, blockSize):
+                yield batch
+
+"""
+Function returns the read id, the first word of a header.
+"""
+def RecordId(header):
+    return header.split(None, 1)[0] if header else b''
+
+"""
+Function iterates over the (header, seq) byte strings of a FASTA or FASTQ file.
+"""
+def IterFastxRecords(seqFile, seq_fmt="fasta"):
+    for headerList, seqList in ReadFastxBatches(seqFile, seq_fmt):
+        for record in zip(headerList, seqList):
+            yield record
+
+def _FastaBytes(headerList, seqList):
+    numRecords = len(headerList)
+    parts = [b'\n'] * (5 * numRecords)
+    parts[0::5] = [b'>'] * numRecords
+    parts[1::5] = headerList
+    parts[3::5] = seqList
+    return b''.join(parts)
+
+"""
+Function converts a FASTA or FASTQ file into an unwrapped FASTA file. Returns the number
+of records written.
+"""
+def FastxToFasta(seqFile, seq_fmt, outputFile):
+    count = 0
+    with open(outputFile, 'wb') as outfile:
+        for headerList, seqList in ReadFastxBatches(seqFile, seq_fmt):
+            if headerList:
+                outfile.write(_FastaBytes(headerList, seqList))
+                count = count + len(headerList)
+    logging.info("Converted " + str(count) + " records from " + seqFile + " to " + outputFile)
+    return count
+
+"""
+Function interleaves the records of R1 and R2 files into one FASTA file. Returns the number
+of records written.
+"""
+def InterleaveFastx(r1File, r2File, seq_fmt, outputFile):
+    count = 0
+    headerList = []
+    seqList = []
+    with open(outputFile, 'wb') as outfile:
+        for (header_f, seq_f), (header_r, seq_r) in zip(IterFastxRecords(r1File, seq_fmt),
+                                                        IterFastxRecords(r2File, seq_fmt)):
+            headerList.extend((header_f, header_r))
+            seqList.extend((seq_f, seq_r))
+            if len(headerList) >= 200000:
+                outfile.write(_FastaBytes(headerList, seqList))
+                count = count + len(headerList)
+                headerList = []
+                seqList = []
+        if headerList:
+            outfile.write(_FastaBytes(headerList, seqList))
+            count = count + len(headerList)
+    logging.info("Interleaved " + str(count) + " records from " + r1File + " and " + r2File)
+    return count
+
+"""
+Function writes the records of a FASTA or FASTQ file whose read id is in idSet to a FASTA
+file. The ids in idSet are str. Returns the number of records written.
+"""
+def ExtractFastxRecords(seqFile, seq_fmt, idSet, outputFile):
+    idSet = set(readId.encode() for readId in idSet)
+    count = 0
+    with open(outputFile, 'wb') as outfile:
+        for headerList, seqList in ReadFastxBatches(seqFile, seq_fmt):
+            keep = [i for i, header in enumerate(headerList) if RecordId(header) in idSet]
+            if keep:
+                outfile.write(_FastaBytes([headerList[i] for i in keep], [seqList[i] for i in keep]))
+                count = count + len(keep)
+    return count
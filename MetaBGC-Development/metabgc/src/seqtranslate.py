@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import numpy as np
+import logging
+from metabgc.src.seqreader import ReadFastxBatches, RecordId
+
+"""
+In-process 6 frame translation of nucleotide reads with codon table 11, replacing the
+EMBOSS transeq subprocess. Frames are named like transeq: _1, _2, _3 are the forward
+frames and _4, _5, _6 are the reverse complement of the codons used in frames 1, 2, 3.
+Bases are encoded as IUPAC bit masks so ambiguous codons that code for a single amino
+acid (or to B, Z, J) are translated the way transeq does, and all others become X.
+"""
+
+CODON_TABLE_11 = "FFLLSSSSYY**CC*WLLLLPPPPHHQQRRRRIIIMTTTTNNKKSSRRVVVVAAAADDEEGGGG"
+TABLE_BASES = "TCAG"
+IUPAC_MASKS = {'A': 1, 'C': 2, 'G': 4, 'T': 8, 'U': 8, 'R': 5, 'Y': 10, 'S': 6, 'W': 9, 'K': 12,
+               'M': 3, 'B': 14, 'D': 13, 'H': 11, 'V': 7, 'N': 15}
+MASK_BASES = {1: 'A', 2: 'C', 4: 'G', 8: 'T'}
+AMBIGUOUS_AA = {frozenset('DN'): 'B', frozenset('EQ'): 'Z', frozenset('IL'): 'J'}
+
+def _BuildLookupTables():
+    baseMask = np.zeros(256, dtype=np.uint8)
+    for base, mask in IUPAC_MASKS.items():
+        baseMask[ord(base)] = mask
+        baseMask[ord(base.lower())] = mask
+    compMask = np.zeros(16, dtype=np.uint8)
+    for mask in range(16):
+        # Complement swaps A<->T and C<->G, which reverses the 4 mask bits
+        compMask[mask] = ((mask & 1) << 3) | ((mask & 2) << 1) | ((mask & 4) >> 1) | ((mask & 8) >> 3)
+    codonAA = {}
+    for i, aa in enumerate(CODON_TABLE_11):
+        codonAA[TABLE_BASES[i // 16] + TABLE_BASES[(i // 4) % 4] + TABLE_BASES[i % 4]] = aa
+    expand = [[MASK_BASES[bit] for bit in (1, 2, 4, 8) if mask & bit] for mask in range(16)]
+    aaTable = np.full(4096, ord('X'), dtype=np.uint8)
+    for m1 in range(1, 16):
+        for m2 in range(1, 16):
+            for m3 in range(1, 16):
+                aaSet = set(codonAA[b1 + b2 + b3] for b1 in expand[m1] for b2 in expand[m2] for b3 in expand[m3])
+                if len(aaSet) == 1:
+                    aaTable[(m1 << 8) | (m2 << 4) | m3] = ord(aaSet.pop())
+                elif frozenset(aaSet) in AMBIGUOUS_AA:
+                    aaTable[(m1 << 8) | (m2 << 4) | m3] = ord(AMBIGUOUS_AA[frozenset(aaSet)])
+    return baseMask, compMask, aaTable
+
+BASE_MASK, COMP_MASK, AA_TABLE = _BuildLookupTables()
+
+def _TranslateFrame(codes, start, numCodons):
+    numSeqs = codes.shape[0]
+    codons = codes[:, start:start + 3 * numCodons].reshape(numSeqs, numCodons, 3).astype(np.uint16)
+    return AA_TABLE[(codons[:, :, 0] << 8) | (codons[:, :, 1] << 4) | codons[:, :, 2]]
+
+def _ConstColumns(value, numSeqs):
+    return np.broadcast_to(np.frombuffer(value, dtype=np.uint8), (numSeqs, len(value)))
+
+"""
+Function translates reads that share the same read and id lengths into 6 frame protein
+FASTA bytes. Every record of the group has the same width, so the whole block is built
+with array operations.
+"""
+def TranslateGroup(idList, seqList):
+    numSeqs = len(seqList)
+    seqLen = len(seqList[0])
+    ids = np.frombuffer(b''.join(idList), dtype=np.uint8).reshape(numSeqs, -1)
+    codes = BASE_MASK[np.frombuffer(b''.join(seqList), dtype=np.uint8).reshape(numSeqs, seqLen)]
+    revCodes = COMP_MASK[codes[:, ::-1]]
+    columns = []
+    for frame in range(6):
+        offset = frame % 3
+        numCodons = (seqLen - offset) // 3
+        if frame < 3:
+            prot = _TranslateFrame(codes, offset, numCodons)
+        else:
+            prot = _TranslateFrame(revCodes, seqLen - offset - 3 * numCodons, numCodons)
+        columns.extend([_ConstColumns(b'>', numSeqs), ids,
+                        _ConstColumns(b'_' + str(frame + 1).encode() + b'\n', numSeqs),
+                        prot, _ConstColumns(b'\n', numSeqs)])
+    return np.concatenate(columns, axis=1).tobytes()
+
+"""
+Function translates a batch of (id, seq) byte records into 6 frame protein FASTA bytes.
+Reads shorter than a codon are skipped. Records are grouped by read and id length, so the
+output is ordered by group rather than by input position.
+"""
+def TranslateBatch(recordList):
+    groups = {}
+    for seqId, seq in recordList:
+        if len(seq) >= 3:
+            group = groups.setdefault((len(seq), len(seqId)), ([], []))
+            group[0].append(seqId)
+            group[1].append(seq)
+    return b''.join(TranslateGroup(idList, seqList) for idList, seqList in groups.values())
+
+"""
+Function reads a FASTA file in batches of (id, seq) byte records.
+"""
+def ReadFastaBatches(fastaFile, batchSize=100000):
+    batch = []
+    for headerList, seqList in ReadFastxBatches(fastaFile, "fasta"):
+        batch.extend(zip([RecordId(header) for header in headerList], seqList))
+        while len(batch) >= batchSize:
+            yield batch[:batchSize]
+            batch = batch[batchSize:]
+    if batch:
+        yield batch
+
+"""
+Function writes the 6 frame translation of a FASTA file to an open binary handle, such as
+the stdin pipe of hmmsearch. Returns the number of reads translated.
+"""
+def TranslateFastaToStream(fastaFile, outHandle, batchSize=100000):
+    readCtr = 0
+    for batch in ReadFastaBatches(fastaFile, batchSize):
+        outHandle.write(TranslateBatch(batch))
+        readCtr = readCtr + len(batch)
+    return readCtr
+
+"""
+Function writes the 6 frame translation of a FASTA file to outputFile.
+"""
+def TranslateFastaFile(fastaFile, outputFile):
+    logging.info('Translating {0}.'.format(fastaFile))
+    with open(outputFile, 'wb') as outHandle:
+        readCtr = TranslateFastaToStream(fastaFile, outHandle)
+    logging.info("Done translating " + str(readCtr) + " reads from:" + fastaFile)
+    return 0
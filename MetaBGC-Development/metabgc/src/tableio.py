@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+#####################################################################################
+# This file is a component of MetaBGC (Metagenomic identifier of Biosynthetic Gene Clusters)
+# (contact Francine Camacho at camachofrancine@gmail.com).
+#####################################################################################
+
+import os
+import shutil
+import pandas as pd
+
+"""
+Read and write of the intermediate result tables (per-sample HMM hits, CombinedHmmSearch,
+CombinedQuantifyBLAST and the abundance tables) as TSV or Parquet. The format is set once
+per run with SetIntermediateFormat and read back from METABGC_INTERMEDIATE_FORMAT by the
+worker processes. In Parquet, the sample, interval and type columns are stored as
+dictionary encoded categoricals. The file extension selects the reader, so tables written
+in either format can be read back. Parquet needs the optional pyarrow package.
+"""
+
+INTERMEDIATE_FORMAT_ENV = "METABGC_INTERMEDIATE_FORMAT"
+INTERMEDIATE_FORMATS = ["tsv", "parquet"]
+PARQUET_EXT = ".parquet"
+CATEGORICAL_COLUMNS = ["sampleType", "sampleID", "Sample", "protType", "window", "interval", "cohort"]
+
+def _ImportArrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet intermediate format needs the pyarrow package. "
+                          "Install it with: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+"""
+Function sets the intermediate table format for this process and its workers.
+"""
+def SetIntermediateFormat(tableFormat):
+    if tableFormat:
+        tableFormat = tableFormat.lower()
+        if tableFormat not in INTERMEDIATE_FORMATS:
+            raise ValueError("Unknown intermediate format: " + tableFormat)
+        if tableFormat == "parquet":
+            _ImportArrow()
+        os.environ[INTERMEDIATE_FORMAT_ENV] = tableFormat
+
+"""
+Function returns the intermediate table format of the run.
+"""
+def IntermediateFormat():
+    return os.environ.get(INTERMEDIATE_FORMAT_ENV, "tsv")
+
+"""
+Function returns the path of an intermediate table in the format of the run. TSV tables keep
+their name, Parquet tables get the .parquet extension.
+"""
+def TableFileName(filePath):
+    if IntermediateFormat() == "parquet":
+        return os.path.splitext(filePath)[0] + PARQUET_EXT
+    return filePath
+
+"""
+Function returns True if the file is a Parquet table.
+"""
+def IsParquet(filePath):
+    return filePath.endswith(PARQUET_EXT)
+
+def _ArrowTable(df):
+    pyarrow, pq = _ImportArrow()
+    df = df.astype({col: "category" for col in CATEGORICAL_COLUMNS if col in df.columns})
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    # Fixed dictionary index and value types so the tables of all samples share one schema
+    fields = [pyarrow.field(f.name, pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))
+              if pyarrow.types.is_dictionary(f.type) else f for f in table.schema]
+    return table.cast(pyarrow.schema(fields))
+
+"""
+Function writes a table. TSV tables are written without the header unless header is set;
+Parquet tables always keep their column names.
+"""
+def WriteTable(df, filePath, header=False):
+    if IsParquet(filePath):
+        pyarrow, pq = _ImportArrow()
+        pq.write_table(_ArrowTable(df), filePath)
+    else:
+        df.to_csv(filePath, index=False, sep='\t', header=header)
+
+"""
+Function writes a table given as an iterable of data frames of the same columns, so only one
+block is in memory at a time. TSV headers are written with the first block when header is
+set; Parquet blocks are written as the row groups of one file.
+"""
+def WriteTableBlocks(dfBlocks, filePath, header=False):
+    if IsParquet(filePath):
+        pyarrow, pq = _ImportArrow()
+        writer = None
+        try:
+            for df in dfBlocks:
+                table = _ArrowTable(df)
+                if writer is None:
+                    writer = pq.ParquetWriter(filePath, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    else:
+        with open(filePath, 'w') as outfile:
+            for i, df in enumerate(dfBlocks):
+                df.to_csv(outfile, index=False, sep='\t', header=header and i == 0)
+
+"""
+Function reads a table. For TSV, names, header and dtype are passed to read_csv. For Parquet,
+names renames the stored columns.
+"""
+def ReadTable(filePath, names=None, header=None, dtype=None):
+    if IsParquet(filePath):
+        _ImportArrow()
+        df = pd.read_parquet(filePath)
+        if names is not None:
+            df.columns = names
+        return df
+    if names is None and header is None:
+        header = 0
+    return pd.read_csv(filePath, sep='\t', names=names, header=header, dtype=dtype)
+
+"""
+Function reads a table in chunks of chunkSize rows.
+"""
+def IterTableChunks(filePath, names=None, dtype=None, chunkSize=1000000):
+    if IsParquet(filePath):
+        pyarrow, pq = _ImportArrow()
+        for batch in pq.ParquetFile(filePath).iter_batches(batch_size=chunkSize):
+            df = batch.to_pandas()
+            if names is not None:
+                df.columns = names
+            yield df
+    else:
+        for df in pd.read_csv(filePath, sep='\t', names=names, header=None, dtype=dtype, chunksize=chunkSize):
+            yield df
+
+"""
+Function returns the number of rows of a table.
+"""
+def TableRowCount(filePath):
+    if IsParquet(filePath):
+        pyarrow, pq = _ImportArrow()
+        return pq.ParquetFile(filePath).metadata.num_rows
+    with open(filePath, 'rb') as infile:
+        return sum(block.count(b'\n') for block in iter(lambda: infile.read(1024 * 1024), b''))
+
+"""
+Function concatenates tables of the same columns and format, headerless for TSV, into
+outFile. Returns the number of rows written.
+"""
+def ConcatTables(fileList, outFile):
+    rowCtr = 0
+    if IsParquet(outFile):
+        pyarrow, pq = _ImportArrow()
+        writer = None
+        try:
+            for filePath in fileList:
+                table = pq.read_table(filePath)
+                if table.num_rows == 0:
+                    continue
+                if writer is None:
+                    schema = table.schema.remove_metadata()
+                    writer = pq.ParquetWriter(outFile, schema)
+                writer.write_table(table.cast(schema))
+                rowCtr = rowCtr + table.num_rows
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            open(outFile, 'wb').close()
+    else:
+        with open(outFile, 'wb') as outfile:
+            for filePath in fileList:
+                with open(filePath, 'rb') as infile:
+                    shutil.copyfileobj(infile, outfile)
+        rowCtr = TableRowCount(outFile)
+    return rowCtr
+
+"""
+Function exports a Parquet table to TSV.
+"""
+def ExportTSV(parquetFile, tsvFile, header=True):
+    ReadTable(parquetFile).to_csv(tsvFile, index=False, sep='\t', header=header)
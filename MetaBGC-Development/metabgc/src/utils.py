@@ -1,5 +1,6 @@
 from Bio import SearchIO
 from Bio import SeqIO
+import io
 import os
 import subprocess
 import metabgc.src.hmmrecord as hmmrecord
@@ -10,6 +11,13 @@ from itertools import repeat
 import shutil
 import csv
 import logging
+from metabgc.src.producer_consumer import Task, invoke_producer_consumer, checkResults
+from metabgc.src.seqtranslate import TranslateFastaFile
+from metabgc.src.tableio import WriteTable, TableFileName
+from metabgc.src.seqreader import FastxToFasta, InterleaveFastx, OpenSeqFile, SeqFileRegex, SeqFileStem, \
+    CompressionExt, COMPRESSED_EXT_RE
+from metabgc.src.pipelinestate import IsTaskDone, ClearTaskDone, CommitOutput, TmpPath, runCheckpointed
+from metabgc.src.blastdbregistry import BlastDBRegistry, RegisteredBlastDB
 
 """
 Function searches all FASTA file in a directory against a HMM. 
@@ -119,16 +127,11 @@ def MakeSearchBLASTN(dbInputFile, existingDbDirMapFile, dbOpPath, searchFile, bl
         dbOut = map_dict[sample_basename]
 
     if not os.path.isfile(dbOut):
-        logging.info("Constructing BLAST DB for:" + dbInputFile)
-        dbOpPath = dbOpPath + os.sep + sample_basename
-        os.makedirs(dbOpPath, 0o777, True)
-        dbName = os.path.splitext(sample_basename)[0]
-        dbOut = runMakeBLASTDB(dbInputFile, dbName, dbOpPath, 'nucl')
-        runBLASTN(searchFile, dbOut, blastCmdString, blastParamStr, outFile, 1)
-        shutil.rmtree(dbOpPath)
+        # The database is kept in the registry for the next searches of the sample
+        dbOut = RegisteredBlastDB(BlastDBRegistry(), dbInputFile)
     else:
         logging.info("Found existing database path:" + dbOut)
-        runBLASTN(searchFile, dbOut, blastCmdString, blastParamStr, outFile, 1)
+    runBLASTN(searchFile, dbOut, blastCmdString, blastParamStr, outFile, 1)
 """
 Function to run make BLAST db and search a FASTA file. 
 """
@@ -211,9 +214,55 @@ def RunBlastSearch(blastdb, queryFileList, blastCmdString, blastParamStr, ouputD
                       blastCmdString, blastParamStr, outFileList)
 
 """
-Function to parse HMM file into HMMRecord dict. 
+Function reads the hit lines of a HMMER tblout file and yields the (target name, query name,
+full sequence bit score) of each hit, without building SearchIO objects.
+"""
+def IterTbloutHits(hmmPathFile):
+    with open(hmmPathFile, 'rb') as handle:
+        for line in handle:
+            if line[:1] == b'#':
+                continue
+            fields = line.split(None, 6)
+            if len(fields) > 5:
+                yield fields[0].decode(), fields[2].decode(), float(fields[5])
+
+"""
+Function returns the dict of read to best bit score of a hmmsearch tblout file. A read found
+more than once keeps its highest score.
+"""
+def parseHMMScores(hmmPathFile):
+    score_dict = {}
+    for read_name, model_name, bitscore in IterTbloutHits(hmmPathFile):
+        if bitscore > score_dict.get(read_name, float('-inf')):
+            score_dict[read_name] = bitscore
+    return score_dict
+
+"""
+Function returns the dict of interval to {read: best bit score} of a hmmscan tblout file of
+reads against a combined spHMM database. The model name of each hit is mapped to its interval.
+"""
+def parseHMMScanScores(hmmPathFile, modelIntervalDict):
+    interval_scores_dict = {interval: {} for interval in modelIntervalDict.values()}
+    for model_name, read_name, bitscore in IterTbloutHits(hmmPathFile):
+        interval = modelIntervalDict.get(model_name)
+        if interval is None:
+            continue
+        score_dict = interval_scores_dict[interval]
+        if bitscore > score_dict.get(read_name, float('-inf')):
+            score_dict[read_name] = bitscore
+    return interval_scores_dict
+
+def _scoresToRecords(score_dict, sampleType, sampleID, protType, window, interval):
+    return {read_name: hmmrecord.HMMRecord(read_name, sampleType, sampleID, protType, bitscore, window, interval)
+            for read_name, bitscore in score_dict.items()}
+
+"""
+Function to parse hmm table output and store read information in a dictionary of HMMRecord.
+Formats other than hmmer3-tab are read with SearchIO.
 """
 def parseHMM(hmmPathFile, hmm_string_fmt, sampleType, sampleID, protType, window, interval):
+    if hmm_string_fmt == "hmmer3-tab":
+        return _scoresToRecords(parseHMMScores(hmmPathFile), sampleType, sampleID, protType, window, interval)
     with open(hmmPathFile, 'r') as handle:
         results_dict = {}
         try:
@@ -232,19 +281,37 @@ def parseHMM(hmmPathFile, hmm_string_fmt, sampleType, sampleID, protType, window
             print ("ERROR: duplicated queryIDs in hmmer result file:", hmmPathFile)
     return results_dict
 
+"""
+Function to parse a hmmscan table of reads against a combined spHMM database into one
+HMMRecord dict per interval. The model name of each hit is mapped to its interval.
+"""
+def parseHMMScan(hmmPathFile, hmm_string_fmt, sampleType, sampleID, protType, window, modelIntervalDict):
+    interval_scores_dict = parseHMMScanScores(hmmPathFile, modelIntervalDict)
+    return {interval: _scoresToRecords(score_dict, sampleType, sampleID, protType, window, interval)
+            for interval, score_dict in interval_scores_dict.items()}
+
+"""
+Function writes the per-sample hit table of a {read: bit score} dict, sorted by score.
+"""
+def createHitTable(score_dict, outfile, sampleType, sampleID, protType, window, interval):
+    outputDF = pd.DataFrame({"readID": list(score_dict.keys()), "sampleType": sampleType, "sampleID": sampleID,
+                             "protType": protType, "HMMScore": list(score_dict.values()), "window": window,
+                             "interval": interval},
+                            columns=["readID", "sampleType", "sampleID", "protType", "HMMScore", "window", "interval"])
+    outputDF = outputDF.sort_values(by=['HMMScore'], ascending=[False])
+    WriteTable(outputDF, TableFileName(outfile))
+
 
 def createPandaDF(hmm_dict, outfile):
-    outputDF = pd.DataFrame()
+    outputDF_columns = ["readID", "sampleType", "sampleID", "protType", "HMMScore", "window", "interval"]
     if len(hmm_dict) != 0:  # check if counter dict is not empty to add to df
         df = [(k, v.sampleType, v.sampleID, v.protType, v.bitscore, v.window, v.interval) for k, v in list(hmm_dict.items())]  # convert dictionary to list
-        outputDF = outputDF.append(df)  # append list to our initalized dataframe
-        outputDF.columns = ["readID", "sampleType", "sampleID", "protType", "HMMScore", "window","interval"]  # rename column names
+        outputDF = pd.DataFrame(df, columns=outputDF_columns)
         sorted_outputDF = outputDF.sort_values(by=['HMMScore'],ascending=[False])  # sort in decending order by Hit.counts column
-        sorted_outputDF.to_csv(outfile, index=False, sep='\t', header=False)
+        WriteTable(sorted_outputDF, TableFileName(outfile))
     else:
-        outputDF_empty_columns = ["readID", "sampleType", "sampleID", "protType", "HMMScore", "window", "interval"]  # rename column names
-        outputDF_empty = pd.DataFrame(columns=outputDF_empty_columns)
-        outputDF_empty.to_csv(outfile, index=False, sep='\t', header=False)
+        outputDF_empty = pd.DataFrame(columns=outputDF_columns)
+        WriteTable(outputDF_empty, TableFileName(outfile))
 
 
 """
@@ -264,8 +331,9 @@ def runTranSeq(fastaFile,frameCode,outputFile):
     logging.info('Running transeq with {0}.'.format(fastaFile))
     cmd = "transeq " + fastaFile + " " + outputFile + " -frame="+ frameCode +" -table=11 -sformat pearson"
     logging.info(cmd)
-    subprocess.call(cmd, shell=True)
+    status = subprocess.call(cmd, shell=True)
     logging.info("Done Running transeq with:" + fastaFile)
+    return status
 
 
 """
@@ -275,8 +343,9 @@ def runCDHit(fastaFile,outputFile,ncpu):
     logging.info('Running CD-Hit with {0}.'.format(fastaFile))
     cmd = "cd-hit-est -i " + fastaFile + " -o " + outputFile + " -c .95 -n 10 -d 0 -aS .95 -M 4098 -T "+ str(ncpu)
     logging.info(cmd)
-    subprocess.call(cmd, shell=True)
+    status = subprocess.call(cmd, shell=True)
     logging.info("Done Running Cd-Hit with:" + fastaFile)
+    return status
 
 """
 Interleave FR reads. 
@@ -286,13 +355,46 @@ def interleave(iter1, iter2) :
         yield forward
         yield reverse
 
+"""
+Interleave R1 and R2 read files into one FASTA file with the buffer-level reader. FASTQ
+files that are not on 4 lines per record fall back to SeqIO.
+"""
 def InterleaveReads(out_seq_directory, sampleName, r1FilePath,r2FilePath,seq_fmt):
-    records_f = SeqIO.parse(open(r1FilePath, "rU"), seq_fmt)
-    records_r = SeqIO.parse(open(r2FilePath, "rU"), seq_fmt)
     file_out = os.path.join(out_seq_directory, sampleName + ".fasta")
-    handle = open(file_out, "w")
-    count = SeqIO.write(interleave(records_f, records_r), handle, "fasta")
-    handle.close()
+    if IsTaskDone(file_out):
+        logging.info("Using pre-processed reads: " + file_out)
+        return 0
+    ClearTaskDone(file_out)
+    tmp_out = TmpPath(file_out)
+    try:
+        count = InterleaveFastx(r1FilePath, r2FilePath, seq_fmt, tmp_out)
+    except ValueError:
+        logging.info("Parsing " + r1FilePath + " with SeqIO.")
+        with OpenSeqFile(r1FilePath) as handle_f, OpenSeqFile(r2FilePath) as handle_r:
+            records_f = SeqIO.parse(io.TextIOWrapper(handle_f), seq_fmt)
+            records_r = SeqIO.parse(io.TextIOWrapper(handle_r), seq_fmt)
+            count = SeqIO.write(interleave(records_f, records_r), tmp_out, "fasta")
+    CommitOutput(tmp_out, file_out)
+    return count
+
+"""
+Convert a FASTQ file to FASTA with the buffer-level reader. FASTQ files that are not on
+4 lines per record fall back to SeqIO.
+"""
+def ConvertReadsToFasta(filePath, out_seq_path):
+    try:
+        return FastxToFasta(filePath, "fastq", out_seq_path)
+    except ValueError:
+        logging.info("Parsing " + filePath + " with SeqIO.")
+        with OpenSeqFile(filePath) as handle:
+            return SeqIO.convert(io.TextIOWrapper(handle), "fastq", out_seq_path, "fasta")
+
+"""
+Function converts a FASTQ file to FASTA as a checkpointed task. Returns the exit status.
+"""
+def ConvertReadsTask(filePath, out_seq_path):
+    ConvertReadsToFasta(filePath, out_seq_path)
+    return 0
 
 def InterleaveReadsParallel(out_seq_directory,sampleNameList,r1FilePathList,r2FilePathList,seq_fmt):
     numOfprocess = len(sampleNameList)
@@ -312,26 +414,25 @@ def TranseqReadsParallel(nSeqFileNameList,frameCode,protFileNameList):
     pool.terminate()  # garbage collector
 
 """
-Convert all files in a directory to corresponding 6 frame protein sequence
+Convert all files in a directory to corresponding 6 frame protein sequence. The built-in
+translator is used unless useTranseq is set, in which case EMBOSS transeq is called.
 """
-def TranseqReadsDir(build_op_dir,nucl_seq_directory,ncpus):
+def TranseqReadsDir(build_op_dir,nucl_seq_directory,ncpus,useTranseq=False):
     prot_seq_directory = os.path.join(build_op_dir, 'prot_seq_dir')
     os.makedirs(prot_seq_directory, 0o777, True)
+    transeq_task_list = []
     for subdir, dirs, files in os.walk(nucl_seq_directory):
-        nSeqFileNameList = []
-        protFileNameList = []
         for file in files:
             filePath = os.path.join(subdir, file)
-            if re.match(r".*\.fasta$", file) and os.path.getsize(filePath) > 0:
-                prot_file = prot_seq_directory + os.sep + os.path.basename(filePath)
-                nSeqFileNameList.append(filePath)
-                protFileNameList.append(prot_file)
-            if len(nSeqFileNameList) >= ncpus:
-                TranseqReadsParallel(nSeqFileNameList, "6", protFileNameList)
-                nSeqFileNameList = []
-                protFileNameList = []
-        if len(nSeqFileNameList) > 0:
-            TranseqReadsParallel(nSeqFileNameList, "6", protFileNameList)
+            if re.match(SeqFileRegex("fasta"), file) and os.path.getsize(filePath) > 0:
+                prot_file = prot_seq_directory + os.sep + SeqFileStem(file) + ".fasta"
+                if IsTaskDone(prot_file):
+                    continue
+                if useTranseq:
+                    transeq_task_list.append(Task("transeq", filePath, runCheckpointed, prot_file, runTranSeq, filePath, "6"))
+                else:
+                    transeq_task_list.append(Task("transeq", filePath, runCheckpointed, prot_file, TranslateFastaFile, filePath))
+    checkResults(invoke_producer_consumer(transeq_task_list, ncpus), "Translation")
     return prot_seq_directory
 
 """
@@ -342,10 +443,10 @@ def PreProcessReadsPar(nucl_seq_directory, seq_fmt, pair_fmt, R1_file_suffix, R2
     if seq_fmt.lower() == "fasta" and (pair_fmt.lower() == "interleaved" or pair_fmt.lower() == "single"):
         return nucl_seq_directory
 
+    # Samples are skipped once their pre-processed file is marked done, so an interrupted
+    # pre-processing resumes at the unfinished samples
     out_seq_directory = os.path.join(ouputDir, 'nucl_seq_dir')
-    if os.path.isdir(out_seq_directory):
-        return out_seq_directory
-    elif seq_fmt.lower() == "fasta" and pair_fmt.lower() == "split":
+    if seq_fmt.lower() == "fasta" and pair_fmt.lower() == "split":
         os.makedirs(out_seq_directory, 0o777, True)
         for subdir, dirs, files in os.walk(nucl_seq_directory):
             sampleNameList = []
@@ -354,12 +455,12 @@ def PreProcessReadsPar(nucl_seq_directory, seq_fmt, pair_fmt, R1_file_suffix, R2
             freeze_support()
             for file in files:
                 filePath = os.path.join(subdir, file)
-                regF = r".*" + R1_file_suffix + "$"
-                regR = r".*" + R2_file_suffix + "$"
+                regF = r".*" + R1_file_suffix + COMPRESSED_EXT_RE + "$"
+                regR = r".*" + R2_file_suffix + COMPRESSED_EXT_RE + "$"
                 if re.match(regF, file) and not re.match(regR, file) and os.path.getsize(filePath) > 0:
                     logging.info("Pre-processing:" + file)
                     sampleName = file.split(R1_file_suffix)[0]
-                    r2FilePath = os.path.join(subdir, sampleName + R2_file_suffix)
+                    r2FilePath = os.path.join(subdir, sampleName + R2_file_suffix + CompressionExt(file))
                     sampleNameList.append(sampleName)
                     r1FilePathList.append(filePath)
                     r2FilePathList.append(r2FilePath)
@@ -378,10 +479,10 @@ def PreProcessReadsPar(nucl_seq_directory, seq_fmt, pair_fmt, R1_file_suffix, R2
             for subdir, dirs, files in os.walk(nucl_seq_directory):
                 for file in files:
                     filePath = os.path.join(subdir, file)
-                    if re.match(r".*.fastq$", file) and os.path.getsize(filePath) > 0:
+                    if re.match(SeqFileRegex("fastq"), file) and os.path.getsize(filePath) > 0:
                         logging.info("Pre-processing:" + file)
-                        out_seq_path = os.path.join(out_seq_directory, file)
-                        count = SeqIO.convert(filePath, "fastq", out_seq_path, "fasta")
+                        out_seq_path = os.path.join(out_seq_directory, SeqFileStem(file) + ".fasta")
+                        runCheckpointed(out_seq_path, ConvertReadsTask, filePath)
         elif pair_fmt.lower() == "split":
             for subdir, dirs, files in os.walk(nucl_seq_directory):
                 sampleNameList = []
@@ -390,12 +491,12 @@ def PreProcessReadsPar(nucl_seq_directory, seq_fmt, pair_fmt, R1_file_suffix, R2
                 freeze_support()
                 for file in files:
                     filePath = os.path.join(subdir, file)
-                    regF = r".*" + R1_file_suffix + "$"
-                    regR = r".*" + R2_file_suffix + "$"
+                    regF = r".*" + R1_file_suffix + COMPRESSED_EXT_RE + "$"
+                    regR = r".*" + R2_file_suffix + COMPRESSED_EXT_RE + "$"
                     if re.match(regF, file) and not re.match(regR, file) and os.path.getsize(filePath) > 0:
                         logging.info("Pre-processing:" + file)
                         sampleName = file.split(R1_file_suffix)[0]
-                        r2FilePath = os.path.join(subdir, sampleName + R2_file_suffix)
+                        r2FilePath = os.path.join(subdir, sampleName + R2_file_suffix + CompressionExt(file))
                         sampleNameList.append(sampleName)
                         r1FilePathList.append(filePath)
                         r2FilePathList.append(r2FilePath)
@@ -424,10 +525,10 @@ def PreProcessReads(nucl_seq_directory,seq_fmt,pair_fmt,R1_file_suffix,R2_file_s
     if seq_fmt.lower() == "fasta" and (pair_fmt.lower() == "interleaved" or pair_fmt.lower() == "single"):
         return nucl_seq_directory
 
+    # Samples are skipped once their pre-processed file is marked done, so an interrupted
+    # pre-processing resumes at the unfinished samples
     out_seq_directory = os.path.join(ouputDir, 'nucl_seq_dir')
-    if os.path.isdir(out_seq_directory):
-        return out_seq_directory
-    elif seq_fmt.lower() == "fasta" and pair_fmt.lower() == "split":
+    if seq_fmt.lower() == "fasta" and pair_fmt.lower() == "split":
         os.makedirs(out_seq_directory, 0o777, True)
         for subdir, dirs, files in os.walk(nucl_seq_directory):
             for file in files:
@@ -437,12 +538,7 @@ def PreProcessReads(nucl_seq_directory,seq_fmt,pair_fmt,R1_file_suffix,R2_file_s
                 if re.match(regF, file) and not re.match(regR, file) and os.path.getsize(filePath) > 0:
                     sampleName = file.split(R1_file_suffix)[0]
                     r2FilePath = os.path.join(subdir, sampleName + R2_file_suffix)
-                    file_out = os.path.join(out_seq_directory, sampleName + ".fasta")
-                    records_f = SeqIO.parse(open(filePath, "rU"), seq_fmt.lower())
-                    records_r = SeqIO.parse(open(r2FilePath, "rU"), seq_fmt.lower())
-                    handle = open(file_out, "w")
-                    count = SeqIO.write(interleave(records_f, records_r), handle, "fasta")
-                    handle.close()
+                    count = InterleaveReads(out_seq_directory, sampleName, filePath, r2FilePath, seq_fmt.lower())
         return out_seq_directory
     elif seq_fmt.lower() == "fastq":
         os.makedirs(out_seq_directory, 0o777, True)
@@ -453,7 +549,7 @@ def PreProcessReads(nucl_seq_directory,seq_fmt,pair_fmt,R1_file_suffix,R2_file_s
                     if re.match(r".*.fastq$", file) and os.path.getsize(filePath) > 0:
                         logging.info("Pre-processing:" + file)
                         out_seq_path = os.path.join(out_seq_directory, file)
-                        count = SeqIO.convert(filePath, "fastq", out_seq_path, "fasta")
+                        count = ConvertReadsToFasta(filePath, out_seq_path)
         elif pair_fmt.lower() == "split":
             for subdir, dirs, files in os.walk(nucl_seq_directory):
                 for file in files:
@@ -464,12 +560,7 @@ def PreProcessReads(nucl_seq_directory,seq_fmt,pair_fmt,R1_file_suffix,R2_file_s
                         logging.info("Pre-processing:" + file)
                         sampleName = file.split(R1_file_suffix)[0]
                         r2FilePath = os.path.join(subdir,sampleName + R2_file_suffix)
-                        file_out = os.path.join(out_seq_directory,sampleName + ".fasta")
-                        records_f = SeqIO.parse(open(filePath, "rU"), seq_fmt.lower())
-                        records_r = SeqIO.parse(open(r2FilePath, "rU"), seq_fmt.lower())
-                        handle = open(file_out, "w")
-                        count = SeqIO.write(interleave(records_f, records_r), handle, "fasta")
-                        handle.close()
+                        count = InterleaveReads(out_seq_directory, sampleName, filePath, r2FilePath, seq_fmt.lower())
         else:
             logging.info("Invalid sequence pair format inputs.\n")
             exit(0)
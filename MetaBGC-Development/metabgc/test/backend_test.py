@@ -0,0 +1,66 @@
+from metabgc.src.executionbackend import *
+from metabgc.src.producer_consumer import ShellTask, ThreadedTask, invoke_producer_consumer
+
+def threaded_task(name, threads=1):
+    return 0 if threads == 2 else 1
+
+def test_queue_backend(tmp_path, monkeypatch):
+    for env in [BACKEND_ENV, QUEUE_DIR_ENV, LOCAL_WORKERS_ENV]:
+        monkeypatch.setenv(env, "")
+    queue_dir = str(tmp_path / "queue")
+    SetExecutionBackend("queue", queue_dir, 2)
+    assert ExecutionBackend() == "queue"
+    task_list = [ShellTask("blastn", "true"), ShellTask("makeblastdb", "exit 3"), ShellTask("transeq", "true"),
+                 ThreadedTask("hmmsearch", "S1", 10, threaded_task, "S1")]
+    assert [IsQueuedTask(task) for task in task_list] == [True, True, False, True]
+    results = invoke_producer_consumer(task_list, 4)
+    status_dict = {r.name: r.status for r in results}
+    assert len(results) == 4
+    assert status_dict == {"true": 0, "exit 3": 3, "S1": 0}
+    # The queued tasks ran on the workers and left no pending or running task
+    batch_dir = os.path.join(queue_dir, os.listdir(queue_dir)[0])
+    assert len(os.listdir(os.path.join(batch_dir, RESULT_DIR))) == 3
+    assert os.listdir(os.path.join(batch_dir, TASK_DIR)) == []
+    assert os.listdir(os.path.join(batch_dir, RUNNING_DIR)) == []
+
+def test_worker_and_slurm_array(tmp_path, monkeypatch):
+    monkeypatch.setenv(BACKEND_ENV, "local")
+    queue_dir = str(tmp_path / "queue")
+    os.makedirs(queue_dir)
+    batch_dir = SubmitBatch(queue_dir, [ShellTask("blastn", "true"), ShellTask("blastn", "false")], 8)
+    script_file = WriteSlurmArray(batch_dir, 2, 8, "--partition=short --time=1:00:00")
+    with open(script_file) as infile:
+        script = infile.read()
+    assert "#SBATCH --array=0-1\n" in script
+    assert "#SBATCH --cpus-per-task=8\n" in script
+    assert "#SBATCH --partition=short\n" in script
+    assert "worker --queue_directory " + queue_dir + " --batch " + os.path.basename(batch_dir) in script
+    # A worker pulls all the pending tasks of the queue
+    assert RunWorker(queue_dir) == 2
+    assert RunWorker(queue_dir) == 0
+    results = WaitBatch(batch_dir, pollInterval=0)
+    assert [r["status"] for r in results] == [0, 1]
+
+def test_stale_claim(tmp_path, monkeypatch):
+    monkeypatch.setenv(BACKEND_ENV, "local")
+    queue_dir = str(tmp_path / "queue")
+    os.makedirs(queue_dir)
+    batch_dir = SubmitBatch(queue_dir, [ShellTask("blastn", "true"), ShellTask("blastn", "exit 2")], 1)
+    batch_id = os.path.basename(batch_dir)
+
+    # A task claimed by a preempted worker is requeued once its lease expires
+    def preempted_claim():
+        claimed_file = ClaimTask(batch_dir)
+        os.utime(claimed_file, (0, 0))
+        return claimed_file
+    preempted_claim()
+    results = WaitBatch(batch_dir, pollInterval=0, leaseTimeout=60, onRequeue=lambda: RunWorker(queue_dir, batch_id))
+    assert [r["status"] for r in results] == [0, 2]
+    assert os.listdir(os.path.join(batch_dir, RUNNING_DIR)) == []
+
+    # A task whose workers keep being preempted is reported failed
+    batch_dir = SubmitBatch(queue_dir, [ShellTask("blastn", "true")], 1)
+    preempted_claim()
+    results = WaitBatch(batch_dir, pollInterval=0, leaseTimeout=60, onRequeue=preempted_claim)
+    assert [r["status"] for r in results] == [-1]
+    assert os.listdir(os.path.join(batch_dir, RUNNING_DIR)) == []
@@ -0,0 +1,77 @@
+import stat
+from metabgc.src.blastdbregistry import *
+
+def fake_makeblastdb(bin_dir, log_file, status=0):
+    # Writes the index file of the -out database and logs the call
+    script = bin_dir / "makeblastdb"
+    script.write_text("#!/bin/sh\nwhile [ $# -gt 0 ]; do if [ \"$1\" = \"-out\" ]; then out=$2; fi; shift; done\n"
+                      "echo $out >> " + str(log_file) + "\ntouch $out.nin\nexit " + str(status) + "\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+
+def test_blastdb_registry(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log_file = tmp_path / "makeblastdb.log"
+    fake_makeblastdb(bin_dir, log_file)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv(BLASTDB_REGISTRY_ENV, "")
+    monkeypatch.setenv("METABGC_CACHE_DIR", "")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "user_cache"))
+    registry_dir = BlastDBRegistry()
+    assert registry_dir == str(tmp_path / "user_cache" / "metabgc" / "blastdb")
+
+    # Samples with the same reads share one database
+    sample_list = []
+    for name, seq in [("S1.fasta", "ACGT"), ("S2.fasta", "ACGT"), ("S3.fasta", "GGCC")]:
+        (tmp_path / name).write_text(">r1\n" + seq + "\n")
+        sample_list.append(str(tmp_path / name))
+    db_dict = RegisterBlastDBs(registry_dir, sample_list, 2)
+    assert db_dict[sample_list[0]] == db_dict[sample_list[1]] != db_dict[sample_list[2]]
+    assert os.path.exists(db_dict[sample_list[0]] + ".nin")
+    assert len(log_file.read_text().splitlines()) == 2
+    # A later run, e.g. for another protein family, finds the databases
+    assert RegisterBlastDBs(registry_dir, sample_list, 2) == db_dict
+    assert RegisteredBlastDB(registry_dir, sample_list[2]) == db_dict[sample_list[2]]
+    assert len(log_file.read_text().splitlines()) == 2
+
+    # A failed build leaves no database
+    fake_makeblastdb(bin_dir, log_file, 1)
+    (tmp_path / "S4.fasta").write_text(">r1\nTTTT\n")
+    assert RegisterBlastDBs(registry_dir, [str(tmp_path / "S4.fasta")], 1) == {}
+    assert not [d for subdir, dirs, files in os.walk(registry_dir) for d in dirs if ".tmp." in d]
+
+def test_inverted_blast_query_db(tmp_path, monkeypatch):
+    from metabgc.src.blastrunlib import RunPCInvertedBlastN, RunPCMakeDBandBlastN
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log_file = tmp_path / "makeblastdb.log"
+    fake_makeblastdb(bin_dir, log_file)
+    script = bin_dir / "blastn"
+    script.write_text("#!/bin/sh\nwhile [ $# -gt 0 ]; do if [ \"$1\" = \"-out\" ]; then out=$2; fi; shift; done\n"
+                      "echo $out >> " + str(tmp_path / "blastn.log") + "\ntouch $out\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv(BLASTDB_REGISTRY_ENV, str(tmp_path / "registry"))
+    monkeypatch.setenv("METABGC_CACHE_DIR", "")
+    read_dir = tmp_path / "reads"
+    read_dir.mkdir()
+    (read_dir / "S1.fasta").write_text(">r1\nACGT\n")
+    query_file = tmp_path / "identified.fasta"
+    query_file.write_text(">id1\nACGT\n")
+
+    # The database of the identified reads is built once for all the runs
+    for run in ["run1", "run2"]:
+        out_dir = tmp_path / run
+        out_dir.mkdir()
+        RunPCInvertedBlastN(str(read_dir), str(query_file), "blastn", "-perc_identity 95", 50, str(out_dir), 2)
+        assert os.path.exists(str(out_dir / "S1.txt"))
+    assert len(log_file.read_text().splitlines()) == 1
+
+    # The sample databases are built and the results looked up by the search tasks
+    out_dir = tmp_path / "forward"
+    out_dir.mkdir()
+    for run in range(2):
+        RunPCMakeDBandBlastN(str(read_dir), "", str(query_file), "blastn", "-perc_identity 95", str(out_dir), 2)
+    assert os.path.exists(str(out_dir / "S1.txt"))
+    assert len(log_file.read_text().splitlines()) == 2
+    assert len([line for line in (tmp_path / "blastn.log").read_text().splitlines() if line]) == 3
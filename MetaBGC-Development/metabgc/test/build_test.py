@@ -1,6 +1,9 @@
 import metabgc.src.metabgcbuild as build
 import metabgc.src.evaluate_sphmms as evaluate
 from Bio import SeqIO
+import os
+import random
+import stat
 
 def test_ungappedseqsearch():
     assert build.ungappedseqsearch("--MSE-HDTDV---LVGGSM","TDV-LV") == [8,16]
@@ -41,4 +44,36 @@ def test_evaluate_sphmm():
                              HMM_Model_Name,
                              F1_Threshold,
                              HMMOutDir,
-                             HMMHighPerfOutDir)
\ No newline at end of file
+                             HMMHighPerfOutDir)
+
+def test_parallel_sphmm_build(tmp_path, monkeypatch):
+    # hmmbuild -n name --amino out.hmm in.fas, faked by a copy of the window alignment
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "hmmbuild"
+    script.write_text("#!/bin/sh\ncp $5 $4\n")
+    script.chmod(script.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    random.seed(915)
+    seqs = ["".join(random.choice("ACDEFGHIKLMNPQRSTVWY") for i in range(120)) for j in range(6)]
+    prot_aln_file = tmp_path / "aln.fasta"
+    prot_aln_file.write_text("".join(">s{0}\n{1}\n".format(j, seq) for j, seq in enumerate(seqs)))
+    tp_prot_file = tmp_path / "tp.faa"
+    tp_prot_file.write_text(">s2\nMM{0}\n".format(seqs[2]))
+    outputs = []
+    for cpu in [1, 3]:
+        hmm_directory = tmp_path / "cpu{0}".format(cpu)
+        hmm_directory.mkdir()
+        gene_pos_file = hmm_directory / "Gene_Interval_Pos.txt"
+        gene_pos_file_aa = hmm_directory / "Gene_Interval_Pos_AA.txt"
+        hmmDict = build.gensphmmfiles("Fam", str(prot_aln_file), str(tp_prot_file), str(hmm_directory),
+                                      str(gene_pos_file), str(gene_pos_file_aa), cpu)
+        for segment, hmm in hmmDict.items():
+            assert [r.id for r in SeqIO.parse(hmm.hmmFile, "fasta")] == ["s0", "s1", "s3", "s4", "s5"]
+            assert segment == "{0}_{1}".format(hmm.intervalStart, hmm.intervalEnd)
+        outputs.append(([(k, v.intervalStart, os.path.basename(v.hmmFile)) for k, v in hmmDict.items()],
+                        gene_pos_file.read_text(), gene_pos_file_aa.read_text()))
+    assert len(outputs[0][0]) == 10
+    assert outputs[0][0][0] == ("0_30", 0, "Fam__30_10__0_30.hmm")
+    assert outputs[0] == outputs[1]
+    assert outputs[0][2].splitlines()[1] == "s2\t2\t32\t0_30\tFam"
@@ -1,3 +1,4 @@
+import pytest
 from metabgc.src.metabgccluster import *
 
 def test_cluster():
@@ -6,3 +7,156 @@ def test_cluster():
     tableAbundance = "AbcK/output/"+cohortStr+"/unique-biosynthetic-reads-abundance-table-wide.txt"
     identifiedReadFile = "AbcK/output/"+cohortStr+"/identify/identified-biosynthetic-reads.fasta"
     mbgccluster(table, tableAbundance, identifiedReadFile, 0.1, 1, 10, 10, 4)
+
+def test_sparse_cluster():
+    rng = np.random.RandomState(915)
+    # Groups of reads with scaled, noisy copies of a sparse sample profile
+    profiles = []
+    for group in range(20):
+        profile = rng.poisson(20, 40) * (rng.rand(40) < 0.2)
+        for read in range(rng.randint(1, 8)):
+            profiles.append(profile * rng.randint(1, 4) + rng.poisson(0.5, 40) * (rng.rand(40) < 0.1))
+    profiles.append(profiles[0].copy())
+    profiles.append(np.ones(40, dtype=int))
+    mat = np.array(profiles)
+    mat = mat[mat.sum(axis=1) > 0]
+    sample_idx, read_idx = np.nonzero(mat.T)
+    df_abundance = pd.DataFrame({"Sample": ["S" + str(i) for i in sample_idx],
+                                 "qseqid": ["r{:03d}".format(i) for i in read_idx],
+                                 "count": mat.T[sample_idx, read_idx]})
+    read_names, sample_names, sparse_mat = SparseAbundance(df_abundance)
+    assert read_names.tolist() == ["r{:03d}".format(i) for i in range(mat.shape[0])]
+    for max_dist, min_samples in [(0.1, 1), (0.3, 2), (0.05, 3)]:
+        dense_labels = DBSCAN(eps=max_dist, min_samples=min_samples, metric="correlation",
+                              algorithm="brute").fit_predict(sparse_mat.toarray())
+        sparse_labels = ClusterReads(sparse_mat, max_dist, min_samples)
+        assert sparse_labels.tolist() == dense_labels.tolist()
+    # Identical profiles, at distance zero, are in the same bin
+    labels = ClusterReads(sparse_mat, 0.1, 2)
+    assert labels[0] == labels[mat.shape[0] - 2] != -1
+
+def long_table(mat, read_names, sample_names):
+    read_idx, sample_idx = np.nonzero(mat)
+    return pd.DataFrame({"Sample": [sample_names[i] for i in sample_idx],
+                         "qseqid": [read_names[i] for i in read_idx],
+                         "count": mat[read_idx, sample_idx]})
+
+def test_incremental_cluster(tmp_path):
+    rng = np.random.RandomState(915)
+    # Bins of reads with scaled, noisy copies of a sample profile over 30 old and 10 new samples
+    profiles = []
+    bins = []
+    for group in range(12):
+        profile = rng.poisson(20, 40) * (rng.rand(40) < 0.3)
+        for read in range(rng.randint(2, 6)):
+            profiles.append(profile * rng.randint(1, 4) + rng.poisson(0.5, 40) * (rng.rand(40) < 0.1))
+            bins.append(group)
+    mat = np.array(profiles)
+    mat[np.array(bins) == 11, :30] = 0
+    read_names = ["r{:03d}".format(i) for i in range(mat.shape[0])]
+    sample_names = ["S{:02d}".format(i) for i in range(40)]
+    old_reads = [i for i in range(mat.shape[0]) if mat[i, :30].sum() > 0]
+    df_old = long_table(mat[old_reads, :30], [read_names[i] for i in old_reads], sample_names[:30])
+    df_new = long_table(mat[:, 30:], read_names, sample_names[30:])
+
+    fasta = tmp_path / "reads.fasta"
+    fasta.write_text("".join(">{0}\n{1}\n".format(r, "ACGT" * 20) for r in read_names))
+    old_dir = tmp_path / "old"
+    new_dir = tmp_path / "new"
+    old_dir.mkdir()
+    new_dir.mkdir()
+    df_old.to_csv(old_dir / "abund.txt", sep="\t", index=False)
+    df_new.to_csv(new_dir / "abund.txt", sep="\t", index=False)
+    mbgccluster(str(old_dir / "abund.txt"), str(old_dir / "abund.txt"), str(fasta), 0.1, 1, 2, 10, 1)
+    model = LoadClusterModel(str(old_dir / CLUSTER_MODEL_FILE))
+    assert model["samples"] == sample_names[:30]
+    assert model["reads"] == [read_names[i] for i in old_reads]
+
+    mbgcclusterupdate(str(old_dir / CLUSTER_MODEL_FILE), str(new_dir / "abund.txt"), str(new_dir / "abund.txt"),
+                      str(fasta), 2, 10, 1)
+    updated = LoadClusterModel(str(new_dir / CLUSTER_MODEL_FILE))
+    assert updated["samples"] == sample_names
+    assert sorted(updated["reads"]) == read_names
+    assert updated["max_dist"] == 0.1
+    labels = dict(zip(updated["reads"], updated["labels"].tolist()))
+    old_labels = dict(zip(model["reads"], model["labels"].tolist()))
+    # The bins are those of a full re-clustering and the old reads keep their bins
+    full_labels = ClusterReads(sparse.csr_matrix(mat.astype(np.float64)), 0.1, 1)
+    for i in range(mat.shape[0]):
+        for j in range(mat.shape[0]):
+            assert (labels[read_names[i]] == labels[read_names[j]]) == (full_labels[i] == full_labels[j])
+    for read, label in old_labels.items():
+        assert labels[read] == label
+    # Reads only found in the new samples are a new bin
+    new_reads = [read_names[i] for i in range(mat.shape[0]) if i not in old_reads]
+    assert new_reads and len(set(labels[r] for r in new_reads)) == 1
+    assert labels[new_reads[0]] not in old_labels.values()
+    # Samples already in the model are not added again
+    with pytest.raises(ValueError):
+        AddSamples(updated["reads"], updated["samples"], updated["matrix"], df_new)
+
+def test_print_bin_seqs(tmp_path, monkeypatch):
+    fasta = tmp_path / "reads.fasta"
+    fasta.write_text("".join(">r{0}\nACGT{1}\n".format(i, "A" * i) for i in range(8)))
+    df_read_labels = pd.DataFrame({"qseqid": ["r{0}".format(i) for i in range(8)],
+                                   "bin": [0, 1, 0, 2, 0, -1, 1, 3]})
+    # A pool of one open file, reopened for appending
+    monkeypatch.setattr("metabgc.src.metabgccluster.BIN_FASTA_MAX_OPEN", 1)
+    PrintBinSeqs([0, 1, 2, -1, 3], df_read_labels, str(fasta), 3, str(tmp_path))
+    def read_ids(path):
+        return [record.id for record in SeqIO.parse(str(path), "fasta")]
+    assert read_ids(tmp_path / "bin_fasta/gt3/0.fasta") == ["r0", "r2", "r4"]
+    assert read_ids(tmp_path / "bin_fasta/rem/1.fasta") == ["r1", "r6"]
+    assert read_ids(tmp_path / "bin_fasta/rem/singleton.fasta") == ["r3", "r5", "r7"]
+    assert read_ids(tmp_path / "identified_quantified_reads.fasta") == ["r{0}".format(i) for i in range(8)]
+    assert str(next(SeqIO.parse(str(tmp_path / "bin_fasta/rem/1.fasta"), "fasta")).seq) == "ACGTA"
+
+def test_cluster_sweep(tmp_path):
+    rng = np.random.RandomState(915)
+    profiles = []
+    for group in range(15):
+        profile = rng.poisson(20, 30) * (rng.rand(30) < 0.3)
+        for read in range(rng.randint(1, 12)):
+            profiles.append(profile * rng.randint(1, 4) + rng.poisson(0.5, 30) * (rng.rand(30) < 0.1))
+    mat = np.array(profiles)
+    mat = mat[mat.sum(axis=1) > 0]
+    df_abundance = long_table(mat, ["r{:03d}".format(i) for i in range(mat.shape[0])],
+                              ["S{:02d}".format(i) for i in range(30)])
+    df_abundance.to_csv(tmp_path / "abund.txt", sep="\t", index=False)
+    sweep_file = mbgcclustersweep(str(tmp_path / "abund.txt"), str(tmp_path / "abund.txt"),
+                                  [0.05, 0.2, 1.5], [1, 3], 5, 10, 2)
+    df_sweep = pd.read_csv(sweep_file, sep="\t")
+    assert len(df_sweep) == 6
+    sparse_mat = sparse.csr_matrix(mat.astype(np.float64))
+    for row in df_sweep.itertuples():
+        # Each point of the sweep is the clustering of its own parameters
+        cl = ClusterReads(sparse_mat, row.max_dist, row.min_samples)
+        assert np.load(os.path.join(str(tmp_path), CLUSTER_SWEEP_DIR, "DBSCAN_{0}_{1}.npy".format(
+            row.max_dist, row.min_samples))).tolist() == cl.tolist()
+        assert row.Bins == len(set(cl.tolist()) - {-1})
+        assert row.NoiseReads == (cl == -1).sum()
+    # The statistics of a point are those of BinSummary.txt
+    row = next(r for r in df_sweep.itertuples() if r.max_dist == 0.2 and r.min_samples == 3)
+    fasta = tmp_path / "reads.fasta"
+    fasta.write_text("".join(">r{:03d}\nACGT\n".format(i) for i in range(mat.shape[0])))
+    summary_file, abund_file = mbgccluster(str(tmp_path / "abund.txt"), str(tmp_path / "abund.txt"),
+                                           str(fasta), 0.2, 3, 5, 10, 1)
+    summary = open(summary_file).read()
+    assert "Number of Bins: {0}\n".format(row.Bins) in summary
+    assert "Number of Bins with >= 5 Reads: {0}\n".format(row.BinsGE5Reads) in summary
+    assert "Number of Bins with >= 5 Reads and Bin Abundance >= 10: {0}\n".format(row.BinsGTReadThreshAbundThresh) in summary
+    assert "Bin Abundance >= 10: {0}\n".format(row.SamplesWithBins) in summary
+    assert "Average Number of Reads in Bins with >= 5 Reads: {0}\n".format(row.AvgReadsGTReadThresh) in summary
+
+def test_failed_sweep_point(tmp_path, monkeypatch):
+    import metabgc.src.metabgccluster as metabgccluster
+    def failed_point(graphFile, matFile, max_dist, min_samples, labelFile):
+        return 1
+    monkeypatch.setattr(metabgccluster, "SweepClusterPoint", failed_point)
+    out_dir = tmp_path / "sweep"
+    out_dir.mkdir()
+    # The labels of an earlier sweep are not read back for a failed point
+    np.save(str(out_dir / "DBSCAN_1.5_1.npy"), np.zeros(3, dtype=int))
+    with pytest.raises(RuntimeError):
+        SweepClusterReads(sparse.csr_matrix(np.eye(3)), [1.5], [1], 5, 10, str(out_dir))
+    assert not os.path.exists(str(out_dir / "DBSCAN_1.5_1.npy"))
@@ -0,0 +1,101 @@
+from metabgc.src.hitstore import *
+import pytest
+from metabgc.src.hmmerrunlib import RunPCHMMDirectoryIntervals
+from metabgc.src.producer_consumer import Task, invoke_producer_consumer
+from metabgc.src.metabgcidentify import runidentifystreaming
+
+def append_sample_hits(storeDir, sample, score_dict, interval):
+    AppendHits(storeDir, score_dict, "ALL", sample, "AbcK", "30_10", interval)
+    return 0
+
+def test_hit_store(tmp_path):
+    store_dir = str(tmp_path / "CombinedHmmSearch")
+    OpenHitStore(store_dir)
+    assert not IsHitStoreComplete(store_dir)
+    task_list = [Task("hmmsearch", "S1", append_sample_hits, store_dir, "S1", {"read1/1_4": 35.0, "read1/1_1": 40.5}, "0_30"),
+                 Task("hmmsearch", "S2", append_sample_hits, store_dir, "S2", {"read3/1_5": 22.0}, "10_40"),
+                 Task("hmmsearch", "S3", append_sample_hits, store_dir, "S3", {}, "10_40")]
+    invoke_producer_consumer(task_list, 2)
+    CloseHitStore(store_dir)
+    assert IsHitStoreComplete(store_dir)
+    assert 1 <= len(HitStoreShards(store_dir)) <= 2
+    assert HitRowCount(store_dir) == 3
+
+    hit_df = ReadHitTable(store_dir).sort_values("HMMScore", ascending=False)
+    assert hit_df.readID.tolist() == ["read1/1_1", "read1/1_4", "read3/1_5"]
+    assert hit_df.sampleID.tolist() == ["S1", "S1", "S2"]
+
+    cutoff_file = tmp_path / "AbcK_F1_Cutoff.tsv"
+    cutoff_file.write_text("interval\tcutoff\n0_30\t20\n10_40\t20\n")
+    filtered_file = str(tmp_path / "spHMM-filtered-results.txt")
+    runidentifystreaming(store_dir, str(cutoff_file), filtered_file, str(tmp_path / "ids.txt"))
+    filtered_df = pd.read_csv(filtered_file, sep="\t")
+    assert sorted(filtered_df.readID) == ["read1/1", "read3/1"]
+
+    # Reopening the store starts a new search
+    OpenHitStore(store_dir)
+    assert not IsHitStoreComplete(store_dir)
+    assert HitRowCount(store_dir) == 0
+
+def test_short_writes(tmp_path, monkeypatch):
+    store_dir = OpenHitStore(str(tmp_path / "CombinedHmmSearch"))
+    write = os.write
+    # Each write takes at most 7 bytes, as a signal or a full pipe can cut a write short
+    monkeypatch.setattr(os, "write", lambda fd, data: write(fd, bytes(data[:7])))
+    score_dict = {"read%d/1_1" % i: float(i) for i in range(50)}
+    assert AppendHits(store_dir, score_dict, "ALL", "S1", "AbcK", "30_10", "0_30") == 50
+    assert sorted(ReadHitTable(store_dir).readID) == sorted(score_dict)
+    # A write that makes no progress raises instead of truncating the shard
+    monkeypatch.setattr(os, "write", lambda fd, data: 0)
+    with pytest.raises(OSError):
+        AppendHits(store_dir, {"read1/1_1": 1.0}, "ALL", "S2", "AbcK", "30_10", "0_30")
+
+def test_failed_search_raises(tmp_path, monkeypatch):
+    # An hmmsearch that always fails, so the hit store must not be closed
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "hmmsearch"
+    script.write_text("#!/bin/sh\nexit 1\n")
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    prot_dir = tmp_path / "prot"
+    prot_dir.mkdir()
+    (prot_dir / "S1.fasta").write_text(">r1\nMKV\n")
+    model = tmp_path / "m.hmm"
+    model.write_text("HMMER3/f\n")
+    store_dir = str(tmp_path / "store")
+    OpenHitStore(store_dir)
+    with pytest.raises(RuntimeError):
+        RunPCHMMDirectoryIntervals(str(prot_dir), [("0_30", str(model))], "cohort", "prot", "30_10",
+                                   str(tmp_path / "out"), 1, store_dir)
+    assert not IsHitStoreComplete(store_dir)
+
+def test_stream_error_stops_hmmscan(tmp_path, monkeypatch):
+    import subprocess
+    import metabgc.src.hmmerrunlib as hmmerrunlib
+    from metabgc.src.hmmrecord import HMMTask
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    script = bin_dir / "hmmscan"
+    script.write_text("#!/bin/sh\ncase $1 in -version|-h) echo \"# HMMER 3.3\"; exit 0;; esac\nexec sleep 60\n")
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+    monkeypatch.setenv("METABGC_CACHE_DIR", "")
+    proc_list = []
+    popen = subprocess.Popen
+    def record_popen(*args, **kwargs):
+        proc_list.append(popen(*args, **kwargs))
+        return proc_list[-1]
+    monkeypatch.setattr(subprocess, "Popen", record_popen)
+    def failed_translation(batch):
+        raise ValueError("bad batch")
+    monkeypatch.setattr(hmmerrunlib, "TranslateBatch", failed_translation)
+    (tmp_path / "S1.fasta").write_text(">r1\nATGAAAGTT\n")
+    (tmp_path / "combined.hmm").write_text("HMMER3/f\n")
+    task = HMMTask(str(tmp_path / "S1.fasta"), str(tmp_path / "combined.hmm"), str(tmp_path), "cohort", "S1",
+                   "prot", "30_10", "all")
+    # The error of the translation is raised once hmmscan is stopped and reaped
+    with pytest.raises(ValueError):
+        hmmerrunlib.runHMMScanStreamTask(task)
+    assert proc_list[-1].returncode is not None
+    assert proc_list[-1].stdin.closed
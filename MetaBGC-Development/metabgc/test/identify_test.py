@@ -28,3 +28,72 @@ def test_extract():
     os.makedirs(outputDir, 0o777, True)
     RunExtractDirectoryPar(readsDir, filteredTableFile, outputDir, identifyOutFile, "fasta", ncpus=4)
 
+
+def test_parseHMMScan(tmp_path):
+    tblFile = tmp_path / "S1__combined.tbl"
+    tblFile.write_text(
+        "# target name  accession  query name  accession  E-value  score  bias  E-value  score  bias  exp reg clu  ov env dom rep inc description of target\n"
+        "AbcK__30_10__0_30 - read1_1 - 1e-10 40.5 0.1 1e-10 40.5 0.1 1.0 1 0 0 1 1 1 1 -\n"
+        "AbcK__30_10__10_40 - read1_1 - 1e-05 22.0 0.1 1e-05 22.0 0.1 1.0 1 0 0 1 1 1 1 -\n"
+        "AbcK__30_10__10_40 - read2_4 - 1e-03 15.0 0.1 1e-03 15.0 0.1 1.0 1 0 0 1 1 1 1 -\n")
+    modelIntervalDict = {"AbcK__30_10__0_30": "0_30", "AbcK__30_10__10_40": "10_40", "AbcK__30_10__20_50": "20_50"}
+    interval_dict = parseHMMScan(str(tblFile), "hmmer3-tab", "ALL", "S1", "AbcK", "30_10", modelIntervalDict)
+    assert sorted(interval_dict["0_30"]) == ["read1_1"]
+    assert sorted(interval_dict["10_40"]) == ["read1_1", "read2_4"]
+    assert interval_dict["20_50"] == {}
+    assert interval_dict["10_40"]["read2_4"].bitscore == 15.0
+
+
+def test_parseHMM_duplicates(tmp_path):
+    tblFile = tmp_path / "S1__30_60.tbl"
+    tblFile.write_text(
+        "# target name  accession  query name  accession  E-value  score  bias  E-value  score  bias  exp reg clu  ov env dom rep inc description of target\n"
+        "read1_1 - AbcK__30_10__30_60 - 1e-05 22.0 0.1 1e-05 22.0 0.1 1.0 1 0 0 1 1 1 1 -\n"
+        "read2_4 - AbcK__30_10__30_60 - 1e-03 15.0 0.1 1e-03 15.0 0.1 1.0 1 0 0 1 1 1 1 -\n"
+        "read1_1 - AbcK__30_10__30_60 - 1e-10 40.5 0.1 1e-10 40.5 0.1 1.0 1 0 0 1 1 1 1 a read description\n")
+    assert parseHMMScores(str(tblFile)) == {"read1_1": 40.5, "read2_4": 15.0}
+    hmm_rec_dict = parseHMM(str(tblFile), "hmmer3-tab", "ALL", "S1", "AbcK", "30_10", "30_60")
+    assert hmm_rec_dict["read1_1"].bitscore == 40.5
+    outFile = str(tmp_path / "S1__30_60.txt")
+    createHitTable(parseHMMScores(str(tblFile)), outFile, "ALL", "S1", "AbcK", "30_10", "30_60")
+    hitDF = pd.read_csv(outFile, sep='\t', header=None)
+    assert list(hitDF[0]) == ["read1_1", "read2_4"]
+    assert list(hitDF[4]) == [40.5, 15.0]
+
+def write_threshold_inputs(tmp_path):
+    hmm_file = tmp_path / "CombinedHmmSearch.txt"
+    hmm_file.write_text(
+        "read1/1_1\tALL\tS1\tAbcK\t40.5\t30_10\t0_30\n"
+        "read1/1_4\tALL\tS1\tAbcK\t35.0\t30_10\t10_40\n"
+        "read2/1_2\tALL\tS1\tAbcK\t12.0\t30_10\t0_30\n"
+        "read3/1_5\tALL\tS2\tAbcK\t22.0\t30_10\t10_40\n"
+        "read3/1_6\tALL\tS2\tAbcK\t22.0\t30_10\t20_50\n"
+        "read4/1_1\tALL\tS2\tAbcK\t99.0\t30_10\t30_60\n")
+    cutoff_file = tmp_path / "AbcK_F1_Cutoff.tsv"
+    cutoff_file.write_text("interval\tcutoff\n0_30\t20\n10_40\t20\n20_50\t21\n")
+    return str(hmm_file), str(cutoff_file)
+
+
+def test_runidentify_threshold(tmp_path):
+    hmm_file, cutoff_file = write_threshold_inputs(tmp_path)
+    filtered_file = str(tmp_path / "spHMM-filtered-results.txt")
+    read_id_file = str(tmp_path / "CombinedReadIds.txt")
+    runidentify(hmm_file, cutoff_file, filtered_file, read_id_file)
+    filtered_df = pd.read_csv(filtered_file, sep="\t").sort_values(["readID", "interval"])
+    assert filtered_df.readID.tolist() == ["read1/1", "read3/1", "read3/1"]
+    assert filtered_df.HMMScore.tolist() == [40.5, 22.0, 22.0]
+    assert filtered_df.interval.tolist() == ["0_30", "10_40", "20_50"]
+    with open(read_id_file) as infile:
+        assert sorted(infile.read().split()) == ["read1/1", "read3/1"]
+
+
+def test_runidentifystreaming(tmp_path):
+    hmm_file, cutoff_file = write_threshold_inputs(tmp_path)
+    runidentify(hmm_file, cutoff_file, str(tmp_path / "filtered.txt"), str(tmp_path / "ids.txt"))
+    runidentifystreaming(hmm_file, cutoff_file, str(tmp_path / "filtered_stream.txt"), str(tmp_path / "ids_stream.txt"))
+    filtered_df = pd.read_csv(str(tmp_path / "filtered.txt"), sep="\t").sort_values(["readID", "interval"])
+    stream_df = pd.read_csv(str(tmp_path / "filtered_stream.txt"), sep="\t").sort_values(["readID", "interval"])
+    assert stream_df.reset_index(drop=True).equals(filtered_df.reset_index(drop=True))
+    with open(str(tmp_path / "ids_stream.txt")) as infile:
+        assert sorted(infile.read().split()) == ["read1/1", "read3/1"]
+    assert not os.path.exists(str(tmp_path / "filtered_stream.txt.tmp"))
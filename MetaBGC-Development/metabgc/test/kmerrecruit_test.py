@@ -0,0 +1,92 @@
+from metabgc.src.kmerrecruit import *
+import pickle
+import random
+
+REP_SEQ = b"ATGGCGTACGTTAGCCTAGGCTAACGTTGCAGTCCGATGCAAGTCGGATCCTAGCATCGTAGCTAGGCTTACG"
+
+def mutate(seq, positions):
+    seq = bytearray(seq)
+    for pos in positions:
+        seq[pos] = ord("A") if seq[pos] != ord("A") else ord("C")
+    return bytes(seq)
+
+def test_recruit_read(tmp_path):
+    rep_file = tmp_path / "CombinedIDFASTASeqs_Drep.fasta"
+    rep_file.write_text(">id1 rep\n" + REP_SEQ.decode() + "\n")
+    index = BuildKmerIndex(str(rep_file))
+    rep_len = len(REP_SEQ)
+
+    # Exact read on the forward strand, with flanks outside of the identified read
+    cols = RecruitRead("r1", b"TTTTT" + REP_SEQ[10:60], index)[0].split("\t")
+    assert cols[:8] == ["r1", "55", "6", "55", "id1", str(rep_len), "11", "60"]
+    assert float(cols[8]) == 100.0
+    # Reverse strand read with one mismatch in 50 bases
+    read = ReverseComplement(mutate(REP_SEQ[0:50], [25]))
+    cols = RecruitRead("r2", read, index)[0].split("\t")
+    assert cols[2:4] == ["50", "1"] and cols[6:8] == ["1", "50"]
+    assert float(cols[8]) == 98.0
+    # Too many mismatches, too short a coverage, or unrelated
+    assert RecruitRead("r3", mutate(REP_SEQ[0:50], [5, 15, 25, 35, 45]), index) == []
+    assert RecruitRead("r4", REP_SEQ[0:30], index) == []
+    assert RecruitRead("r5", b"A" * 60, index) == []
+
+    read_dir = tmp_path / "nucl_seq_dir"
+    read_dir.mkdir()
+    (read_dir / "S1.fasta").write_text(">r1\n" + REP_SEQ[5:70].decode() + "\n>r2\n" + "C" * 70 + "\n")
+    out_dir = tmp_path / "quantify_blastn_result"
+    out_dir.mkdir()
+    RunPCKmerRecruit(str(read_dir), str(rep_file), str(out_dir), 1)
+    with open(out_dir / "S1.txt") as infile:
+        assert [line.split("\t")[:5] for line in infile] == [["r1", "65", "1", "65", "id1"]]
+
+    ref_dir = tmp_path / "blast"
+    ref_dir.mkdir()
+    (ref_dir / "S1.txt").write_text("r1\t65\t1\t65\tid1\t75\t6\t70\t100.000\t1e-30\n"
+                                    "r3\t65\t1\t65\tid1\t75\t6\t70\t96.000\t1e-20\n")
+    compare_dict = CompareRecruitment(str(ref_dir), str(out_dir))
+    assert compare_dict["shared"] == 1
+    assert compare_dict["recall"] == 0.5 and compare_dict["precision"] == 1.0
+
+def test_candidate_reads(tmp_path, monkeypatch):
+    random.seed(915)
+    reps = ["".join(random.choice("ACGT") for i in range(100)) for j in range(20)]
+    rep_file = tmp_path / "CombinedIDFASTASeqs_Drep.fasta"
+    rep_file.write_text("".join(">id{0}\n{1}\n".format(j, rep) for j, rep in enumerate(reps)))
+    index = LoadKmerIndex(str(rep_file))
+    assert LoadKmerIndex(str(rep_file)) is index
+    reads = []
+    for r in range(300):
+        if r % 3 == 0:
+            rep = reps[random.randrange(20)].encode()
+            offset = random.randint(0, 40)
+            read = mutate(rep[offset:], random.sample(range(100 - offset), 2)) + b"ACGT" * (offset // 4)
+            reads.append(read if r % 2 else ReverseComplement(read))
+        else:
+            reads.append("".join(random.choice("ACGTN") for i in range(random.randint(5, 120))).encode())
+    reads.append(b"ACGTRYACGTACGTACGT")
+    read_dir = tmp_path / "nucl_seq_dir"
+    read_dir.mkdir()
+    (read_dir / "S1.fasta").write_text("".join(">r{0}\n{1}\n".format(i, read.decode()) for i, read in enumerate(reads)))
+
+    # The k-mer screen only drops the reads without hits
+    candidate = CandidateReads(reads, index)
+    assert candidate[-1]
+    expected = []
+    for i, read in enumerate(reads):
+        lines = RecruitRead("r" + str(i), read, index)
+        assert candidate[i] or not lines
+        expected.extend(lines)
+    assert len(expected) > 50 and candidate.sum() < len(reads)
+
+    # The tasks are sent the path of the identified reads, not their index
+    task_list = []
+    def capture(tasks, ncpus):
+        task_list.extend(tasks)
+        return invoke_producer_consumer(tasks, ncpus)
+    monkeypatch.setattr("metabgc.src.kmerrecruit.invoke_producer_consumer", capture)
+    out_dir = tmp_path / "quantify_blastn_result"
+    out_dir.mkdir()
+    RunPCKmerRecruit(str(read_dir), str(rep_file), str(out_dir), 2)
+    assert len(task_list) == 1 and len(pickle.dumps(task_list[0])) < 1000
+    with open(out_dir / "S1.txt") as infile:
+        assert infile.readlines() == expected
@@ -0,0 +1,70 @@
+from metabgc.src.pipelinestate import *
+from metabgc.src.producer_consumer import TaskResult, checkResults
+
+def write_task(text, status, tmpFile):
+    with open(tmpFile, 'w') as outfile:
+        outfile.write(text)
+    return status
+
+def test_run_checkpointed(tmp_path):
+    out_file = str(tmp_path / "S1.fasta")
+    # A failed task leaves neither the output nor its temporary file
+    assert runCheckpointed(out_file, write_task, "partial", 2) == 2
+    assert not os.path.exists(out_file) and not os.path.exists(TmpPath(out_file))
+    assert runCheckpointed(out_file, write_task, "complete", 0) == 0
+    assert IsTaskDone(out_file)
+    # A completed task is not rerun
+    assert runCheckpointed(out_file, write_task, "rerun", 0) == 0
+    with open(out_file) as infile:
+        assert infile.read() == "complete"
+    # An output without its marker is recomputed
+    ClearTaskDone(out_file)
+    assert runCheckpointed(out_file, write_task, "rerun", 0) == 0
+    with open(out_file) as infile:
+        assert infile.read() == "rerun"
+
+def test_run_stage(tmp_path):
+    out_dir = str(tmp_path)
+    calls = []
+    def stage(name):
+        calls.append(name)
+        out_files = tuple(os.path.join(out_dir, name + ext) for ext in (".summary.txt", ".cluster.txt"))
+        for out_file in out_files:
+            open(out_file, 'w').close()
+        return out_files
+    params = {"max_dist": 0.1}
+    assert not IsStageDone(out_dir, "cluster", params)
+    result = RunStage(out_dir, "cluster", params, ["summary_file", "cluster_file"], stage, "a")
+    assert result == (os.path.join(out_dir, "a.summary.txt"), os.path.join(out_dir, "a.cluster.txt"))
+    assert RunStage(out_dir, "cluster", params, ["summary_file", "cluster_file"], stage, "a") == result
+    assert calls == ["a"]
+    assert LoadManifest(out_dir)["stages"]["cluster"]["status"] == "done"
+    # Changed parameters or a missing output rerun the stage
+    RunStage(out_dir, "cluster", {"max_dist": 0.2}, ["summary_file", "cluster_file"], stage, "a")
+    os.remove(os.path.join(out_dir, "a.cluster.txt"))
+    assert not IsStageDone(out_dir, "cluster", {"max_dist": 0.2})
+    RunStage(out_dir, "cluster", {"max_dist": 0.2}, ["summary_file", "cluster_file"], stage, "a")
+    assert calls == ["a", "a", "a"]
+    # A stage whose tasks failed is not marked done, so a resumed run reruns it
+    def failed_stage(name):
+        checkResults([TaskResult("blastn", name, 0, 1.0, 1), TaskResult("blastn", name + "2", 1, 1.0, 1)], "BLAST search")
+    try:
+        RunStage(out_dir, "quantify", params, ["abund_file"], failed_stage, "S1")
+        assert False
+    except RuntimeError as e:
+        assert "S12" in str(e)
+    assert not IsStageDone(out_dir, "quantify", params)
+    assert LoadManifest(out_dir)["stages"]["quantify"]["status"] != "done"
+
+def test_stage_input_signature(tmp_path):
+    from metabgc.src.resultcache import DirectorySignature
+    sample_dir = tmp_path / "nucl"
+    sample_dir.mkdir()
+    (sample_dir / "S1.fasta").write_text(">r1\nACGT\n")
+    params = {"nucl_seq_directory": DirectorySignature(str(sample_dir))}
+    MarkStageDone(str(tmp_path), "identify", params, {})
+    assert IsStageDone(str(tmp_path), "identify", {"nucl_seq_directory": DirectorySignature(str(sample_dir))})
+    # An added sample reruns the stage reading the directory
+    (sample_dir / "S2.fasta").write_text(">r1\nACGT\n")
+    assert not IsStageDone(str(tmp_path), "identify", {"nucl_seq_directory": DirectorySignature(str(sample_dir))})
+    assert DirectorySignature(None) is None
@@ -0,0 +1,46 @@
+from metabgc.src.seedprefilter import *
+from metabgc.src.hitstore import OpenHitStore, AppendHits, CloseHitStore
+from metabgc.src.metabgcidentify import write_prefilter_report
+
+def test_seed_prefilter(tmp_path):
+    sphmm_dir = tmp_path / "HiPer_spHMMs"
+    sphmm_dir.mkdir()
+    (sphmm_dir / "AbcK__30_10__0_30.hmm").write_text("HMMER3/f\n")
+    (sphmm_dir / "AbcK__30_10__0_30.fas").write_text(">seed1\nMKTAY--IAKQRQISFVK\n>seed2\nGHWEDCPPGHW\n")
+    (sphmm_dir / "AbcK__30_10__10_40.hmm").write_text("HMMER3/f\n")
+    fas_files = SeedAlignmentFiles(str(sphmm_dir))
+    assert [os.path.basename(f) for f in fas_files] == ["AbcK__30_10__0_30.fas"]
+    seed_index = BuildSeedIndex(fas_files)
+
+    # Reads match through the reduced alphabet (I/L, K/R, D/E) but not across gaps or X
+    seq_list = [b"PPPPMKTAYPPPP", b"LARQRLSFVR", b"GHWEXDCPXG", b"PPPPPPPPPPPP", b"MKT", b""]
+    assert SeedHitMask(seq_list, seed_index).tolist() == [True, True, False, False, False, False]
+    assert SeedHitMask(seq_list, seed_index, minSeedHits=2).tolist() == [False, True, False, False, False, False]
+
+    prot_dir = tmp_path / "prot_seq_dir"
+    prot_dir.mkdir()
+    (prot_dir / "S1.fasta").write_text(">r1_1\nPPPPMKTAYIAPPPP\n>r1_2\nPPPPPPPPPPPP\n>r2_4\nLARQRL\nSFVR\n")
+    out_dir = RunPrefilterDirectoryPar(str(prot_dir), seed_index, str(tmp_path / "prefilter_prot_seq"), 1)
+    with open(os.path.join(out_dir, "S1.fasta")) as infile:
+        assert infile.read() == ">r1_1\nPPPPMKTAYIAPPPP\n>r2_4\nLARQRLSFVR\n"
+    assert ReadPrefilterStats(out_dir) == (3, 2)
+
+    kept_bytes, total_ctr, kept_ctr = FilterFastaBytes(b">r1_1\nPPPPPPPPPPPP\n>r1_2\nGHWEDCPP\n", seed_index)
+    assert (kept_bytes, total_ctr, kept_ctr) == (b">r1_2\nGHWEDCPP\n", 2, 1)
+
+    # Recall of the prefiltered identification against the unfiltered one
+    cutoff_file = tmp_path / "AbcK_F1_Cutoff.tsv"
+    cutoff_file.write_text("interval\tcutoff\n0_30\t20\n")
+    unfiltered_store = str(tmp_path / "CombinedHmmSearch_Unfiltered")
+    OpenHitStore(unfiltered_store)
+    AppendHits(unfiltered_store, {"r1_1": 40.0, "r2_4": 30.0, "r3_2": 25.0, "r4_1": 5.0}, "ALL", "S1", "AbcK", "30_10", "0_30")
+    CloseHitStore(unfiltered_store)
+    read_id_file = tmp_path / "CombinedReadIds.txt"
+    read_id_file.write_text("r1\nr2\n")
+    report_file = str(tmp_path / "prefilter-recall-report.txt")
+    recall = write_prefilter_report(report_file, unfiltered_store, str(cutoff_file), str(read_id_file), out_dir)
+    assert abs(recall - 2 / 3) < 1e-9
+    with open(report_file) as infile:
+        report = dict(line.split("\t") for line in infile.read().splitlines())
+    assert report["forwarded_reads"] == "2"
+    assert report["missed_reads"] == "1"
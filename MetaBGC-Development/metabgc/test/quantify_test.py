@@ -1,5 +1,6 @@
 from metabgc.src.metabgcquantify import *
 
+
 def test_combine():
     cohortStr = "MetaHit"
     blastn_search_directory = "AbcK/data/"+cohortStr+"/quantify_blastn_result"
@@ -8,9 +9,47 @@ def test_combine():
     combinedBLASTPath = "AbcK/output/"+cohortStr+"/CombinedQuantifyBLAST.txt"
     combine_blast_results(blastn_search_directory, combinedBLASTPath, cohortStr)
 
+
 def test_clustering():
     cohortStr = "MetaHit"
     abundFile = "AbcK/output/"+cohortStr+"/unique-biosynthetic-reads-abundance-table.txt"
     abundWideFile = "AbcK/output/"+cohortStr+"/unique-biosynthetic-reads-abundance-table-wide.txt"
     combinedBLASTPath = "AbcK/output/"+cohortStr+"/CombinedQuantifyBLAST.txt"
-    create_clustering_file(combinedBLASTPath,abundFile,abundWideFile)
\ No newline at end of file
+    create_clustering_file(combinedBLASTPath,abundFile,abundWideFile)
+
+
+def test_filter_subject_coverage(tmp_path):
+    blast_file = tmp_path / "S1.txt.raw"
+    # qseqid qlen qstart qend sseqid slen sstart send pident evalue
+    blast_file.write_text("r1\t100\t1\t100\tid1\t100\t1\t100\t100.0\t1e-50\n"
+                          "r2\t100\t1\t40\tid1\t100\t61\t100\t97.5\t1e-15\n"
+                          "r3\t100\t1\t50\tid2\t100\t100\t51\t96.0\t1e-20\n")
+    filtered_file = str(tmp_path / "S1.txt")
+    FilterSubjectCoverage(str(blast_file), filtered_file, 50)
+    with open(filtered_file) as infile:
+        assert [line.split("\t")[0] for line in infile] == ["r1", "r3"]
+
+
+def test_count_blast_hits(tmp_path):
+    blast_dir = tmp_path / "quantify_blastn_result"
+    blast_dir.mkdir()
+    (blast_dir / "S2.txt").write_text("s1\t100\t1\t100\tid2\t100\t1\t100\t100.000\t1e-50\n"
+                                      "s2\t100\t1\t100\tid2\t100\t1\t100\t99.000\t1e-50\n"
+                                      "s3\t100\t1\t100\tid1\t100\t1\t100\t99.000\t1e-50\n")
+    (blast_dir / "S1.txt").write_text("s1\t100\t1\t100\tid3\t100\t1\t100\t100.000\t1e-50\n")
+    (blast_dir / "S3.txt").write_text("")
+    read_list, sample_list, count_matrix = count_blast_hits(str(blast_dir), chunkSize=2)
+    assert read_list == ["id1", "id2", "id3"]
+    assert sample_list == ["S1", "S2"]
+    assert count_matrix.toarray().tolist() == [[0, 1], [0, 2], [1, 0]]
+
+    # The tables of the pivot of the combined BLAST table
+    write_abundance_tables(read_list, sample_list, count_matrix, str(tmp_path / "abund.txt"), str(tmp_path / "wide.txt"))
+    with open(tmp_path / "abund.txt") as infile:
+        assert infile.read() == "qseqid\tS1\tS2\nid1\t0\t1\nid2\t0\t2\nid3\t1\t0\n"
+    with open(tmp_path / "wide.txt") as infile:
+        assert infile.read() == "Sample\tqseqid\tcount\nS1\tid3\t1\nS2\tid1\t1\nS2\tid2\t2\n"
+    # The read x sample table is built by blocks of reads
+    blocks = list(abundance_table_blocks(read_list, sample_list, count_matrix, blockRows=2))
+    assert [len(block) for block in blocks] == [2, 1]
+    assert pd.concat(blocks).to_csv(sep="\t", index=False) == "qseqid\tS1\tS2\nid1\t0\t1\nid2\t0\t2\nid3\t1\t0\n"
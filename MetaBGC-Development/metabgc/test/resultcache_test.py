@@ -0,0 +1,59 @@
+from metabgc.src.resultcache import *
+
+def test_result_cache(tmp_path, monkeypatch):
+    reads = tmp_path / "S1.fasta"
+    reads.write_text(">r1\nMKV\n")
+    model = tmp_path / "model.hmm"
+    model.write_text("HMMER3/f\nNAME  m1\n")
+    key = ResultKey("hmmsearch", [str(reads)], [str(model)], "--F1 0.02")
+    assert key == ResultKey("hmmsearch", [str(reads)], [str(model)], "--F1 0.02")
+    assert key != ResultKey("hmmsearch", [str(reads)], [str(model)], "--F1 0.05")
+
+    # A result is only reused with a matching key
+    out_file = str(tmp_path / "run1" / "S1__30_60.tbl")
+    os.makedirs(os.path.dirname(out_file))
+    monkeypatch.setenv(CACHE_DIR_ENV, str(tmp_path / "cache"))
+    assert not IsCachedResult(out_file, key)
+    with open(out_file, 'w') as outfile:
+        outfile.write("hit\n")
+    StoreResult(out_file, key)
+    assert IsCachedResult(out_file, key)
+
+    model.write_text("HMMER3/f\nNAME  m2\n")
+    new_key = ResultKey("hmmsearch", [str(reads)], [str(model)], "--F1 0.02")
+    assert new_key != key
+    assert not IsCachedResult(out_file, new_key)
+    assert not os.path.exists(out_file)
+
+    # Another output directory restores the result from the shared cache
+    other_file = str(tmp_path / "run2" / "S1__30_60.tbl")
+    os.makedirs(os.path.dirname(other_file))
+    assert IsCachedResult(other_file, key)
+    with open(other_file) as infile:
+        assert infile.read() == "hit\n"
+
+    # Results without a key are stale, unless in a search directory given by the user
+    legacy_file = str(tmp_path / "run2" / "S2__30_60.tbl")
+    with open(legacy_file, 'w') as outfile:
+        outfile.write("hit\n")
+    monkeypatch.setenv(PROVIDED_RESULT_DIRS_ENV, "")
+    assert not IsCachedResult(legacy_file, new_key)
+    assert not os.path.exists(legacy_file)
+    with open(legacy_file, 'w') as outfile:
+        outfile.write("hit\n")
+    SetProvidedResultDirectory(str(tmp_path / "run2"))
+    assert IsCachedResult(legacy_file, new_key)
+
+    # The key is that of the read content, wherever the reads are
+    copied_reads = tmp_path / "run3" / "S1.fasta"
+    os.makedirs(os.path.dirname(str(copied_reads)))
+    copied_reads.write_text(reads.read_text())
+    assert ResultKey("hmmsearch", [str(copied_reads)], [str(model)], "--F1 0.02") == new_key
+    assert len([f for f in os.listdir(str(tmp_path / "cache" / "sig")) if f != "locks"]) == 3
+
+    # Without a shared cache the hashes are memoized in the user cache directory
+    monkeypatch.setenv(CACHE_DIR_ENV, "")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "user_cache"))
+    assert ContentHashDirectory() == str(tmp_path / "user_cache" / "metabgc" / "sig")
+    assert InputContentHash(str(copied_reads)) == InputContentHash(str(reads))
+    assert len([f for f in os.listdir(ContentHashDirectory()) if f != "locks"]) == 2
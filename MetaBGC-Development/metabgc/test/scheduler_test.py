@@ -0,0 +1,66 @@
+import signal
+import metabgc.src.producer_consumer
+from metabgc.src.producer_consumer import *
+
+def test_invoke_producer_consumer():
+    task_list = ["true", ShellTask("blastn", "false"), ShellTask("extract", "exit 3")]
+    results = invoke_producer_consumer(task_list, 2)
+    status_dict = {r.name: r.status for r in results}
+    assert len(results) == 3
+    assert status_dict["true"] == 0
+    assert status_dict["false"] != 0
+    assert status_dict["exit 3"] == 3
+    assert all(r.wallTime >= 0 for r in results)
+
+def threaded_task(name, threads=1):
+    return 0
+
+def test_invoke_adaptive_scheduler():
+    assert taskThreads(ThreadedTask("hmmsearch", "big", 100, threaded_task, "big"), 4, 103, 8, 8) == 8
+    assert taskThreads(ThreadedTask("hmmsearch", "small", 1, threaded_task, "small"), 100, 100, 8, 8) == 1
+    assert taskThreads(ThreadedTask("hmmsearch", "last", 1, threaded_task, "last"), 2, 2, 6, 8) == 4
+
+    task_list = [ThreadedTask("hmmsearch", name, size, threaded_task, name)
+                 for name, size in [("S1", 1), ("S2", 100), ("S3", 1), ("S4", 1)]]
+    task_list.append(ShellTask("extract", "true"))
+    results = invoke_adaptive_scheduler(task_list, 4)
+    threads_dict = {r.name: r.threads for r in results}
+    assert len(results) == 5
+    assert all(r.status == 0 for r in results)
+    # The largest sample is dispatched first with all the cores
+    assert results[0].name == "S2"
+    assert threads_dict["S2"] == 4
+    assert threads_dict["true"] == 1
+
+
+def killed_task(name, threads=1):
+    os.kill(os.getpid(), signal.SIGKILL)
+
+def test_killed_consumer(monkeypatch):
+    monkeypatch.setattr(metabgc.src.producer_consumer, "RESULT_POLL_SECS", 0.2)
+    # The task of a killed consumer is reported failed and the other tasks still run
+    task_list = [Task("extract", "killed", killed_task, "killed")] + [ShellTask("extract", "true") for i in range(3)]
+    results = invoke_producer_consumer(task_list, 1)
+    assert sorted((r.name, r.status) for r in results) == [("killed", -signal.SIGKILL)] + [("true", 0)] * 3
+
+    task_list = [ThreadedTask("hmmsearch", "killed", 100, killed_task, "killed"),
+                 ThreadedTask("hmmsearch", "S1", 1, threaded_task, "S1")]
+    results = invoke_adaptive_scheduler(task_list, 2)
+    assert sorted((r.name, r.status) for r in results) == [("S1", 0), ("killed", -signal.SIGKILL)]
+
+class UnpickleKilledTask(Task):
+    # Kills the consumer when it takes the task, before the start notice
+    def __setstate__(self, state):
+        os.kill(os.getpid(), signal.SIGKILL)
+
+def test_consumer_killed_before_start(monkeypatch):
+    monkeypatch.setattr(metabgc.src.producer_consumer, "RESULT_POLL_SECS", 0.2)
+    task_list = [UnpickleKilledTask("hmmsearch", "lost", threaded_task, "lost"),
+                 ThreadedTask("hmmsearch", "S1", 1, threaded_task, "S1")]
+    task_list[0].size = 100
+    results = invoke_adaptive_scheduler(task_list, 2)
+    assert sorted((r.name, r.status) for r in results) == [("S1", 0), ("lost", -signal.SIGKILL)]
+
+    task_list = [UnpickleKilledTask("extract", "lost", threaded_task, "lost"), ShellTask("extract", "true")]
+    results = invoke_producer_consumer(task_list, 1)
+    assert sorted((r.name, r.status) for r in results) == [("lost", -1), ("true", 0)]
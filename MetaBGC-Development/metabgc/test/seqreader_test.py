@@ -0,0 +1,67 @@
+from metabgc.src.seqreader import *
+from Bio import SeqIO
+
+def test_fastx_reader(tmp_path):
+    fastq_file = str(tmp_path / "reads.fastq")
+    with open(fastq_file, 'w') as outfile:
+        for i in range(50):
+            outfile.write("@read" + str(i) + "/1 desc" + str(i) + "\n" + "ACGTN" * (1 + i % 3) + "\n+\n" + "IIIII" * (1 + i % 3) + "\n")
+    fasta_file = str(tmp_path / "reads.fasta")
+    assert FastxToFasta(fastq_file, "fastq", fasta_file) == 50
+
+    # Small blocks split records across reads of the file
+    expected = [(r.description, str(r.seq)) for r in SeqIO.parse(fastq_file, "fastq")]
+    for seq_file, seq_fmt in [(fastq_file, "fastq"), (fasta_file, "fasta")]:
+        records = []
+        for header_list, seq_list in ReadFastxBatches(seq_file, seq_fmt, blockSize=37):
+            records.extend((h.decode(), s.decode()) for h, s in zip(header_list, seq_list))
+        assert records == expected
+
+    wrapped_file = str(tmp_path / "wrapped.fasta")
+    SeqIO.write(SeqIO.parse(fastq_file, "fastq"), wrapped_file, "fasta")
+    assert [(h.decode(), s.decode()) for h, s in IterFastxRecords(wrapped_file)] == expected
+    # Blocks that are not one line per sequence are split record by record
+    records = []
+    for header_list, seq_list in ReadFastxBatches(wrapped_file, "fasta", blockSize=37):
+        records.extend((h.decode(), s.decode()) for h, s in zip(header_list, seq_list))
+    assert records == expected
+    from metabgc.src.seqreader import _SplitFastaBlock
+    assert _SplitFastaBlock(b"h1\nAC\nGT\n>h2") == ([b"h1", b"h2"], [b"ACGT", b""])
+    assert _SplitFastaBlock(b"h1\nACGT\n>h2\nTT") == ([b"h1", b"h2"], [b"ACGT", b"TT"])
+
+    interleaved_file = str(tmp_path / "interleaved.fasta")
+    assert InterleaveFastx(fastq_file, fastq_file, "fastq", interleaved_file) == 100
+    interleaved = [r.id for r in SeqIO.parse(interleaved_file, "fasta")]
+    assert interleaved[:4] == ["read0/1", "read0/1", "read1/1", "read1/1"]
+
+    extract_file = str(tmp_path / "extract.fasta")
+    assert ExtractFastxRecords(wrapped_file, "fasta", {"read3/1", "read7/1", "missing"}, extract_file) == 2
+    assert [r.description for r in SeqIO.parse(extract_file, "fasta")] == ["read3/1 desc3", "read7/1 desc7"]
+
+def test_fastq_empty_reads(tmp_path):
+    # Zero-length reads are split alike in the blocks and in the tail of the file
+    expected = [("r1", "ACGT"), ("r2", ""), ("r3", "")]
+    for ending in ["\n", ""]:
+        fastq_file = tmp_path / "empty.fastq"
+        fastq_file.write_text("@r1\nACGT\n+\nIIII\n@r2\n\n+\n\n@r3\n\n+\n" + ending)
+        for block_size in [5, 1000]:
+            records = []
+            for header_list, seq_list in ReadFastxBatches(str(fastq_file), "fastq", blockSize=block_size):
+                records.extend((h.decode(), s.decode()) for h, s in zip(header_list, seq_list))
+            assert records == expected
+
+def test_compressed_fastx(tmp_path):
+    import gzip
+    fastq_text = "".join("@read" + str(i) + "\nACGT\n+\nIIII\n" for i in range(20))
+    with gzip.open(str(tmp_path / "S1_R1.fastq.gz"), 'wt') as outfile:
+        outfile.write(fastq_text)
+    fasta_file = str(tmp_path / "S1.fasta")
+    assert FastxToFasta(str(tmp_path / "S1_R1.fastq.gz"), "fastq", fasta_file) == 20
+    assert sum(1 for record in IterFastxRecords(fasta_file)) == 20
+
+    assert re.match(SeqFileRegex("fastq"), "S1_R1.fastq.gz")
+    assert re.match(SeqFileRegex("fasta"), "S1.fasta.zst")
+    assert not re.match(SeqFileRegex("fasta"), "S1.fasta.tbl")
+    assert SeqFileStem("/data/S1.fasta.bgz") == "S1"
+    assert SeqFileStem("S1.fasta") == "S1"
+    assert CompressionExt("S1_R1.fastq.gz") == ".gz"
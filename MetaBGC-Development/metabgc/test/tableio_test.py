@@ -0,0 +1,44 @@
+import pytest
+from metabgc.src.tableio import *
+from metabgc.src.metabgcidentify import runidentifystreaming
+from metabgc.src.metabgcquantify import create_clustering_file
+
+def test_parquet_tables(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    monkeypatch.setenv(INTERMEDIATE_FORMAT_ENV, "parquet")
+    assert TableFileName(str(tmp_path / "CombinedHmmSearch.txt")).endswith("CombinedHmmSearch.parquet")
+
+    columns = ["readID", "sampleType", "sampleID", "protType", "HMMScore", "window", "interval"]
+    hit_files = []
+    for sample, rows in [("S1", [("read1/1_1", 40.5, "0_30"), ("read1/1_4", 35.0, "10_40")]),
+                         ("S2", [("read3/1_5", 22.0, "10_40")]), ("S3", [])]:
+        df = pd.DataFrame([(r, "ALL", sample, "AbcK", s, "30_10", i) for r, s, i in rows], columns=columns)
+        hit_files.append(TableFileName(str(tmp_path / (sample + "__combined.txt"))))
+        WriteTable(df, hit_files[-1])
+    combined_file = TableFileName(str(tmp_path / "CombinedHmmSearch.txt"))
+    assert ConcatTables(hit_files, combined_file) == 3
+    assert TableRowCount(combined_file) == 3
+
+    cutoff_file = tmp_path / "AbcK_F1_Cutoff.tsv"
+    cutoff_file.write_text("interval\tcutoff\n0_30\t20\n10_40\t20\n")
+    filtered_file = str(tmp_path / "spHMM-filtered-results.txt")
+    runidentifystreaming(combined_file, str(cutoff_file), filtered_file, str(tmp_path / "ids.txt"))
+    filtered_df = pd.read_csv(filtered_file, sep="\t")
+    assert sorted(filtered_df.readID) == ["read1/1", "read3/1"]
+
+    blast_df = pd.DataFrame({"sseqid": ["c1", "c2", "c3"], "slen": 100, "sstart": 1, "send": 100,
+                             "qseqid": ["read1/1", "read1/1", "read3/1"], "qlen": 100, "qstart": 1, "qend": 100,
+                             "qcovs": 100, "pident": 99.0, "evalue": 1e-30, "Sample": ["S1", "S2", "S2"],
+                             "cohort": "C"})
+    blast_file = TableFileName(str(tmp_path / "CombinedQuantifyBLAST.txt"))
+    WriteTable(blast_df, blast_file)
+    abund_file = TableFileName(str(tmp_path / "abundance-table.txt"))
+    abund_wide_file = TableFileName(str(tmp_path / "abundance-table-wide.txt"))
+    create_clustering_file(blast_file, abund_file, abund_wide_file)
+    abund_df = ReadTable(abund_file)
+    assert list(abund_df.columns) == ["qseqid", "S1", "S2"]
+    assert abund_df.set_index("qseqid").loc["read1/1"].tolist() == [1, 1]
+
+    tsv_file = str(tmp_path / "abundance-table.tsv")
+    ExportTSV(abund_file, tsv_file)
+    assert ReadTable(tsv_file).equals(pd.read_csv(tsv_file, sep="\t"))
@@ -0,0 +1,15 @@
+from metabgc.src.seqtranslate import *
+from Bio.Seq import Seq
+
+def test_translate_batch():
+    seq_list = ["ATGGCCATTGTAATGGGCCGCTGAAAGGGTGCCCGATAG", "ATGNNNGAYCARTTAA", "ACGTNRYKMacgt", "AT"]
+    records = [(("read" + str(i)).encode(), seq.encode()) for i, seq in enumerate(seq_list)]
+    lines = TranslateBatch(records).decode().split("\n")
+    prot_dict = dict(zip([l[1:] for l in lines[0::2]], lines[1::2]))
+    assert "read3_1" not in prot_dict
+    for i, seq in enumerate(seq_list[:3]):
+        for offset in range(3):
+            codons = (len(seq) - offset) // 3
+            piece = Seq(seq[offset:offset + 3 * codons])
+            assert prot_dict["read" + str(i) + "_" + str(offset + 1)] == str(piece.translate(table=11)).upper()
+            assert prot_dict["read" + str(i) + "_" + str(offset + 4)] == str(piece.reverse_complement().translate(table=11)).upper()
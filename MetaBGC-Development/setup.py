@@ -37,6 +37,7 @@ setup(
     long_description=long_description,
     long_description_content_type='text/markdown',
     install_requires=install_requires,
+    extras_require={'parquet': ['pyarrow']},
     entry_points={
         'console_scripts': ['metabgc=metabgc.metabgc_cmds:main'],
     },